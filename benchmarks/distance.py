@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+# distance.py
+#
+# Compare the speed and accuracy of the distance kernels in curvature/distance.py.
+#
+# The points of routes made by generate.py's NetworkGenerator (curves of 10 to
+# 300 meter radius, hairpins and straight stretches, with segments of a few
+# meters up to 500) are measured with each kernel's arcs(), as the collector
+# measures ways. Each kernel is timed over --repeat runs, keeping the fastest,
+# and its segment lengths and curve radii are compared with reference values
+# computed from 3D unit vectors with the chord formula, which is well
+# conditioned at any distance. The reference is itself only good to a relative
+# error of about 1e-10, so smaller errors aren't measured.
+#
+# Each kernel's arc(), which measures the distance between the ends of a way, is
+# also compared with the reference for random pairs of points at distances of
+# 1m to 100km.
+#
+# Usage:
+#   python benchmarks/distance.py --routes 200
+
+import os
+import sys
+import math
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from curvature.distance import kernels
+import generate
+
+rad_earth_m = 6373000 # Radius of the earth in meters
+
+parser = argparse.ArgumentParser(description='Compare the speed and accuracy of the distance kernels.')
+parser.add_argument('--routes', type=int, default=200, help='The number of routes to generate. The default is 200.')
+parser.add_argument('--points', type=int, default=600, help='The number of points in each route. The default is 600.')
+parser.add_argument('--seed', type=int, default=1, help='The seed of the generated routes. The default is 1.')
+parser.add_argument('--repeat', type=int, default=5, help='The number of times to time each kernel, keeping the fastest. The default is 5.')
+args = parser.parse_args()
+
+# The distance in meters between two points given as unit vectors.
+def chord_distance(p, q):
+	chord = math.sqrt((p[0] - q[0]) ** 2 + (p[1] - q[1]) ** 2 + (p[2] - q[2]) ** 2)
+	return 2 * math.asin(min(chord / 2, 1.0)) * rad_earth_m
+
+def unit_vector(lat, lon):
+	lat = math.radians(lat)
+	lon = math.radians(lon)
+	return (math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), math.sin(lat))
+
+def circumradius(a, b, c):
+	divisor = math.sqrt(math.fabs((a+b+c)*(b+c-a)*(c+a-b)*(a+b-c)))
+	if not (a > 0 and b > 0 and c > 0) or not divisor:
+		return None
+	return (a * b * c) / divisor
+
+# The reference lengths of each segment and radii of each triangle of a route.
+def reference(lats, lons):
+	vectors = [unit_vector(lat, lon) for lat, lon in zip(lats, lons)]
+	lengths = [chord_distance(vectors[i], vectors[i + 1]) for i in xrange(len(vectors) - 1)]
+	skips = [chord_distance(vectors[i], vectors[i + 2]) for i in xrange(len(vectors) - 2)]
+	return lengths, skips
+
+# Errors are grouped by segment length.
+bins = ((0, 10), (10, 100), (100, 1000), (1000, 10000), (10000, float('inf')))
+
+def bin_name(low, high):
+	if high == float('inf'):
+		return '>{:g}m'.format(low)
+	return '{:g}-{:g}m'.format(low, high)
+
+def format_error(error):
+	if error is None:
+		return '{:>10}'.format('-')
+	return '{:10.1e}'.format(error)
+
+network = generate.NetworkGenerator(open(os.devnull, 'w'), args.seed)
+routes = []
+for i in xrange(args.routes):
+	r = network.random
+	points = network.route_points(r.uniform(-60, 60), r.uniform(-180, 180), args.points)
+	lats = [lat for lat, lon in points]
+	lons = [lon for lat, lon in points]
+	routes.append((lats, lons, reference(lats, lons)))
+num_arcs = sum([len(lats) * 2 - 3 for lats, lons, ref in routes])
+
+print '{} routes, {} arcs per run'.format(len(routes), num_arcs)
+print
+print '{:16} {:>10} {:>12}   {}'.format('kernel', 'seconds', 'ns per arc', 'max relative length error by segment length')
+print '{:16} {:>10} {:>12}   {}'.format('', '', '', '  '.join(['{:>10}'.format(bin_name(*b)) for b in bins]))
+for name in ('cosines', 'haversine', 'equirectangular'):
+	kernel = kernels[name]
+	best = None
+	for i in xrange(args.repeat):
+		start = time.time()
+		for lats, lons, ref in routes:
+			kernel.arcs(lats, lons)
+		seconds = time.time() - start
+		if best is None or seconds < best:
+			best = seconds
+
+	errors = [None] * len(bins)
+	radius_error = 0.0
+	for lats, lons, ref in routes:
+		arcs, skip_arcs = kernel.arcs(lats, lons)
+		ref_lengths, ref_skips = ref
+		for i in xrange(len(arcs)):
+			length = arcs[i] * rad_earth_m
+			ref_length = ref_lengths[i]
+			if not ref_length:
+				continue
+			error = abs(length - ref_length) / ref_length
+			for j, (low, high) in enumerate(bins):
+				if low <= ref_length < high:
+					errors[j] = max(errors[j], error)
+		for i in xrange(len(skip_arcs)):
+			radius = circumradius(arcs[i] * rad_earth_m, arcs[i + 1] * rad_earth_m, skip_arcs[i] * rad_earth_m)
+			ref_radius = circumradius(ref_lengths[i], ref_lengths[i + 1], ref_skips[i])
+			# Only curves that could reach a curvature level.
+			if radius is None or ref_radius is None or ref_radius > 175:
+				continue
+			radius_error = max(radius_error, abs(radius - ref_radius) / ref_radius)
+	print '{:16} {:10.3f} {:12.0f}   {}'.format(name, best, best / num_arcs * 1e9, '  '.join([format_error(e) for e in errors]))
+	print '{:16} {:>10} {:>12}   max relative error of curve radii under 175m: {:.1e}'.format('', '', '', radius_error)
+
+# The point at a distance and heading from another on the sphere.
+def destination(lat, lon, meters, heading):
+	lat = math.radians(lat)
+	lon = math.radians(lon)
+	angle = float(meters) / rad_earth_m
+	lat2 = math.asin(math.sin(lat) * math.cos(angle) + math.cos(lat) * math.sin(angle) * math.cos(heading))
+	lon2 = lon + math.atan2(math.sin(heading) * math.sin(angle) * math.cos(lat), math.cos(angle) - math.sin(lat) * math.sin(lat2))
+	return math.degrees(lat2), math.degrees(lon2)
+
+distances = (1, 10, 100, 1000, 10000, 100000)
+r = network.random
+pairs = {}
+for meters in distances:
+	pairs[meters] = []
+	for i in xrange(1000):
+		lat = r.uniform(-60, 60)
+		lon = r.uniform(-180, 180)
+		lat2, lon2 = destination(lat, lon, meters, r.uniform(0, 2 * math.pi))
+		pairs[meters].append((lat, lon, lat2, lon2, chord_distance(unit_vector(lat, lon), unit_vector(lat2, lon2))))
+
+print
+print '{:16}   {}'.format('kernel', 'max relative error of arc() by distance')
+print '{:16}   {}'.format('', '  '.join(['{:>10}'.format('{:g}m'.format(meters)) for meters in distances]))
+for name in ('cosines', 'haversine', 'equirectangular'):
+	kernel = kernels[name]
+	errors = []
+	for meters in distances:
+		error = 0.0
+		for lat, lon, lat2, lon2, ref_length in pairs[meters]:
+			try:
+				length = kernel.arc(lat, lon, lat2, lon2) * rad_earth_m
+			except ValueError:
+				# A math domain error, which fails the way.
+				error = float('inf')
+				continue
+			error = max(error, abs(length - ref_length) / ref_length)
+		errors.append(error)
+	print '{:16}   {}'.format(name, '  '.join([format_error(e) for e in errors]))
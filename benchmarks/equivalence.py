@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+# equivalence.py
+#
+# Check that alternate implementations answer the same sections on a synthetic
+# road network made by generate.py.
+#
+# The sections calculated with --engine numpy are compared with those of the
+# python engine for each distance kernel. The sections must be the same: the
+# same ways, split at the same segments, with the same points, curvature levels
+# and eliminated segments. Their length, curvature and distance must match to a
+# relative --tolerance, 1e-9 by default as the --engine option promises, and so
+# must the radius of each segment in a curve. The radii of nearly straight
+# segments aren't compared: the circumradius of three points in almost a line
+# magnifies the rounding of their distances many times over, and any radius
+# over level_1_max_radius is straight all the same. This is skipped if numpy
+# isn't installed.
+#
+# With --reference, curvature.py of another checkout (e.g. one from before a
+# change that should not change any output) and of this one are both run on the
+# network with tabular and colorized KML output of every way, and the outputs
+# must be byte for byte identical. Only options that every version has are used.
+#
+# The exit status is 1 if any check fails.
+#
+# Usage:
+#   python benchmarks/equivalence.py
+#   python benchmarks/equivalence.py --reference ../curvature-master
+
+import os
+import sys
+import shutil
+import filecmp
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from curvature.collector import WayCollector
+from curvature.distance import kernels
+from curvature.input import OsmInput
+import generate
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+parser = argparse.ArgumentParser(description='Check that alternate implementations answer the same sections.')
+parser.add_argument('--routes', type=int, default=50, help='The number of routes to generate. The default is 50.')
+parser.add_argument('--seed', type=int, default=1, help='The seed of the generated network. The default is 1.')
+parser.add_argument('--tolerance', type=float, default=1e-9, help='The relative difference allowed between the values of the engines. The default is 1e-9.')
+parser.add_argument('--reference', type=str, default=None, help='A checkout of curvature to compare the outputs of this one with.')
+parser.add_argument('--work_dir', type=str, default=os.path.join(tempfile.gettempdir(), 'curvature-benchmarks'), help='The directory to keep generated inputs in. The default is curvature-benchmarks in the temporary directory.')
+args = parser.parse_args()
+
+# Calculate the sections of a network with an engine and distance kernel.
+def sections(filename, engine, kernel):
+	collector = WayCollector()
+	collector.engine = engine
+	collector.distance_kernel = kernels[kernel]
+	source = OsmInput(filename)
+	try:
+		collector.load_source(source)
+	finally:
+		source.close()
+	return collector.ways
+
+def close(a, b):
+	return abs(a - b) <= args.tolerance * max(abs(a), abs(b))
+
+# Answer a description of the first difference between two sections, or None
+# if they are the same.
+def difference(a, b, max_radius):
+	if (a.id, a.name, a.type, a.surface) != (b.id, b.name, b.type, b.surface):
+		return 'way {} {!r} differs from way {} {!r}'.format(a.id, a.name, b.id, b.name)
+	if len(a.geometry) != len(b.geometry) or list(a.geometry.points()) != list(b.geometry.points()):
+		return 'the points differ'
+	for name in ('length', 'curvature', 'distance'):
+		if not close(getattr(a, name), getattr(b, name)):
+			return 'the {} {!r} differs from {!r}'.format(name, getattr(a, name), getattr(b, name))
+	for i in xrange(len(a.geometry)):
+		if a.geometry.level(i) != b.geometry.level(i):
+			return 'the level of segment {} differs'.format(i)
+		if a.geometry.is_eliminated(i) != b.geometry.is_eliminated(i):
+			return 'the elimination of segment {} differs'.format(i)
+		if min(a.geometry.radius(i), b.geometry.radius(i)) < max_radius and not close(a.geometry.radius(i), b.geometry.radius(i)):
+			return 'the radius of segment {} differs'.format(i)
+	return None
+
+def compare_engines(filename):
+	failed = False
+	for kernel in ('cosines', 'haversine', 'equirectangular'):
+		python = sections(filename, 'python', kernel)
+		numpy = sections(filename, 'numpy', kernel)
+		differences = 0
+		if len(python) != len(numpy):
+			print '{}: {} sections with the python engine, {} with numpy'.format(kernel, len(python), len(numpy))
+			failed = True
+			continue
+		for i, (a, b) in enumerate(zip(python, numpy)):
+			description = difference(a, b, WayCollector.level_1_max_radius)
+			if description is not None:
+				if not differences:
+					print '{}: section {}: {}'.format(kernel, i, description)
+				differences += 1
+		if differences:
+			print '{}: {} of {} sections differ'.format(kernel, differences, len(python))
+			failed = True
+		else:
+			print '{}: all {} sections match'.format(kernel, len(python))
+	return failed
+
+# Run the curvature.py of a checkout on a network, writing its outputs to a
+# directory.
+def run_checkout(checkout, filename, output_dir):
+	os.makedirs(output_dir)
+	with open(os.path.join(output_dir, 'tab.txt'), 'w') as tab:
+		subprocess.check_call([sys.executable, 'curvature.py', '-t', '--colorize', '--min_curvature', '0', '--min_length', '0', '--output_path', output_dir, filename], cwd=checkout, stdout=tab)
+
+def compare_checkouts(filename):
+	work = tempfile.mkdtemp(prefix='curvature-equivalence-')
+	try:
+		run_checkout(args.reference, filename, os.path.join(work, 'reference'))
+		run_checkout(root_dir, filename, os.path.join(work, 'current'))
+		names = sorted(os.listdir(os.path.join(work, 'reference')))
+		match, mismatch, errors = filecmp.cmpfiles(os.path.join(work, 'reference'), os.path.join(work, 'current'), names, shallow=False)
+		for name in mismatch + errors:
+			print '{} differs from the reference'.format(name)
+		if not mismatch and not errors:
+			print 'all {} outputs match the reference'.format(len(names))
+		return bool(mismatch or errors)
+	finally:
+		shutil.rmtree(work, ignore_errors=True)
+
+if not os.path.isdir(args.work_dir):
+	os.makedirs(args.work_dir)
+filename = os.path.join(args.work_dir, 'equivalence-{}-{}.osm'.format(args.routes, args.seed))
+if not os.path.exists(filename):
+	sys.stderr.write('Generating {}\n'.format(filename))
+	generate.generate(filename, args.routes, seed=args.seed)
+
+failed = False
+try:
+	import numpy
+except ImportError:
+	numpy = None
+if numpy is None:
+	print 'numpy is not installed, skipping the engine comparison'
+else:
+	failed |= compare_engines(filename)
+if args.reference is not None:
+	failed |= compare_checkouts(filename)
+if failed:
+	exit(1)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+# generate.py
+#
+# Generate a synthetic OSM XML road network for benchmarking.
+#
+# Each route is a line of straight stretches, runs of curves of various radii
+# and hairpin turns, split into many ways that share their end nodes. Some
+# ways are reversed, some routes have a ref and others only a name, some ways
+# carry several route refs (e.g. "US 2;VT 100") and some have a surface that
+# is ignored. Unnamed roads, footways and nodes that aren't on any way are
+# added around them as noise. The same arguments and seed always generate the
+# same file.
+#
+# The output is OSM XML, compressed with bzip2 or gzip if the file name ends in
+# .bz2 or .gz. PBF isn't generated since none of our dependencies can write
+# it; convert the XML with osmium or osmconvert to benchmark PBF input.
+#
+# Usage:
+#   python benchmarks/generate.py --routes 500 --ways_per_route 20 network.osm.bz2
+
+import bz2
+import math
+import gzip
+import random
+import argparse
+
+rad_earth_m = 6373000 # Radius of the earth in meters
+
+highway_types = ('secondary', 'residential', 'tertiary', 'primary', 'unclassified', 'trunk')
+names = ('Hill Rd', 'River Rd', 'Main St', 'Notch Rd', 'Gap Rd', 'Mountain Rd', 'Valley Rd', 'Lake Rd', u'Côte Rd')
+
+class NetworkGenerator(object):
+	def __init__(self, f, seed=1):
+		self.f = f
+		self.random = random.Random(seed)
+		self.next_node = 1
+		self.next_way = 1
+		self.ways = []
+		self.num_nodes = 0
+
+	# Write a network of routes, each of about ways_per_route ways with about
+	# points_per_way points each, to our file.
+	def generate(self, routes, ways_per_route, points_per_way):
+		self.f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+		self.f.write('<osm version="0.6" generator="curvature-benchmarks">\n')
+		for i in xrange(routes):
+			self.add_route(i, ways_per_route, points_per_way)
+		# Ways are written after all of the nodes, as in OSM extracts.
+		for osm_id, refs, tags in self.ways:
+			self.write_way(osm_id, refs, tags)
+		self.f.write('</osm>\n')
+
+	def add_route(self, number, ways_per_route, points_per_way):
+		r = self.random
+		# Scatter the routes over an area about the size of Vermont.
+		lat = r.uniform(42.7, 45.0)
+		lon = r.uniform(-73.4, -71.5)
+		points = self.route_points(lat, lon, ways_per_route * points_per_way)
+		refs = [self.add_node(p_lat, p_lon) for p_lat, p_lon in points]
+
+		kind = r.random()
+		ref = 'VT {}'.format(number + 1)
+		if kind < 0.4:
+			tags = {'ref': ref}
+		elif kind < 0.7:
+			tags = {'ref': ref, 'name': r.choice(names)}
+		elif kind < 0.9:
+			tags = {'name': u'{} {}'.format(r.choice(names), number + 1)}
+		else:
+			# Shares its ways with another route.
+			tags = {'ref': 'US {};{}'.format(r.randint(1, 20), ref)}
+		tags['highway'] = r.choice(highway_types)
+
+		# Split the route into ways that share their end nodes.
+		start = 0
+		while start < len(refs) - 1:
+			end = min(len(refs) - 1, start + r.randint(max(1, points_per_way // 2), points_per_way * 3 // 2 + 1))
+			way_refs = refs[start:end + 1]
+			if r.random() < 0.2:
+				way_refs.reverse()
+			way_tags = dict(tags)
+			if r.random() < 0.05:
+				way_tags['surface'] = 'gravel'
+			elif r.random() < 0.3:
+				way_tags['surface'] = 'asphalt'
+			if 'name' in way_tags and r.random() < 0.05:
+				way_tags['name'] = 'Bridge {}'.format(number + 1)
+			self.add_way(way_refs, way_tags)
+			start = end
+
+		# Noise: an unnamed road, a footway and some points of interest nearby.
+		noise = [self.add_node(lat + r.uniform(-0.01, 0.01), lon + r.uniform(-0.01, 0.01)) for i in xrange(6)]
+		self.add_way(noise[0:3], {'highway': 'residential'})
+		self.add_way(noise[2:5], {'highway': 'footway', 'name': 'Trail'})
+
+	# The points of a route of about count points from a location.
+	def route_points(self, lat, lon, count):
+		r = self.random
+		x = 0.0
+		y = 0.0
+		heading = r.uniform(0, 2 * math.pi)
+		points = [(x, y)]
+
+		def step(length, turn):
+			position = points[-1]
+			new_heading = heading + turn
+			points.append((position[0] + length * math.sin(new_heading), position[1] + length * math.cos(new_heading)))
+			return new_heading
+
+		while len(points) < count:
+			feature = r.random()
+			if feature < 0.3:
+				# A straight stretch with sparse points.
+				for i in xrange(r.randint(2, 10)):
+					heading = step(r.uniform(200, 500), 0)
+			elif feature < 0.9:
+				# A run of curves of a random radius, turning one way or the other.
+				radius = r.choice((20, 40, 80, 150, 300))
+				direction = r.choice((-1, 1))
+				for i in xrange(r.randint(5, 30)):
+					length = r.uniform(10, 30)
+					heading = step(length, direction * length / radius)
+					if r.random() < 0.15:
+						direction = -direction
+			else:
+				# A hairpin: a tight turn of about 180 degrees.
+				radius = r.uniform(10, 20)
+				direction = r.choice((-1, 1))
+				length = 8.0
+				for i in xrange(int(math.pi * radius / length)):
+					heading = step(length, direction * length / radius)
+
+		scale = 180 / math.pi / rad_earth_m
+		return [(lat + y * scale, lon + x * scale / math.cos(math.radians(lat))) for x, y in points[:count]]
+
+	def add_node(self, lat, lon):
+		osm_id = self.next_node
+		self.next_node += 1
+		self.num_nodes += 1
+		self.f.write('  <node id="{}" lat="{:.7f}" lon="{:.7f}" version="1"/>\n'.format(osm_id, lat, lon))
+		return osm_id
+
+	def add_way(self, refs, tags):
+		self.ways.append((self.next_way, refs, tags))
+		self.next_way += 1
+
+	def write_way(self, osm_id, refs, tags):
+		self.f.write('  <way id="{}" version="1">\n'.format(osm_id))
+		for ref in refs:
+			self.f.write('    <nd ref="{}"/>\n'.format(ref))
+		for key in sorted(tags):
+			self.f.write(u'    <tag k="{}" v="{}"/>\n'.format(key, tags[key]).encode('utf-8'))
+		self.f.write('  </way>\n')
+
+def open_output(filename):
+	if filename.endswith('.bz2'):
+		return bz2.BZ2File(filename, 'w')
+	if filename.endswith('.gz'):
+		return gzip.open(filename, 'wb')
+	return open(filename, 'wb')
+
+# Generate a network into a file, answering the number of nodes and ways.
+def generate(filename, routes=100, ways_per_route=20, points_per_way=30, seed=1):
+	f = open_output(filename)
+	try:
+		generator = NetworkGenerator(f, seed)
+		generator.generate(routes, ways_per_route, points_per_way)
+	finally:
+		f.close()
+	return generator.num_nodes, len(generator.ways)
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Generate a synthetic OSM XML road network for benchmarking.')
+	parser.add_argument('--routes', type=int, default=100, help='The number of routes to generate. The default is 100.')
+	parser.add_argument('--ways_per_route', type=int, default=20, help='The approximate number of ways each route is split into. The default is 20.')
+	parser.add_argument('--points_per_way', type=int, default=30, help='The approximate number of points in each way. The default is 30.')
+	parser.add_argument('--seed', type=int, default=1, help='The seed of the random generator. The default is 1.')
+	parser.add_argument('file', type=str, help='The file to write: .osm, .osm.bz2 or .osm.gz.')
+	args = parser.parse_args()
+	nodes, ways = generate(args.file, args.routes, args.ways_per_route, args.points_per_way, args.seed)
+	print '{}: {} nodes, {} ways'.format(args.file, nodes, ways)
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+# run.py
+#
+# Time each phase of a curvature run on synthetic road networks and compare the
+# times with a stored baseline.
+#
+# Each input is generated by generate.py into the work directory, unless it is
+# already there, and then run through a WayCollector, timing:
+#
+#   ways                the parse of the ways
+#   coords              the parse of the coordinates of their nodes
+#   join_ways           joining the ways of each route
+#   calculate           calculating the sections of the joined ways, including:
+#   distance_and_curvature, filter_deflections, split_way_sections
+#   output:<writer>     writing the sections with each output
+#
+# Each input is run --repeat times and the fastest time of each phase is kept.
+# The times are written as JSON to --output. With --baseline, they are
+# compared with those of an earlier run, and any phase that is slower than the
+# baseline by more than --tolerance (and by more than --min_seconds) is reported
+# as a regression and the exit status is 1. A run that can't be compared fails
+# too: the exit status is 2 if there is no baseline or an input isn't in it (or
+# was generated differently), unless --no_compare is given to only record the
+# times. --save_baseline writes the times to the baseline file instead, so the
+# usual workflow is:
+#
+#   python benchmarks/run.py --save_baseline        # before a change
+#   python benchmarks/run.py                        # after it
+#
+# Baselines are only comparable on the same machine.
+
+import os
+import sys
+import copy
+import json
+import codecs
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from curvature.collector import WayCollector
+from curvature.input import OsmInput
+from curvature.filter import WayFilter
+from curvature.output import TabOutput, SingleColorKmlOutput, ReducedPointsSingleColorKmlOutput, MultiColorKmlOutput, SurfaceKmlOutput, KmlOutputPlan
+import generate
+
+# (name, routes, ways per route, points per way) of each input size.
+sizes = {
+	'small': (50, 20, 30),
+	'medium': (500, 20, 30),
+	'large': (5000, 20, 30),
+}
+
+benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+
+parser = argparse.ArgumentParser(description='Time each phase of a curvature run on synthetic road networks and compare the times with a baseline.')
+parser.add_argument('--sizes', type=str, default='small,medium', help='A comma-separated list of the input sizes to run: small, medium and large. The default is small,medium.')
+parser.add_argument('--seed', type=int, default=1, help='The seed of the generated inputs. The default is 1.')
+parser.add_argument('--repeat', type=int, default=3, help='The number of times to run each input, keeping the fastest time of each phase. The default is 3.')
+parser.add_argument('--work_dir', type=str, default=os.path.join(tempfile.gettempdir(), 'curvature-benchmarks'), help='The directory to keep generated inputs in. The default is curvature-benchmarks in the temporary directory.')
+parser.add_argument('--output', type=str, default=os.path.join(benchmarks_dir, 'results.json'), help='The file to write the times to. The default is benchmarks/results.json.')
+parser.add_argument('--baseline', type=str, default=os.path.join(benchmarks_dir, 'baseline.json'), help='The baseline to compare with. The default is benchmarks/baseline.json.')
+parser.add_argument('--no_compare', action='store_true', help='Only write the times to --output without comparing them with the baseline.')
+parser.add_argument('--save_baseline', action='store_true', help='Write the times to the baseline file rather than comparing with it.')
+parser.add_argument('--tolerance', type=float, default=0.2, help='The fraction by which a phase may be slower than the baseline before it fails. The default is 0.2.')
+parser.add_argument('--min_seconds', type=float, default=0.05, help='Differences smaller than this many seconds are never regressions. The default is 0.05.')
+parser.add_argument('--parser_concurrency', type=int, default=None, help='The number of parser processes. The default is one per CPU.')
+args = parser.parse_args()
+
+# Accumulates the time spent in methods of an object.
+class PhaseTimer(object):
+	def __init__(self):
+		self.times = {}
+
+	def add(self, phase, seconds):
+		self.times[phase] = self.times.get(phase, 0.0) + seconds
+
+	# Replace a method of an object with one that times each call as a phase.
+	def wrap(self, obj, name, phase=None):
+		method = getattr(obj, name)
+		phase = phase or name
+
+		def timed(*args, **kwargs):
+			start = time.time()
+			try:
+				return method(*args, **kwargs)
+			finally:
+				self.add(phase, time.time() - start)
+		setattr(obj, name, timed)
+
+	# Time each call of a method as the next of several phases.
+	def wrap_sequence(self, obj, name, phases):
+		method = getattr(obj, name)
+		phases = list(phases)
+
+		def timed(*args, **kwargs):
+			start = time.time()
+			try:
+				return method(*args, **kwargs)
+			finally:
+				self.add(phases.pop(0), time.time() - start)
+		setattr(obj, name, timed)
+
+# Time one run of the collector and outputs on an input, answering the time of
+# each phase and the number of ways calculated.
+def run_once(filename, output_dir):
+	timer = PhaseTimer()
+	collector = WayCollector()
+	collector.parser_concurrency = args.parser_concurrency
+	timer.wrap(collector, 'join_ways')
+	timer.wrap(collector, 'calculate')
+	timer.wrap(collector, 'calculate_distance_and_curvature_batch', 'distance_and_curvature')
+	timer.wrap(collector, 'filter_deflections')
+	timer.wrap(collector, 'split_way_sections')
+
+	source = OsmInput(filename)
+	timer.wrap_sequence(source, 'parse', ('ways', 'coords'))
+	try:
+		collector.load_source(source)
+	finally:
+		source.close()
+
+	default_filter = WayFilter()
+	default_filter.min_length = 1
+	default_filter.min_curvature = 300
+	outputs = [
+		('tab', TabOutput(default_filter)),
+		('kml', SingleColorKmlOutput(default_filter, False)),
+		('kml_limit_points', ReducedPointsSingleColorKmlOutput(default_filter, False, 5)),
+		('kml_multicolor', MultiColorKmlOutput(default_filter)),
+		('kml_surface', SurfaceKmlOutput(default_filter)),
+	]
+	simplified = MultiColorKmlOutput(default_filter)
+	simplified.simplify_tolerance = 5
+	outputs.append(('kml_multicolor_simplified', simplified))
+	kmz = MultiColorKmlOutput(default_filter)
+	kmz.kmz_level = 6
+	outputs.append(('kmz_multicolor', kmz))
+
+	for name, output in outputs:
+		start = time.time()
+		if isinstance(output, TabOutput):
+			stdout = sys.stdout
+			sys.stdout = codecs.open(os.devnull, 'w', 'utf-8')
+			try:
+				output.output(collector.ways)
+			finally:
+				sys.stdout.close()
+				sys.stdout = stdout
+		else:
+			plan = KmlOutputPlan(collector.ways)
+			plan.add(output, output_dir, name)
+			plan.write()
+		timer.add('output:' + name, time.time() - start)
+
+	# Several variants written together, as with --add_kml.
+	start = time.time()
+	plan = KmlOutputPlan(collector.ways)
+	for min_curvature in (300, 600, 1000, 2000):
+		variant_filter = copy.copy(default_filter)
+		variant_filter.min_curvature = min_curvature
+		plan.add(SingleColorKmlOutput(variant_filter, False), output_dir, 'variants')
+		plan.add(MultiColorKmlOutput(variant_filter), output_dir, 'variants')
+	plan.write()
+	timer.add('output:variants', time.time() - start)
+
+	return timer.times, len(collector.ways)
+
+def run_input(name, routes, ways_per_route, points_per_way):
+	if not os.path.isdir(args.work_dir):
+		os.makedirs(args.work_dir)
+	filename = os.path.join(args.work_dir, '{}-{}-{}-{}-{}.osm'.format(name, routes, ways_per_route, points_per_way, args.seed))
+	if not os.path.exists(filename):
+		sys.stderr.write('Generating {}\n'.format(filename))
+		generate.generate(filename, routes, ways_per_route, points_per_way, args.seed)
+
+	output_dir = tempfile.mkdtemp(prefix='curvature-benchmarks-')
+	try:
+		best = None
+		for i in xrange(args.repeat):
+			sys.stderr.write('Running {} ({} of {})\n'.format(name, i + 1, args.repeat))
+			times, num_ways = run_once(filename, output_dir)
+			if best is None:
+				best = times
+			else:
+				for phase, seconds in times.iteritems():
+					best[phase] = min(best.get(phase, seconds), seconds)
+	finally:
+		shutil.rmtree(output_dir, ignore_errors=True)
+	return {'routes': routes, 'ways_per_route': ways_per_route, 'points_per_way': points_per_way, 'seed': args.seed, 'sections': num_ways, 'phases': best}
+
+# Compare results with a baseline, printing each phase and answering the list of
+# regressions and the list of the inputs that couldn't be compared.
+def compare(results, baseline):
+	regressions = []
+	uncompared = []
+	for name in sorted(results['inputs']):
+		if name not in baseline['inputs']:
+			print '{}: not in the baseline'.format(name)
+			uncompared.append(name)
+			continue
+		current = results['inputs'][name]
+		base = baseline['inputs'][name]
+		for key in ('routes', 'ways_per_route', 'points_per_way', 'seed'):
+			if current[key] != base[key]:
+				print '{}: generated with a different {} than the baseline, not compared'.format(name, key)
+				uncompared.append(name)
+				break
+		else:
+			print '{}:'.format(name)
+			print '  {:32} {:>10} {:>10} {:>8}'.format('phase', 'baseline', 'current', 'change')
+			for phase in sorted(current['phases']):
+				seconds = current['phases'][phase]
+				if phase not in base['phases']:
+					print '  {:32} {:>10} {:10.3f}'.format(phase, '-', seconds)
+					continue
+				base_seconds = base['phases'][phase]
+				change = (seconds - base_seconds) / base_seconds if base_seconds else 0
+				flag = ''
+				if change > args.tolerance and seconds - base_seconds > args.min_seconds:
+					flag = '  REGRESSION'
+					regressions.append((name, phase, base_seconds, seconds))
+				print '  {:32} {:10.3f} {:10.3f} {:+7.0%}{}'.format(phase, base_seconds, seconds, change, flag)
+	return regressions, uncompared
+
+results = {
+	'python': platform.python_version(),
+	'machine': platform.machine(),
+	'node': platform.node(),
+	'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+	'inputs': {},
+}
+for name in args.sizes.split(','):
+	if name not in sizes:
+		sys.stderr.write('Unknown size {}, use one of {}.\n'.format(name, ', '.join(sorted(sizes))))
+		exit(2)
+	results['inputs'][name] = run_input(name, *sizes[name])
+
+if args.save_baseline:
+	with open(args.baseline, 'w') as f:
+		json.dump(results, f, indent=2, sort_keys=True)
+	sys.stderr.write('Saved the baseline to {}\n'.format(args.baseline))
+	exit(0)
+
+with open(args.output, 'w') as f:
+	json.dump(results, f, indent=2, sort_keys=True)
+sys.stderr.write('Wrote the results to {}\n'.format(args.output))
+
+if args.no_compare:
+	exit(0)
+
+if not os.path.exists(args.baseline):
+	sys.stderr.write('No baseline at {} to compare with. Save one with --save_baseline, or pass --no_compare to only record the times.\n'.format(args.baseline))
+	exit(2)
+
+with open(args.baseline) as f:
+	baseline = json.load(f)
+if (baseline.get('node'), baseline.get('python')) != (results['node'], results['python']):
+	sys.stderr.write('Warning: the baseline was saved on {} with Python {}, so its times may not be comparable.\n'.format(baseline.get('node'), baseline.get('python')))
+regressions, uncompared = compare(results, baseline)
+if regressions:
+	print '\n{} phases are slower than the baseline by more than {:.0%}:'.format(len(regressions), args.tolerance)
+	for name, phase, base_seconds, seconds in regressions:
+		print '  {} {}: {:.3f} -> {:.3f} seconds'.format(name, phase, base_seconds, seconds)
+	exit(1)
+if uncompared:
+	print '\n{} could not be compared with the baseline. Save a new one with --save_baseline.'.format(', '.join(uncompared))
+	exit(2)
@@ -40,12 +40,29 @@ import re
 import ast
 import sys
 import argparse
+import time
+import StringIO
 from curvature.collector import WayCollector
-from curvature.filter import WayFilter
+from curvature.collector import NonSplittingWayCollector
+from curvature.combined import CombinedCollector
+from curvature.metrics import Metrics, peak_memory_mb
+from curvature.input import Prefetcher
+from curvature import incremental
+from curvature import results
+from curvature import batch
+from curvature import distance
+from curvature import sweep
+from curvature.partition import TilePartitioner
+from curvature.filter import WayFilter, loosest
+from curvature.output import SortedWays
+from curvature.output import KmlOutputPlan
+from curvature.regionate import RegionatedKmlOutput
 from curvature.output import TabOutput
+from curvature.sqlite import SqliteOutput
 from curvature.output import SingleColorKmlOutput
 from curvature.output import ReducedPointsSingleColorKmlOutput
 from curvature.output import MultiColorKmlOutput
+from curvature.output import SurfaceKmlOutput
 import codecs
 
 # Set our output to default to UTF-8
@@ -57,18 +74,23 @@ sys.stderr = codecs.getwriter('utf8')(sys.stderr)
 parser = argparse.ArgumentParser(description='Find the roads that are most twisty in an Open Street Map (OSM) XML file.')
 parser.add_argument('-v', action='store_true', help='Verbose mode, showing status output')
 parser.add_argument('-t', action='store_true', help='Display tabular output')
+parser.add_argument('--sqlite', action='store_true', help='Also write the ways that pass the filters to a SQLite database with an R*Tree index on the bounding box of each way and an index on curvature, for fast bounding-box queries. It is named like the KML file with a .sqlite extension.')
 parser.add_argument('--no_kml', action='store_true', help='Do not generate a KML file. By default a KML file is generated with the name of the input file followed by .kml')
 parser.add_argument('--km', action='store_true', help='Output kilometers instead of miles.')
+parser.add_argument('--kmz', action='store_true', help='Write compressed KMZ files rather than KML files. The KML is compressed as it is generated, so it is never held in memory or written uncompressed.')
+parser.add_argument('--kmz_level', type=int, default=6, help='The compression level of KMZ files from 0 (none) to 9 (smallest and slowest). The default is 6.')
+parser.add_argument('--simplify', type=float, default=0, help='Simplify the lines of ways with the Douglas-Peucker algorithm, dropping points that are within this many meters of the simplified line. Unlike --limit_points this keeps the apexes of curves. Colorized output keeps every change of curve level. The number of points removed is reported for each file. The default is 0, which keeps every point.')
+parser.add_argument('--regionate', type=int, default=0, help='Write each KML output as a quadtree of regionated files linked by NetworkLinks with at most this many ways in each tile, so that large areas can be browsed in Google Earth from the root file. Coarse tiles hold the most curvy ways, simplified, and finer tiles are loaded as they are zoomed in to. The default is 0, which writes single files.')
 parser.add_argument('--output_path', type=str, default='.', help='The path under which output files should be written')
 parser.add_argument('--output_basename', type=str, default=None, help='The base of the name for output files. This will be appended with a suffix and extension')
 parser.add_argument('--colorize', action='store_true', help='Colorize KML lines based on the curvature of the road at each segment. Without this option roads will be lines of a single color. For large regions this may make Google Earth run slowly.')
-parser.add_argument('--limit_points', type=int, default=0, help='The maximum number of points to used to render each line, 0 for all points. The default is 0. Must be 0 or greater than or equal to 2.')
+parser.add_argument('--limit_points', type=int, default=0, help='The maximum number of points to used to render each line, 0 for all points. The default is 0. Must be 0 or greater than or equal to 2. See also --simplify, which usually gives smaller files with better curves.')
 parser.add_argument('--relative_color', action='store_true', help='Make the color-scale relative to the maximum curvature in the input file.')
 parser.add_argument('--min_length', type=float, default=1, help='the minimum length of a way that should be included, in miles, 0 for no minimum. The default is 2.0')
 parser.add_argument('--max_length', type=float, default=0, help='the maximum length of a way that should be included, in miles, 0 for no maximum. The default is 0')
 parser.add_argument('--min_curvature', type=float, default=300, help='the minimum curvature of a way that should be included, 0 for no minimum. The default is 300 which catches most twisty roads.')
 parser.add_argument('--max_curvature', type=float, default=0, help='the maximum curvature of a way that should be included, 0 for no maximum. The default is 0')
-parser.add_argument('--add_kml', metavar='PARAMETERS', type=str, action='append', help='Output an additional KML file with alternate output parameters. PARAMETERS should be a comma-separated list of option=value that may include any of the following options: colorize, min_curvature, max_curvature, min_length, and max_length. Example: --add_kml colorize=1,min_curvature=1000')
+parser.add_argument('--add_kml', metavar='PARAMETERS', type=str, action='append', help='Output an additional KML file with alternate output parameters. PARAMETERS should be a comma-separated list of option=value that may include any of the following options: colorize, kmz, regionate, simplify, min_curvature, max_curvature, min_length, and max_length. Example: --add_kml colorize=1,min_curvature=1000')
 parser.add_argument('--level_1_max_radius', type=int, default=175, help='the maximum radius of a curve (in meters) that will be considered part of level 1. Curves with radii larger than this will be considered straight. The default is 175')
 parser.add_argument('--level_1_weight', type=float, default=1, help='the weight to give segments that are classified as level 1. Default 1')
 parser.add_argument('--level_2_max_radius', type=int, default=100, help='the maximum radius of a curve (in meters) that will be considered part of level 2. The default is 100')
@@ -83,8 +105,26 @@ parser.add_argument('--min_lat_bound', type=float, default=None, help='The minim
 parser.add_argument('--max_lat_bound', type=float, default=None, help='The maximum latitude to include.')
 parser.add_argument('--min_lon_bound', type=float, default=None, help='The minimum longitude to include.')
 parser.add_argument('--max_lon_bound', type=float, default=None, help='The maximum longitude to include.')
+parser.add_argument('--flat_nodes', type=str, default=None, help='A directory in which to keep a memory-mapped cache of the node locations in each input file. The first run on a file builds its cache while parsing the ways; later runs on the same unchanged file read node locations from the cache rather than parsing the file a second time.')
+parser.add_argument('--parser_concurrency', type=int, default=None, help='The number of processes to use for parsing the input file. The default is one per CPU.')
+parser.add_argument('--engine', type=str, default='python', choices=['python', 'numpy'], help='The implementation used to calculate distance and curvature. The numpy engine calculates batches of ways with array operations and requires the numpy module. Its results match the default python engine to a relative tolerance of 1e-9. The default is python.')
+parser.add_argument('--distance', type=str, default='cosines', choices=['cosines', 'haversine', 'equirectangular'], help='The formula used to measure distances. cosines is the spherical law of cosines, which can be off by a centimeter on short segments. haversine is the haversine formula, which is accurate at any distance. equirectangular is a flat projection at the latitude of each segment, which is the fastest and as accurate as haversine for segments of up to a kilometer. See curvature/distance.py for their error bounds. The default is cosines.')
 parser.add_argument('--straight_segment_split_threshold', type=float, default=1.5, help='If a way has a series of non-curved segments longer than this (miles), the way will be split on that straight section. Use 0 to never split ways. The default is 1.5')
-parser.add_argument('file', type=argparse.FileType('r'), nargs='+', help='the input file. Should be an OSM XML file.')
+parser.add_argument('--prefetch_dir', type=str, default=None, help='A directory in which to decompress the next compressed input file while the current one is being processed. By default compressed files are decompressed as they are parsed without using any disk space.')
+parser.add_argument('--state', type=str, default=None, help='A directory in which to keep the state of the run so that OSM change files (.osc, .osc.gz or .osc.bz2) can later be applied to it. Input files that are change files are applied to the state, recalculating only the routes they affect, and other input files replace it.')
+parser.add_argument('--save_results', action='store_true', help='Save the calculated ways as a binary results file named with the output basename followed by .curvature. Results files can be passed as input files in place of OSM files to write other outputs without recalculating.')
+parser.add_argument('--sweep', metavar='PARAMETERS', type=str, action='append', help='Also score the calculated ways with each setting of a grid of parameters, without parsing or measuring them again, and write a table comparing the sections of each setting with those of the other options to the output basename followed by .sweep.tsv. PARAMETERS should be a comma-separated list of option=values with values separated by / that may include any of the following options: level_1_max_radius, level_1_weight, level_2_max_radius, level_2_weight, level_3_max_radius, level_3_weight, level_4_max_radius, level_4_weight and straight_segment_split_threshold. Every combination of the values is a setting. Example: --sweep level_1_max_radius=150/175/200,straight_segment_split_threshold=1/1.5/2')
+parser.add_argument('--sweep_results', action='store_true', help='Save the sections of each setting of --sweep as a results file named with the output basename followed by .sweep_N.curvature, from which outputs can be written without recalculating.')
+parser.add_argument('--surface', action='store_true', help='Also write the KML file of road surfaces that surface.py writes, from the same parse of the input. The ways of both are read in a single pass over the input and share their node locations, so the input is only parsed once for both. Its ways are selected with --surface_highway_types and --surface_ignored_surfaces, it uses the --kmz, --simplify and --regionate options and --save_results also saves its ways as a results file named with the output basename followed by .surfaces.curvature. It is written even with --no_kml.')
+parser.add_argument('--surface_highway_types', type=str, default='secondary,residential,tertiary,primary,primary_link,motorway,motorway_link,road,trunk,trunk_link,unclassified', help='a list of the highway types that should be included in the --surface output. The default is secondary,residential,tertiary,primary,primary_link,motorway,motorway_link,road,trunk,trunk_link,unclassified')
+parser.add_argument('--surface_ignored_surfaces', type=str, default='', help='a list of the surfaces that should be ignored in the --surface output. The default is none.')
+parser.add_argument('--tiles', type=str, default=None, help='Process the input in geographic tiles to bound the memory used, using this directory for temporary files. Every way is spooled to disk during a single parse and each route is calculated in the tile of its first node, so routes that cross tile borders are still joined.')
+parser.add_argument('--tile_size', type=float, default=10, help='The size of tiles in degrees of latitude and longitude when using --tiles. The default is 10.')
+parser.add_argument('--tile_memory', type=int, default=2048, help='The approximate memory budget in megabytes for calculating a tile when using --tiles. Tiles with more ways than fit are split, but a route is kept in a single tile. The default is 2048.')
+parser.add_argument('--jobs', type=int, default=1, help='The number of input files to process at once, each in a worker process of its own. 0 uses one per CPU. The time and peak memory of each file is reported as it completes. The default is 1, which processes files one after another.')
+parser.add_argument('--metrics', type=str, default=None, help='Write the wall time, CPU time, peak memory, counts and throughput of each phase of the run (parsing ways, loading coordinates, joining, calculating and output) to this file as JSON.')
+parser.add_argument('--profile', type=str, default=None, help='Run each phase under cProfile and write its statistics to <phase>.prof in this directory, for use with pstats or snakeviz. With --jobs, the statistics of each file are written to a directory of their own named after it.')
+parser.add_argument('file', type=argparse.FileType('r'), nargs='+', help='the input file. Should be an OSM XML file, optionally compressed with bzip2 (.osm.bz2) or gzip (.osm.gz), or a PBF file. Use - to read OSM XML from standard input. A .curvature results file saved with --save_results may also be given.')
 args = parser.parse_args()
 
 rad_earth_mi = 3960 # Radius of the earth in miles
@@ -96,8 +136,78 @@ if args.limit_points < 2:
 		sys.stderr.write("\n--limit_points must be 0 or >= 2.")
 		exit(2);
 
+# Validate our kmz_level argument.
+if args.kmz_level < 0 or args.kmz_level > 9:
+	sys.stderr.write("\n--kmz_level must be between 0 and 9.")
+	exit(2);
+
+# Validate our simplify argument.
+if args.simplify < 0:
+	sys.stderr.write("\n--simplify must be 0 or more.")
+	exit(2);
+
+# Validate our regionate argument.
+if args.regionate < 0:
+	sys.stderr.write("\n--regionate must be 0 or more.")
+	exit(2);
+
+# Validate our state argument.
+for file in args.file:
+	if file is not sys.stdin and incremental.is_change_file(file.name) and args.state is None:
+		sys.stderr.write("\n--state is required to apply the change file {}.".format(file.name))
+		exit(2);
+
+# Validate our tiles argument.
+if args.tiles is not None and args.state is not None:
+	sys.stderr.write("\n--tiles can't be used with --state.")
+	exit(2);
+
+# Validate our jobs argument.
+if args.jobs != 1:
+	if args.jobs < 0:
+		sys.stderr.write("\n--jobs must be 0 or more.")
+		exit(2);
+	if sys.stdin in args.file or args.state is not None:
+		sys.stderr.write("\n--jobs can't be used with standard input or --state.")
+		exit(2);
+
+# Validate our engine argument.
+if args.engine == 'numpy':
+	try:
+		import numpy
+	except ImportError:
+		sys.stderr.write("\n--engine numpy requires the numpy module.")
+		exit(2);
+	# The numpy engine has only been checked against the python engine with
+	# level radii that shrink from level 1 to level 4.
+	radii = [args.level_1_max_radius, args.level_2_max_radius, args.level_3_max_radius, args.level_4_max_radius]
+	if radii != sorted(radii, reverse=True):
+		sys.stderr.write("\nWarning: the --level_N_max_radius values don't shrink from level 1 to level 4, so the python engine will be used.")
+		args.engine = 'python'
+
+# Validate our sweep argument.
+sweep_settings = None
+if args.sweep is not None:
+	try:
+		sweep_settings = sweep.grid(args.sweep)
+	except ValueError as e:
+		sys.stderr.write("\n--sweep: {}.".format(e))
+		exit(2);
+	if args.tiles is not None or args.state is not None:
+		sys.stderr.write("\n--sweep can't be used with --tiles or --state.")
+		exit(2);
+
+# Validate our surface argument.
+if args.surface:
+	if args.tiles is not None or args.state is not None:
+		sys.stderr.write("\n--surface can't be used with --tiles or --state.")
+		exit(2);
+
 # Instantiate our collector
-collector = WayCollector()
+if sweep_settings is not None:
+	collector = sweep.SweepCollector(sweep_settings)
+else:
+	collector = WayCollector()
 default_filter = WayFilter()
 
 # Configure settings based on the command-line arguments
@@ -120,39 +230,138 @@ collector.min_lat_bound = args.min_lat_bound
 collector.max_lat_bound = args.max_lat_bound
 collector.min_lon_bound = args.min_lon_bound
 collector.max_lon_bound = args.max_lon_bound
+collector.flat_nodes = args.flat_nodes
+collector.parser_concurrency = args.parser_concurrency
+collector.engine = args.engine
+collector.distance_kernel = distance.kernels[args.distance]
+collector.metrics = Metrics(args.profile)
+if args.prefetch_dir is not None and args.jobs == 1:
+	collector.prefetcher = Prefetcher(args.prefetch_dir)
 collector.straight_segment_split_threshold = args.straight_segment_split_threshold * 1609
 
-# start parsing
-for file in args.file:
+# Read the ways of surface.py along with our own from each input.
+if args.surface:
+	surface_collector = NonSplittingWayCollector()
+	surface_collector.ignored_surfaces = args.surface_ignored_surfaces.split(',')
+	surface_collector.roads = args.surface_highway_types.split(',')
+	surface_collector.engine = args.engine
+	surface_collector.distance_kernel = distance.kernels[args.distance]
+	surface_collector.verbose = args.v
+	surface_collector.metrics = collector.metrics
+	surface_collector.phase_prefix = 'surface:'
+	loader = CombinedCollector([collector, surface_collector])
+else:
+	surface_collector = None
+	loader = collector
+
+# The keys of --add_kml that set the filter of its file.
+filter_keys = ('min_curvature', 'max_curvature', 'min_length', 'max_length')
+
+# The filter of the file of an --add_kml option string.
+def add_kml_filter(opt_string):
+	filter = copy.copy(default_filter)
+	for opt in opt_string.split(','):
+		opt = opt.split('=')
+		if len(opt) >= 2 and opt[0] in filter_keys:
+			setattr(filter, opt[0], float(opt[1]))
+	return filter
+
+if args.tiles is not None:
+	# Keep only the sections of each tile that some output writes, so that the
+	# merged tiles (and any results saved with --save_results) hold no others.
+	filters = [default_filter]
+	if not args.no_kml and args.add_kml is not None:
+		filters += [add_kml_filter(opt_string) for opt_string in args.add_kml]
+	tile_filter = loosest(filters)
+	partitioner = TilePartitioner(args.tiles, args.tile_size, args.tile_memory, tile_filter)
+else:
+	partitioner = None
+
+# Load, calculate and write the outputs of an input file, answering a summary of
+# the time and memory used.
+def process_file(filename):
+	start_time = time.time()
 	if args.v:
-		sys.stderr.write("\nLoading {}".format(file.name))
+		sys.stderr.write("\nLoading {}".format(filename))
 
-	collector.load_file(file.name)
+	if results.is_results_file(filename):
+		collector.ways = results.load(filename)
+	elif args.state is not None:
+		# The sections of the whole extract are only read for an output.
+		incremental.load_file(collector, filename, args.state, args.t or args.sqlite or args.save_results or not args.no_kml)
+	elif partitioner is not None:
+		partitioner.load_file(collector, filename)
+	else:
+		loader.load_file(filename)
 
+	if args.output_path is None:
+		path = os.path.dirname(filename)
+	else:
+		path = args.output_path
+	if args.output_basename is None:
+		basename = os.path.basename(filename)
+		if filename == '-':
+			basename = 'stdin'
+		parts = os.path.splitext(basename)
+		if re.search('\.osm$', parts[0]):
+			parts = os.path.splitext(parts[0])
+		basename = parts[0]
+	else:
+		basename = os.path.basename(args.output_basename)
+
+	# Save the calculated ways so that outputs can be written again without recalculating
+	if args.save_results and not results.is_results_file(filename):
+		results.save(os.path.join(path, basename + results.extension), collector.ways, {'source': filename, 'collector': 'WayCollector', 'distance': collector.distance_kernel.name})
+
+	# Write the surfaces of the ways read for surface.py and release them
+	if surface_collector is not None:
+		if results.is_results_file(filename):
+			sys.stderr.write("\nWarning: {} holds calculated sections, so their surfaces can't be written.".format(filename))
+		else:
+			write_surfaces(filename, path, basename)
+
+	# Score the calculated ways with each setting of the sweep
+	if sweep_settings is not None:
+		if results.is_results_file(filename):
+			sys.stderr.write("\nWarning: {} holds sections that are already split, so it can't be swept.".format(filename))
+		else:
+			with collector.metrics.phase('sweep') as phase:
+				def settings():
+					for i, (setting, sections) in enumerate(collector.sweep()):
+						if args.sweep_results:
+							results.save(os.path.join(path, '{}.sweep_{}{}'.format(basename, i + 1, results.extension)), sections, {'source': filename, 'collector': 'WayCollector', 'distance': collector.distance_kernel.name, 'setting': setting})
+						phase.count('sections', len(sections))
+						yield setting, sections
+				rows = sweep.summarize(collector.ways, settings(), default_filter)
+				with open(os.path.join(path, basename + '.sweep.tsv'), 'w') as f:
+					sweep.write_table(f, rows)
+				phase.count('settings', len(sweep_settings))
+			collector.calculated = []
+
+	# Sort the ways once for all of the outputs
+	with collector.metrics.phase('sort') as phase:
+		ways = SortedWays(collector.ways)
+		phase.count('ways', len(collector.ways))
 
 	# Output our tabular data
 	if args.t:
-		tab = TabOutput(default_filter)
-		tab.output(collector.ways)
+		with collector.metrics.phase('output:tab') as phase:
+			tab = TabOutput(default_filter)
+			tab.output(ways)
+			phase.count('ways', len(collector.ways))
+
+	# Load the ways into a SQLite database for bounding-box queries
+	if args.sqlite:
+		with collector.metrics.phase('output:sqlite') as phase:
+			database = SqliteOutput(default_filter, {'source': filename})
+			database.write(ways, path, basename)
+			phase.count('ways', len(collector.ways))
 
 	# Generate KML output
 	if not args.no_kml:
 		if args.v:
 			sys.stderr.write("\ngenerating KML output")
 
-		if args.output_path is None:
-			path = os.path.dirname(file.name)
-		else:
-			path = args.output_path
-		if args.output_basename is None:
-			basename = os.path.basename(file.name)
-			parts = os.path.splitext(basename)
-			if re.search('\.osm$', parts[0]):
-				parts = os.path.splitext(parts[0])
-			basename = parts[0]
-		else:
-			basename = os.path.basename(args.output_basename)
-
 		if args.colorize:
 			kml = MultiColorKmlOutput(default_filter)
 		elif args.limit_points:
@@ -161,16 +370,25 @@ for file in args.file:
 			kml = SingleColorKmlOutput(default_filter, args.relative_color)
 		if args.km:
 			kml.units = 'km'
-		kml.write(collector.ways, path, basename)
+		if args.kmz:
+			kml.kmz_level = args.kmz_level
+		kml.simplify_tolerance = args.simplify
+		if args.regionate:
+			kml = RegionatedKmlOutput(kml, args.regionate)
+		plan = KmlOutputPlan(ways)
+		plan.add(kml, path, basename)
 
 		if args.add_kml is not None:
 			for opt_string in args.add_kml:
 				colorize = args.colorize
 				limit_points = args.limit_points
-				filter = copy.copy(default_filter)
+				filter = add_kml_filter(opt_string)
 				opts = opt_string.split(',')
 				output_path = path
 				relative_color = args.relative_color
+				kmz = args.kmz
+				regionate = args.regionate
+				simplify = args.simplify
 				for opt in opts:
 					opt = opt.split('=')
 					key = opt[0]
@@ -183,17 +401,18 @@ for file in args.file:
 							colorize = 1
 						else:
 							colorize = 0
+					elif key == 'kmz':
+						kmz = bool(int(value))
+					elif key == 'simplify':
+						simplify = float(value)
+					elif key == 'regionate':
+						regionate = int(value)
 					elif key == 'limit_points':
 						if int(value) >= 2:
 							limit_points = int(value)
-					elif key == 'min_curvature':
-						filter.min_curvature = float(value)
-					elif key == 'max_curvature':
-						filter.max_curvature = float(value)
-					elif key == 'min_length':
-						filter.min_length = float(value)
-					elif key == 'max_length':
-						filter.max_length = float(value)
+					elif key in filter_keys:
+						# Set by add_kml_filter()
+						pass
 					elif key == 'output_path':
 						output_path = value
 					elif key == 'relative_color':
@@ -212,7 +431,100 @@ for file in args.file:
 					kml = SingleColorKmlOutput(filter, relative_color)
 				if args.km:
 					kml.units = 'km'
-				kml.write(collector.ways, output_path, basename)
+				if kmz:
+					kml.kmz_level = args.kmz_level
+				kml.simplify_tolerance = simplify
+				if regionate > 0:
+					kml = RegionatedKmlOutput(kml, regionate)
+				plan.add(kml, output_path, basename)
+
+		# Write all of the KML files in a single pass over the ways
+		with collector.metrics.phase('output:kml') as phase:
+			plan.write()
+			phase.count('ways', len(collector.ways))
+
+	return {'file': filename, 'ways': len(collector.ways), 'seconds': time.time() - start_time, 'memory': peak_memory_mb(), 'metrics': collector.metrics.to_dict()}
+
+# Write the outputs of surface.py for the ways of the surface collector.
+def write_surfaces(filename, path, basename):
+	if args.save_results:
+		results.save(os.path.join(path, basename + '.surfaces' + results.extension), surface_collector.ways, {'source': filename, 'collector': 'NonSplittingWayCollector', 'distance': surface_collector.distance_kernel.name})
+
+	filter = WayFilter()
+	filter.min_length = 0
+	filter.min_curvature = 0
+	kml = SurfaceKmlOutput(filter)
+	if args.kmz:
+		kml.kmz_level = args.kmz_level
+	kml.simplify_tolerance = args.simplify
+	if args.regionate:
+		kml = RegionatedKmlOutput(kml, args.regionate)
+	plan = KmlOutputPlan(surface_collector.ways)
+	plan.add(kml, path, basename)
+	with collector.metrics.phase('surface:output:kml') as phase:
+		plan.write()
+		phase.count('ways', len(surface_collector.ways))
+	surface_collector.reset()
+
+# Process a file in a batch worker, capturing its tabular output to be written
+# by the main process.
+def process_file_in_worker(filename):
+	stdout = sys.stdout
+	sys.stdout = StringIO.StringIO()
+	if args.profile is not None:
+		collector.metrics.profile_dir = os.path.join(args.profile, os.path.basename(filename))
+	try:
+		summary = process_file(filename)
+		summary['output'] = sys.stdout.getvalue()
+		return summary
+	finally:
+		sys.stdout = stdout
+
+# argparse opens '-' as standard input.
+filenames = []
+for file in args.file:
+	if file is sys.stdin:
+		filenames.append('-')
+	else:
+		filenames.append(file.name)
+
+# start parsing
+if args.jobs == 1:
+	try:
+		for i, filename in enumerate(filenames):
+			# Decompress the next file while we work on this one.
+			if collector.prefetcher is not None and i + 1 < len(filenames) and filenames[i + 1] != '-':
+				collector.prefetcher.start(filenames[i + 1])
+
+			process_file(filename)
+	finally:
+		# Don't leave a file being decompressed if processing one failed.
+		if collector.prefetcher is not None:
+			collector.prefetcher.cancel()
+else:
+	# Process each file in a worker process of its own, at most jobs at a time.
+	jobs = args.jobs or batch.default_jobs()
+	if collector.parser_concurrency is None:
+		# Share the CPUs between the parsers of our workers.
+		collector.parser_concurrency = max(1, batch.default_jobs() // jobs)
+	start_time = time.time()
+	failed = False
+	for index, summary, error in batch.run(process_file_in_worker, filenames, jobs):
+		if error is not None:
+			sys.stderr.write("\nProcessing {} failed:\n{}".format(filenames[index], error))
+			failed = True
+			continue
+		sys.stdout.write(summary['output'])
+		sys.stdout.flush()
+		collector.metrics.merge(summary['metrics'])
+		sys.stderr.write("\n{file}: {seconds:.1f} seconds, {memory:.1f}MB peak memory, {ways} ways".format(**summary))
+	sys.stderr.write("\n{} files processed in {:.1f} seconds\n".format(len(filenames), time.time() - start_time))
+
+if args.metrics is not None:
+	collector.metrics.write(args.metrics)
+
+if args.jobs != 1 and failed:
+	exit(1)
 
 if args.v:
 	sys.stderr.write("\ndone.\n")
@@ -0,0 +1,51 @@
+import Queue
+import traceback
+import multiprocessing
+
+# Processing of several input files at once.
+#
+# Each file is processed in a worker process of its own, so that the memory it
+# used is returned when the process exits, with at most a given number of
+# workers running at a time. multiprocessing.Pool can't be used since its
+# workers are daemonic and may not start the processes of the OSM parser.
+#
+# Usage:
+#   for index, result, error in run(process_file, filenames, jobs):
+#       ...
+
+# The number of jobs to run when none is specified: one per CPU.
+def default_jobs():
+	return multiprocessing.cpu_count()
+
+def _work(function, index, item, queue):
+	try:
+		queue.put((index, function(item), None))
+	except:
+		queue.put((index, None, traceback.format_exc()))
+
+# Run function on each item in a worker process, generating (index, result,
+# error) tuples as the workers finish. error is the traceback of an exception
+# raised by the function, or a message if the worker died, and result is None.
+def run(function, items, jobs):
+	queue = multiprocessing.Queue()
+	pending = list(enumerate(items))
+	pending.reverse()
+	running = {}
+	while pending or running:
+		while pending and len(running) < jobs:
+			index, item = pending.pop()
+			worker = multiprocessing.Process(target=_work, args=(function, index, item, queue))
+			worker.start()
+			running[index] = worker
+
+		try:
+			index, result, error = queue.get(timeout=1)
+		except Queue.Empty:
+			# Workers that were killed, e.g. for running out of memory, never report.
+			for index, worker in running.items():
+				if not worker.is_alive() and worker.exitcode != 0:
+					del running[index]
+					yield index, None, 'The worker exited with status {}'.format(worker.exitcode)
+			continue
+		running.pop(index).join()
+		yield index, result, error
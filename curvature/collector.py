@@ -1,18 +1,20 @@
+import os
 import sys
 import math
-import resource
-import copy
 import time
+import collections
+import array
 from imposm.parser import OSMParser
+from curvature.coordinates import CoordinateStore, FlatNodesCache
+from curvature.geometry import WayGeometry
+from curvature.way import Way, StringTable
+from curvature.input import OsmInput
+from curvature.metrics import Metrics, Progress, peak_memory_mb
+from curvature.distance import kernels
 rad_earth_m = 6373000 # Radius of the earth in meters
 
 # simple class that handles the parsed OSM data.
 class WayCollector(object):
-	ways = []
-	routes = {}
-	coords = {}
-	num_coords = 0
-	num_ways = 0
 	keep_eliminated = False
 
 	verbose = False
@@ -21,6 +23,31 @@ class WayCollector(object):
 	min_lon_bound = None
 	max_lon_bound = None
 
+	# A directory in which to keep flat-nodes caches of the node locations in
+	# our input files. If None, coordinates are parsed from the input files.
+	flat_nodes = None
+
+	# A Prefetcher that may have already decompressed the file we are loading.
+	prefetcher = None
+
+	# The number of parser processes to run, None for one per CPU.
+	parser_concurrency = None
+
+	# The implementation of calculate_distance_and_curvature() to use, 'python' or
+	# 'numpy'. The numpy engine calculates calculate_batch_size ways at a time.
+	engine = 'python'
+	calculate_batch_size = 10000
+
+	# The kernel used to measure distances, one of those in distance.kernels.
+	distance_kernel = kernels['cosines']
+
+	# A prefix for the names of our join and calculate phases in our metrics, to
+	# tell them apart from those of another collector sharing them.
+	phase_prefix = ''
+
+	# The way tags that we make use of. All others are dropped by ways_tag_filter.
+	used_tags = 'highway', 'name', 'ref', 'surface', 'tiger:county'
+
 	roads = 'secondary', 'residential', 'tertiary', 'primary', 'primary_link', 'motorway', 'motorway_link', 'road', 'trunk', 'trunk_link', 'unclassified'
 	ignored_surfaces = 'dirt', 'unpaved', 'gravel', 'sand', 'grass', 'ground'
 	level_1_max_radius = 175
@@ -37,57 +64,145 @@ class WayCollector(object):
 	# 2414 meters ~= 1.5 miles, 1609 ~= 1 mile
 	straight_segment_split_threshold = 2414
 
+	def __init__(self):
+		# The wall and CPU time, memory and counts of each phase of our runs.
+		self.metrics = Metrics()
+		self.reset()
+
+	# Discard the ways, routes and coordinates of any previous file.
+	def reset(self):
+		self.ways = []
+		self.routes = {}
+		self.coords = None
+		self.num_ways = 0
+		# The names of ways with both a name and a ref by (name, ref).
+		self.route_names = {}
+		# The table of the strings of our ways. Earlier ways keep their own table.
+		self.strings = StringTable()
+
 	def load_file(self, filename):
-		# Reinitialize if we have a new file
-		ways = []
-		coords = {}
-		num_coords = 0
-		num_ways = 0
+		prefetched = None
+		if self.prefetcher is not None:
+			prefetched = self.prefetcher.take(filename)
+		source = OsmInput(filename, prefetched)
+		try:
+			self.load_source(source)
+		finally:
+			source.close()
+
+	def load_source(self, source):
+		self.read_source(source, self.cache_for(source))
+		self.join_and_calculate()
+
+	# Join the routes read from a source and calculate the sections of their ways.
+	def join_and_calculate(self):
+		# Join routes end-to-end and add them to the way list.
+		with self.metrics.phase(self.phase_prefix + 'join_ways') as phase:
+			phase.count('routes', len(self.routes))
+			self.join_ways()
+			phase.count('ways', len(self.ways))
 
 		# status output
 		if self.verbose:
-			sys.stderr.write("\nLoading ways, each '-' is 100 ways, each row is 10,000 ways\n")
+			sys.stderr.write("\nJoining complete. {mem:.1f}MB memory used.".format(mem=peak_memory_mb()))
+			sys.stderr.flush()
 
-		p = OSMParser(ways_callback=self.ways_callback)
-		p.parse(filename)
+		# Loop through the ways and calculate their curvature
+		start_time = time.time()
+		with self.metrics.phase(self.phase_prefix + 'calculate') as phase:
+			phase.count('ways', len(self.ways))
+			self.calculate()
+			phase.count('sections', len(self.ways))
 
 		# status output
 		if self.verbose:
-			sys.stderr.write("\n{} ways matched in {} {mem:.1f}MB memory used,\n{} coordinates will be loaded, each '.' is 1% complete\n".format(len(self.ways), filename, len(self.coords), mem=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1048576))
-
-			total = len(self.coords)
-			if total < 100:
-				self.coords_marker = 1
-			else:
-				self.coords_marker = round(total/100)
+			sys.stderr.write("\nCalculation complete, {mem:.1f}MB memory used".format(mem=peak_memory_mb()))
+			sys.stderr.write('\nCalculation completed in {time:.1f} seconds'.format(time=(time.time() - start_time)))
+			sys.stderr.flush()
 
-		p = OSMParser(coords_callback=self.coords_callback)
-		p.parse(filename)
+	# The flat-nodes cache to use for a source, or None to parse coordinates from it.
+	def cache_for(self, source):
+		if self.flat_nodes is not None:
+			return FlatNodesCache.for_source(self.flat_nodes, source.filename)
+		if not source.is_rereadable():
+			# Standard input can only be read once, so keep the location of every node
+			# in a temporary flat-nodes cache while we parse the ways.
+			return FlatNodesCache(os.path.join(source.temp_directory(), 'stdin.nodes'))
+		return None
+
+	# Parse the candidate ways of a source into our routes and load the coordinates
+	# of the nodes they reference, using and building the cache if one is given.
+	def read_source(self, source, cache):
+		filename = source.filename
+		# Reinitialize if we have a new file
+		self.reset()
+		self.coords = CoordinateStore()
 
 		# status output
 		if self.verbose:
-			sys.stderr.write("\nCoordinates loaded {mem:.1f}MB memory used.".format(mem=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1048576))
-			sys.stderr.flush()
+			sys.stderr.write("\nLoading ways")
 
-		# Join routes end-to-end and add them to the way list.
-		self.join_ways()
+		with self.metrics.phase('ways') as phase:
+			progress = Progress('Ways matched', count=lambda: self.num_ways)
+			if self.verbose:
+				progress.start()
+			if cache is not None and not cache.is_current(filename):
+				# Build the flat-nodes cache with every node in the file while we parse
+				# the ways so that the file only needs to be read once.
+				if self.verbose:
+					sys.stderr.write("\nBuilding the flat-nodes cache {}".format(cache.path))
+				cache.open_for_writing()
+				p = OSMParser(concurrency=self.parser_concurrency, ways_callback=self.ways_callback, ways_tag_filter=self.ways_tag_filter, coords_callback=cache.add_coords)
+				source.parse(p)
+				cache.finish(filename)
+			else:
+				p = OSMParser(concurrency=self.parser_concurrency, ways_callback=self.ways_callback, ways_tag_filter=self.ways_tag_filter)
+				source.parse(p)
+			if self.verbose:
+				progress.stop()
+
+			# Sort the referenced node ids into our coordinate index.
+			self.coords.index()
+			phase.count('ways', self.num_ways)
+			phase.count('routes', len(self.routes))
 
 		# status output
 		if self.verbose:
-			sys.stderr.write("\nJoining complete. {mem:.1f}MB memory used.".format(mem=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1048576))
-			sys.stderr.write("\nCalculating curvature, each '.' is 1% complete\n")
-			sys.stderr.flush()
+			sys.stderr.write("\n{} ways matched in {} {mem:.1f}MB memory used,\n{} coordinates will be loaded".format(self.num_ways, filename, len(self.coords), mem=peak_memory_mb()))
 
-		# Loop through the ways and calculate their curvature
-		start_time = time.time()
-		self.calculate()
+		with self.metrics.phase('coords') as phase:
+			progress = Progress('Coordinates loaded', len(self.coords), lambda: self.coords.num_loaded)
+			if self.verbose:
+				progress.start()
+			if cache is not None:
+				self.load_cached_coords(cache)
+			else:
+				p = OSMParser(concurrency=self.parser_concurrency, coords_callback=self.coords_callback)
+				source.parse(p)
+			if self.verbose:
+				progress.stop()
+			phase.count('coordinates', self.coords.num_loaded)
 
 		# status output
 		if self.verbose:
-			sys.stderr.write("\nCalculation complete, {mem:.1f}MB memory used".format(mem=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1048576))
-			sys.stderr.write('\nCalculation completed in {time:.1f} seconds'.format(time=(time.time() - start_time)))
+			sys.stderr.write("\n{} coordinates loaded into {store:.1f}MB, {mem:.1f}MB memory used.".format(self.coords.num_loaded, store=self.coords.memory_usage() / 1048576.0, mem=peak_memory_mb()))
 			sys.stderr.flush()
 
+	# Load the coordinates of our referenced nodes from a flat-nodes cache rather
+	# than parsing them from the input file.
+	def load_cached_coords(self, cache):
+		cache.open_for_reading()
+		coords = []
+		for osm_id in self.coords.ids:
+			coord = cache.get(osm_id)
+			if coord is not None:
+				coords.append((osm_id, coord[1], coord[0]))
+				if len(coords) >= 512:
+					self.coords_callback(coords)
+					coords = []
+		self.coords_callback(coords)
+		cache.close()
+
 	def coords_callback(self, coords):
 		# callback method for coords
 		for osm_id, lon, lat in coords:
@@ -100,19 +215,25 @@ class WayCollector(object):
 			if self.max_lon_bound and lon > self.max_lon_bound:
 				continue
 
-			if osm_id in self.coords:
-				self.coords[osm_id] = (lat, lon)
+			self.coords.set(osm_id, lat, lon)
 
-				# status output
-				if self.verbose:
-					self.num_coords = self.num_coords + 1
-					if not (self.num_coords % self.coords_marker):
-						sys.stderr.write('.')
-						sys.stderr.flush()
+	# Tag filter run in the parser processes. Ways are always passed back by the
+	# parser, but clearing the tags of ways we can't match and dropping the tags
+	# we don't use keeps the data sent back to us to a minimum.
+	def ways_tag_filter(self, tags):
+		if tags.get('highway') not in self.roads or tags.get('surface') in self.ignored_surfaces or (not tags.get('name') and not tags.get('ref')):
+			tags.clear()
+			return
+		for key in tags.keys():
+			if key not in self.used_tags:
+				del tags[key]
 
 	def ways_callback(self, ways):
 		# callback method for ways
 		for osmid, tags, refs in ways:
+			# skip ways cleared by our tag filter
+			if not tags:
+				continue
 
 			# ignore circular ways (Maybe we don't need this)
 			if refs[0] == refs[-1]:
@@ -123,21 +244,13 @@ class WayCollector(object):
 			if 'surface' in tags and tags['surface'] in self.ignored_surfaces:
 				continue
 			if 'highway' in tags and tags['highway'] in self.roads:
-				way = {'id': osmid, 'type': tags['highway'], 'refs': refs}
 				if 'name' not in tags or tags['name'] == '':
-					way['name'] = tags['ref']
+					name = tags['ref']
 				elif 'ref' in tags:
-					way['name'] = unicode('{} ({})').format(tags['name'], tags['ref'])
+					name = self.route_name(tags['name'], tags['ref'])
 				else:
-					way['name'] = tags['name']
-				if 'tiger:county' in tags:
-					way['county'] = tags['tiger:county']
-				else:
-					way['county'] = ''
-				if 'surface' in tags:
-					way['surface'] = tags['surface']
-				else:
-					way['surface'] = 'unknown'
+					name = tags['name']
+				way = Way(osmid, name, tags['highway'], tags.get('surface', 'unknown'), tags.get('tiger:county', ''), self.strings, refs)
 
 				# Add our ways to a route collection if we can match them either
 				# by route-number or alternatively, by name. These route-collections
@@ -150,267 +263,403 @@ class WayCollector(object):
 					for route in routes:
 						if route not in self.routes:
 							self.routes[route] = []
-						self.routes[route].append(copy.copy(way))
+						self.routes[route].append(way.copy())
 				else:
-					if way['name']:
-						if way['name'] not in self.routes:
-							self.routes[way['name']] = []
-						self.routes[way['name']].append(way)
+					if name:
+						if name not in self.routes:
+							self.routes[name] = []
+						self.routes[name].append(way)
 					else:
 						self.ways.append(way)
 
-				for ref in refs:
-					self.coords[ref] = None
+				self.coords.add_refs(refs)
+				self.num_ways += 1
 
-				# status output
-				if self.verbose:
-					self.num_ways = self.num_ways + 1
-					if not (self.num_ways % 100):
-						sys.stderr.write('-')
-						if not self.num_ways % 10000:
-							sys.stderr.write('\n')
-						sys.stderr.flush()
+	# The name of a way with both a name and a ref, formatted once for each pair.
+	def route_name(self, name, ref):
+		key = (name, ref)
+		formatted = self.route_names.get(key)
+		if formatted is None:
+			formatted = unicode('{} ({})').format(name, ref)
+			self.route_names[key] = formatted
+		return formatted
 
 	# Join numbered routes end-to-end and add them to the way list.
 	def join_ways(self):
 		# status output
+		progress = Progress('Routes joined', len(self.routes))
 		if self.verbose:
 			start_time = time.time()
-			i = 0
-			total = len(self.routes)
-			if total < 100:
-				marker = 1
-			else:
-				marker = round(total/100)
-			sys.stderr.write("\n{} routes will be joined, each '.' is 1% complete\n".format(total))
-			sys.stderr.flush()
+			sys.stderr.write("\n{} routes will be joined".format(len(self.routes)))
+			progress.start()
 
+		# (seconds, number of ways, route) for each route joined.
+		self.route_timings = []
 		for route, ways in self.routes.iteritems():
-			# status output
-			if self.verbose:
-				i = i + 1
-				if not (i % marker):
-					sys.stderr.write('.')
-					sys.stderr.flush()
-
-			while len(ways) > 0:
-				base_way = ways.pop()
-				# Loop through all our ways at least as many times as we have ways
-				# to be able to catch any that join onto the end after others have
-				# been joined on.
-				j = 0
-				max_loop = len(ways)
-				# Start our first iteration with the "way_modified" flag set to True.
-				# After this first loop, if no ways get added to the base_way,
-				# there is no reason to keep looping until max_loop
-				way_modified = True
-				while way_modified and j < max_loop:
-					j = j + 1
-					# Set our modification flag to False so we can detect changes
-					# to the base_way.
-					way_modified = False
-					unused_ways = []
-					# try to join to the begining or end
-					while len(ways) > 0:
-						way = ways.pop()
-						# join to the end of the base in order
-						if base_way['refs'][-1] == way['refs'][0] and way['refs'][-1] not in base_way['refs']:
-							way_modified = True
-							# Drop the matching first-ref in the way so that we don't have a duplicate point.
-							del way['refs'][0]
-							base_way['refs'] = base_way['refs'] + way['refs']
-							if base_way['name'] != way['name']:
-								base_way['name'] = route
-						# join to the end of the base in reverse order
-						elif base_way['refs'][-1] == way['refs'][-1] and way['refs'][0] not in base_way['refs']:
-							way_modified = True
-							way['refs'].reverse()
-							# Drop the matching first-ref in the way so that we don't have a duplicate point.
-							del way['refs'][0]
-							base_way['refs'] = base_way['refs'] + way['refs']
-							if base_way['name'] != way['name']:
-								base_way['name'] = route
-						# join to the beginning of the base in order
-						elif base_way['refs'][0] == way['refs'][-1] and way['refs'][0] not in base_way['refs']:
-							way_modified = True
-							# Drop the matching last-ref in the way so that we don't have a duplicate point.
-							del way['refs'][-1]
-							base_way['refs'] = way['refs'] + base_way['refs']
-							if base_way['name'] != way['name']:
-								base_way['name'] = route
-						# join to the beginning of the base in reverse order
-						elif base_way['refs'][0] == way['refs'][0] and way['refs'][-1] not in base_way['refs']:
-							way_modified = True
-							way['refs'].reverse()
-							# Drop the matching last-ref in the way so that we don't have a duplicate point.
-							del way['refs'][-1]
-							base_way['refs'] = way['refs'] + base_way['refs']
-							if base_way['name'] != way['name']:
-								base_way['name'] = route
-						else:
-							unused_ways.append(way)
-					# Continue on joining the rest of the ways in this route.
-					ways = unused_ways
-				# Add this base way to our ways list
-				self.ways.append(base_way)
+			progress.count += 1
+			route_start = time.time()
+			num_ways = len(ways)
+			self.join_route(route, ways)
+			del ways[:]
+			self.route_timings.append((time.time() - route_start, num_ways, route))
+
 		if self.verbose:
+			progress.stop()
 			sys.stderr.write('\nJoining completed in {time:.1f} seconds'.format(time=(time.time() - start_time)))
+			sys.stderr.write('\nSlowest routes to join:')
+			for seconds, num_ways, route in sorted(self.route_timings, reverse=True)[:10]:
+				sys.stderr.write(u'\n  {:.3f} seconds, {} ways: {}'.format(seconds, num_ways, route))
+			sys.stderr.flush()
+
+	# Join the ways of a route end-to-end into as few base ways as possible and add
+	# them to the way list.
+	#
+	# Ways are looked up by the refs at their ends, so each join only considers the
+	# ways that can actually attach to the current ends of the base way. The order
+	# in which ways are tried is that of repeatedly scanning the list of remaining
+	# ways from its end, which reverses the list on each pass, so the joined ways
+	# are the same as those of a scan over every way on every pass.
+	def join_route(self, route, ways):
+		# The positions of the remaining ways by the refs at their ends.
+		endpoints = {}
+		ends = []
+		for position, way in enumerate(ways):
+			ends.append((way.refs[0], way.refs[-1]))
+			for ref in ends[-1]:
+				if ref not in endpoints:
+					endpoints[ref] = set()
+				endpoints[ref].add(position)
+		remaining = [True] * len(ways)
+		num_remaining = len(ways)
+		lowest = 0
+		highest = len(ways) - 1
+		# Whether the list of remaining ways is currently in its original order.
+		in_order = True
+		no_positions = frozenset()
+
+		while num_remaining > 0:
+			# Pop the base way from the end of the list.
+			if in_order:
+				while not remaining[highest]:
+					highest -= 1
+				position = highest
+			else:
+				while not remaining[lowest]:
+					lowest += 1
+				position = lowest
+			base_way = ways[position]
+			self._remove_joining_way(position, remaining, endpoints, ends)
+			num_remaining -= 1
+			base_refs = collections.deque(base_way.refs)
+			base_set = set(base_refs)
+			joined = False
+
+			# Loop through all our ways at least as many times as we have ways
+			# to be able to catch any that join onto the end after others have
+			# been joined on.
+			j = 0
+			max_loop = num_remaining
+			# Start our first iteration with the "way_modified" flag set to True.
+			# After this first loop, if no ways get added to the base_way,
+			# there is no reason to keep looping until max_loop
+			way_modified = True
+			while way_modified and j < max_loop:
+				j = j + 1
+				way_modified = False
+				# Each pass scans from the end of the list, so in descending position
+				# order while the list is in its original order.
+				descending = in_order
+				cursor = None
+				while True:
+					candidates = endpoints.get(base_refs[0], no_positions) | endpoints.get(base_refs[-1], no_positions)
+					if cursor is not None:
+						if descending:
+							candidates = [c for c in candidates if c < cursor]
+						else:
+							candidates = [c for c in candidates if c > cursor]
+					cursor = None
+					for candidate in sorted(candidates, reverse=descending):
+						if self._join_to_base(route, base_way, base_refs, base_set, ways[candidate]):
+							cursor = candidate
+							break
+					if cursor is None:
+						break
+					self._remove_joining_way(cursor, remaining, endpoints, ends)
+					num_remaining -= 1
+					way_modified = True
+					joined = True
+				# The unused ways are left in the order they were scanned.
+				in_order = not in_order
+
+			if joined:
+				base_way.refs = list(base_refs)
+			# Add this base way to our ways list
+			self.ways.append(base_way)
+
+	def _remove_joining_way(self, position, remaining, endpoints, ends):
+		remaining[position] = False
+		for ref in ends[position]:
+			endpoints[ref].discard(position)
+
+	# Try to join a way to the beginning or end of the base way, answering True if
+	# it was joined.
+	def _join_to_base(self, route, base_way, base_refs, base_set, way):
+		refs = way.refs
+		# join to the end of the base in order
+		if base_refs[-1] == refs[0] and refs[-1] not in base_set:
+			# Drop the matching first-ref in the way so that we don't have a duplicate point.
+			del refs[0]
+			base_refs.extend(refs)
+		# join to the end of the base in reverse order
+		elif base_refs[-1] == refs[-1] and refs[0] not in base_set:
+			refs.reverse()
+			# Drop the matching first-ref in the way so that we don't have a duplicate point.
+			del refs[0]
+			base_refs.extend(refs)
+		# join to the beginning of the base in order
+		elif base_refs[0] == refs[-1] and refs[0] not in base_set:
+			# Drop the matching last-ref in the way so that we don't have a duplicate point.
+			del refs[-1]
+			base_refs.extendleft(reversed(refs))
+		# join to the beginning of the base in reverse order
+		elif base_refs[0] == refs[0] and refs[-1] not in base_set:
+			refs.reverse()
+			# Drop the matching last-ref in the way so that we don't have a duplicate point.
+			del refs[-1]
+			base_refs.extendleft(reversed(refs))
+		else:
+			return False
+		base_set.update(refs)
+		if base_way.name_code != way.name_code:
+			base_way.name = route
+		return True
 
 	def calculate(self):
 		# status output
+		progress = Progress('Ways calculated', len(self.ways))
 		if self.verbose:
-			i = 0
-			total = len(self.ways)
-			if total < 100:
-				marker = 1
-			else:
-				marker = round(total/100)
+			progress.start()
 
 		sections = []
 		while len(self.ways):
-			way = self.ways.pop()
-			# status output
-			if self.verbose:
-				i = i + 1
-				if not (i % marker):
-					sys.stderr.write('.')
-					sys.stderr.flush()
+			# Take a batch of ways from the end of the list in the order they would be popped.
+			batch = self.ways[-self.calculate_batch_size:]
+			del self.ways[-self.calculate_batch_size:]
+			batch.reverse()
+			for way in self.calculate_distance_and_curvature_batch(batch):
+				try:
+					self.filter_deflections(way)
+					way_sections = self.split_way_sections(way)
+					sections += way_sections
+				except Exception as e:
+					sys.stderr.write('\nerror calculating distance & curvature: {}'.format(e))
+					continue
+			progress.count += len(batch)
+		if self.verbose:
+			progress.stop()
+		self.ways = sections
+
+	# Calculate the distance and curvature of a batch of ways with our engine,
+	# returning the ways that could be calculated.
+	def calculate_distance_and_curvature_batch(self, ways):
+		if self.engine == 'numpy':
+			from curvature import vectorized
+			return vectorized.calculate_distance_and_curvature(self, ways)
+
+		calculated = []
+		for way in ways:
 			try:
 				self.calculate_distance_and_curvature(way)
-				self.filter_deflections(way)
-				way_sections = self.split_way_sections(way)
-				sections += way_sections
+				calculated.append(way)
 			except Exception as e:
 				sys.stderr.write('\nerror calculating distance & curvature: {}'.format(e))
-				continue
-		self.ways = sections
+		return calculated
 
 	def calculate_distance_and_curvature(self, way):
-		way['distance'] = 0.0
-		way['curvature'] = 0.0
-		way['length'] = 0.0
-		start = self.coords[way['refs'][0]]
-		end = self.coords[way['refs'][-1]]
-		way['distance'] = distance_on_unit_sphere(start[0], start[1], end[0], end[1]) * rad_earth_m
-		second = 0
-		third = 0
-		segments = []
-		for ref in way['refs']:
-			first = self.coords[ref]
-
-			if not second:
-				second = first
-				continue
-
-			first_second_length = distance_on_unit_sphere(first[0], first[1], second[0], second[1]) * rad_earth_m
-			way['length'] += first_second_length
-
-			if not third:
-				third = second
-				second = first
+		way.distance = 0.0
+		way.curvature = 0.0
+		way.length = 0.0
+		kernel = self.distance_kernel
+		coords = self.coords
+		refs = way.refs
+		start = coords[refs[0]]
+		end = coords[refs[-1]]
+		way.distance = kernel.arc(start[0], start[1], end[0], end[1]) * rad_earth_m
+		lats = array.array('d')
+		lons = array.array('d')
+		for ref in refs:
+			coord = coords[ref]
+			lats.append(coord[0])
+			lons.append(coord[1])
+
+		# The arcs from each point to the next and to the one after that, with the
+		# trigonometry of each point done once.
+		arcs, skip_arcs = kernel.arcs(lats, lons)
+		lengths = array.array('d')
+		radii = array.array('d')
+		length = 0.0
+		for i in xrange(len(arcs)):
+			first_second_length = arcs[i] * rad_earth_m
+			length += first_second_length
+
+			if not i:
 				second_third_length = first_second_length
 				continue
 
-			first_third_length = distance_on_unit_sphere(first[0], first[1], third[0], third[1]) * rad_earth_m
+			first_third_length = skip_arcs[i - 1] * rad_earth_m
 			# ignore curvature from zero-distance
 			if first_third_length > 0 and first_second_length > 0 and second_third_length > 0:
 				# Circumcircle radius calculation from http://www.mathopenref.com/trianglecircumcircle.html
 				a = first_second_length
 				b = second_third_length
 				c = first_third_length
-				r = (a * b * c)/math.sqrt(math.fabs((a+b+c)*(b+c-a)*(c+a-b)*(a+b-c)))
+				divisor = math.sqrt(math.fabs((a+b+c)*(b+c-a)*(c+a-b)*(a+b-c)))
+				# Three points in an exact line are straight.
+				if divisor:
+					r = (a * b * c)/divisor
+				else:
+					r = 100000
 			else:
 				r = 100000
 
-			if not len(segments):
+			if not len(lengths):
 				# Add the first segment using the first point
-				segments.append({'start': third, 'end': second, 'length': second_third_length, 'radius': r})
+				lengths.append(second_third_length)
+				radii.append(r)
 			else:
 				# set the radius of the previous segment to the smaller radius of the two circumcircles it's a part of
-				if segments[-1]['radius'] > r:
-					segments[-1]['radius'] = r
+				if radii[-1] > r:
+					radii[-1] = r
 			# Add our latest segment
-			segments.append({'start': second, 'end': first, 'length': first_second_length, 'radius': r})
+			lengths.append(first_second_length)
+			radii.append(r)
 
-			third = second
-			second = first
 			second_third_length = first_second_length
 
+		way.length = length
+
 		# Special case for two-coordinate ways
-		if len(way['refs']) == 2:
-			segments.append({'start': self.coords[way['refs'][0]], 'end': self.coords[way['refs'][1]], 'length': first_second_length, 'radius': 100000})
+		if len(refs) == 2:
+			lengths.append(first_second_length)
+			radii.append(100000)
 
-		way['segments'] = segments
-		del way['refs'] # refs are no longer needed now that we have loaded our segments
+		geometry = WayGeometry(lats, lons, lengths, radii)
+		way.geometry = geometry
+		way.refs = None # refs are no longer needed now that we have loaded our segments
 
 		# Calculate the curvature as a weighted distance traveled at each curvature.
-		way['curvature'] = 0
-		for segment in segments:
-			if segment['radius'] < self.level_4_max_radius:
-				segment['curvature_level'] = 4
-			elif segment['radius'] < self.level_3_max_radius:
-				segment['curvature_level'] = 3
-			elif segment['radius'] < self.level_2_max_radius:
-				segment['curvature_level'] = 2
-			elif segment['radius'] < self.level_1_max_radius:
-				segment['curvature_level'] = 1
-			else:
-				segment['curvature_level'] = 0
-			way['curvature'] += self.get_curvature_for_segment(segment)
-
-	def filter_deflections(self, way):
-		segments = way['segments']
-		for i, segment in enumerate(segments):
-			# While we are in straight segments, be wary of single-point (two-segment)
-			# deflections from our straight line if the next two segments are followed
-			# by a straight section. E.g. __/\__
-			# We want to differentiate a jog off of an otherwise straight line from a
-			# curve between two straight sections like these:
-			#     __ __    __
-			#   /        /   \
-			self.filter_deflection_of_straight_segments(segments, i, 3)
-
-			# While we are in straight segments, be wary of two/three-point (three/four-segment)
-			# deflections from our straight line if the next two segments are followed
-			# by a straight section. E.g. __/\ _   __
-			#                                   \/
-			# We want to differentiate a jog off of an otherwise straight line from a
-			# curve between two straight sections like these:
-			#     __ __    __
-			#   /        /   \
-			self.filter_deflection_of_straight_segments(segments, i, 4)
-			self.filter_deflection_of_straight_segments(segments, i, 5)
-
-	def filter_deflection_of_straight_segments(self, segments, start_index, look_ahead):
-		if look_ahead < 3:
-			raise ValueError("look_ahead must be 3 or more")
-		try:
-			first_straight = segments[start_index]
-			next_straight = segments[start_index + look_ahead]
-			# if (first_straight['curvature_level'] and not 'eliminated' in first_straight) or (next_straight['curvature_level'] and not 'eliminated' in next_straight):
-			if (first_straight['curvature_level'] and not 'eliminated' in first_straight) or (next_straight['curvature_level'] and not 'eliminated' in next_straight):
-				return
-			heading_a = self.get_segment_heading(first_straight)
-			heading_b = self.get_segment_heading(next_straight)
-			heading_diff = abs(heading_a - heading_b)
-			# Compare the difference in heading to the angle that wold be expected
-			# for a curve just barely meeting our threshold for straight/curved.
-			gap_distance = distance_on_unit_sphere(first_straight['end'][0], first_straight['end'][1], next_straight['start'][0], next_straight['start'][1]) * rad_earth_m
-			min_variance = gap_distance / self.level_1_max_radius
-			if abs(heading_diff) < min_variance:
-				# Mark them as eliminated so that we can show them in the output
-				for i in range(start_index + 1, start_index + look_ahead - 1):
-					if segments[i]['curvature_level']:
-						segments[i]['eliminated'] = True
-				if not self.keep_eliminated:
-					# unset the curvature level of the intermediate segments
-					for i in range(start_index + 1, start_index + look_ahead - 1):
-						segments[i]['curvature_level'] = 0
-		except IndexError:
+		curvature = 0
+		for i in xrange(len(geometry)):
+			radius = geometry.radius(i)
+			if radius < self.level_4_max_radius:
+				geometry.set_level(i, 4)
+			elif radius < self.level_3_max_radius:
+				geometry.set_level(i, 3)
+			elif radius < self.level_2_max_radius:
+				geometry.set_level(i, 2)
+			elif radius < self.level_1_max_radius:
+				geometry.set_level(i, 1)
+			curvature += self.get_curvature_for_segment(geometry.length(i), radius)
+		way.curvature = curvature
+
+	# Eliminate the curvature of short deflections from otherwise straight lines.
+	#
+	# While we are in straight segments, be wary of single-point (two-segment)
+	# deflections from our straight line if the next two segments are followed
+	# by a straight section. E.g. __/\__
+	# and of two/three-point (three/four-segment) deflections likewise. E.g.
+	#   __/\ _   __
+	#        \/
+	# We want to differentiate a jog off of an otherwise straight line from a
+	# curve between two straight sections like these:
+	#     __ __    __
+	#   /        /   \
+	#
+	# For each segment, the segments 3, 4 and 5 ahead are checked in turn. The
+	# heading of each segment is computed once per way, and the distance of each
+	# gap between the end of a segment and the start of one ahead (each of which
+	# is only checked once) only when both segments are straight. The headings
+	# and the gap distances (as from deflection_gaps()) may be given if they are
+	# already known.
+	def filter_deflections(self, way, headings=None, gaps=None):
+		geometry = way.geometry
+		count = len(geometry)
+		if count < 4:
 			return
+		offset = geometry.offset
+		lats = geometry.lats
+		lons = geometry.lons
+		levels = geometry.levels
+		eliminated = geometry.eliminated
+		max_radius = self.level_1_max_radius
+		keep_eliminated = self.keep_eliminated
+		arc = self.distance_kernel.arc
+
+		if headings is None:
+			headings = self.deflection_headings(geometry)
+
+		for start in xrange(count - 3):
+			a = offset + start
+			# Only consider deflections from straight (or eliminated) segments.
+			if levels[a] and not eliminated[a]:
+				continue
+			for look_ahead in (3, 4, 5):
+				if start + look_ahead >= count:
+					break
+				b = a + look_ahead
+				if levels[b] and not eliminated[b]:
+					continue
+				heading_diff = abs(headings[start] - headings[start + look_ahead])
+				# Compare the difference in heading to the angle that wold be expected
+				# for a curve just barely meeting our threshold for straight/curved.
+				if gaps is None:
+					gap_distance = arc(lats[a + 1], lons[a + 1], lats[b], lons[b]) * rad_earth_m
+				else:
+					gap_distance = gaps[3 * start + look_ahead - 3]
+				if heading_diff < gap_distance / max_radius:
+					# Mark them as eliminated so that we can show them in the output
+					for i in xrange(a + 1, b - 1):
+						if levels[i]:
+							eliminated[i] = 1
+					if not keep_eliminated:
+						# unset the curvature level of the intermediate segments
+						for i in xrange(a + 1, b - 1):
+							levels[i] = 0
+
+	# The heading of each segment of a geometry, as compared by filter_deflections().
+	def deflection_headings(self, geometry):
+		lats = geometry.lats
+		lons = geometry.lons
+		offset = geometry.offset
+		headings = []
+		for i in xrange(offset, offset + len(geometry)):
+			headings.append(180 + math.atan2((lats[i + 1] - lats[i]), (lons[i + 1] - lons[i])) * (180 / math.pi))
+		return headings
+
+	# The distance of the gap from the end of each segment of a geometry to the
+	# start of the segments 3, 4 and 5 ahead, as checked by filter_deflections(),
+	# with zeros for segments that aren't there.
+	def deflection_gaps(self, geometry):
+		lats = geometry.lats
+		lons = geometry.lons
+		offset = geometry.offset
+		count = len(geometry)
+		arc = self.distance_kernel.arc
+		gaps = array.array('d')
+		for start in xrange(count):
+			a = offset + start
+			for look_ahead in (3, 4, 5):
+				if start + look_ahead < count:
+					b = a + look_ahead
+					gaps.append(arc(lats[a + 1], lons[a + 1], lats[b], lons[b]) * rad_earth_m)
+				else:
+					gaps.append(0.0)
+		return gaps
 
-	def get_segment_heading(self, segment):
-		return 180 + math.atan2((segment['end'][0] - segment['start'][0]),(segment['end'][1] - segment['start'][1])) * (180 / math.pi)
+	def get_segment_heading(self, geometry, index):
+		start = geometry.start(index)
+		end = geometry.end(index)
+		return 180 + math.atan2((end[0] - start[0]),(end[1] - start[1])) * (180 / math.pi)
 
 	def heading_diff(self, initial, final):
             if initial > 360 or initial < 0 or final > 360 or final < 0:
@@ -438,67 +687,86 @@ class WayCollector(object):
 			sections.append(way)
 			return sections
 
+		geometry = way.geometry
+		offset = geometry.offset
+		lengths = geometry.lengths
+		radii = geometry.radii
+		levels = geometry.levels
+		threshold = self.straight_segment_split_threshold
+		# The maximum radius and weight of each level, as in get_curvature_for_segment().
+		weights = ((self.level_4_max_radius, self.level_4_weight), (self.level_3_max_radius, self.level_3_weight),
+			(self.level_2_max_radius, self.level_2_weight), (self.level_1_max_radius, self.level_1_weight))
+		# Running totals of the length and weighted curvature of the segments since
+		# curve_start, summed in segment order, and their values at straight_start.
+		section_length = 0.0
+		section_curvature = 0.0
+		straight_length = 0.0
+		straight_curvature = 0.0
 		curve_start = 0
 		curve_distance = 0
 		straight_start = None
 		straight_distance = 0
-		for index, segment in enumerate(way['segments']):
+		for index in xrange(len(geometry)):
+			length = lengths[offset + index]
+			radius = radii[offset + index]
 			# Reset the straight distance if we have a significant curve
-			if segment['curvature_level']:
+			if levels[offset + index]:
 				# Ignore any preceding long straight sections
-				if straight_distance > self.straight_segment_split_threshold or curve_start is None:
+				if straight_distance > threshold or curve_start is None:
 					curve_start = index
+					section_length = 0.0
+					section_curvature = 0.0
 				straight_start = None
 				straight_distance = 0
-				curve_distance += segment['length']
+				curve_distance += length
 			# Add to our straight distance
 			else:
 				if straight_start is None:
 					straight_start = index
-				straight_distance += segment['length']
+					straight_length = section_length
+					straight_curvature = section_curvature
+				straight_distance += length
+			section_length += length
+			for max_radius, weight in weights:
+				if radius < max_radius:
+					section_curvature += length * weight
+					break
 
 			# If we are more than about 1.5 miles of straight, split off the last curved part.
-			if straight_distance > self.straight_segment_split_threshold and straight_start > 0 and curve_distance > 0:
-				section = copy.copy(way)
-				section['segments'] = way['segments'][curve_start:straight_start]
-				ref_end = straight_start + 1
-				section['curvature'] = 0
-				section['length'] = 0
-				for sect_segment in section['segments']:
-					section['curvature'] += self.get_curvature_for_segment(sect_segment)
-					section['length'] += sect_segment['length']
-				start = section['segments'][0]['start']
-				end = section['segments'][-1]['end']
-				section['distance'] = distance_on_unit_sphere(start[0], start[1], end[0], end[1]) * rad_earth_m
-				sections.append(section)
+			if straight_distance > threshold and straight_start > 0 and curve_distance > 0:
+				sections.append(self.get_section(way, curve_start, straight_start, straight_length, straight_curvature))
 				curve_distance = 0
 				curve_start = None
 
 		# Add any remaining curved section to the sections
 		if curve_distance > 0:
-			section = copy.copy(way)
-			section['segments'] = way['segments'][curve_start:]
-			section['curvature'] = 0
-			section['length'] = 0
-			for sect_segment in section['segments']:
-				section['curvature'] += self.get_curvature_for_segment(sect_segment)
-				section['length'] += sect_segment['length']
-			start = section['segments'][0]['start']
-			end = section['segments'][-1]['end']
-			section['distance'] = distance_on_unit_sphere(start[0], start[1], end[0], end[1]) * rad_earth_m
-			sections.append(section)
+			sections.append(self.get_section(way, curve_start, len(geometry), section_length, section_curvature))
 
 		return sections
 
-	def get_curvature_for_segment(self, segment):
-		if segment['radius'] < self.level_4_max_radius:
-			return segment['length'] * self.level_4_weight
-		elif segment['radius'] < self.level_3_max_radius:
-			return segment['length'] * self.level_3_weight
-		elif segment['radius'] < self.level_2_max_radius:
-			return segment['length'] * self.level_2_weight
-		elif segment['radius'] < self.level_1_max_radius:
-			return segment['length'] * self.level_1_weight
+	# Answer a copy of the way with only the segments from start up to end, with
+	# the totals of their length and curvature. The section shares the
+	# attributes and geometry arrays of the way.
+	def get_section(self, way, start, end, length, curvature):
+		section = way.copy()
+		geometry = way.geometry.section(start, end)
+		section.geometry = geometry
+		section.curvature = curvature
+		section.length = length
+		start = geometry.start(0)
+		end = geometry.end(len(geometry) - 1)
+		section.distance = self.distance_kernel.arc(start[0], start[1], end[0], end[1]) * rad_earth_m
+		return section
+
+	def get_curvature_for_segment(self, length, radius):
+		if radius < self.level_4_max_radius:
+			return length * self.level_4_weight
+		elif radius < self.level_3_max_radius:
+			return length * self.level_3_weight
+		elif radius < self.level_2_max_radius:
+			return length * self.level_2_weight
+		elif radius < self.level_1_max_radius:
+			return length * self.level_1_weight
 		else:
 			return 0
 
@@ -518,35 +786,7 @@ class NonSplittingWayCollector(WayCollector):
 
 
 
-# From http://www.johndcook.com/python_longitude_latitude.html
+# The arc between two points in radians by the spherical law of cosines. See
+# distance.py for the other distance kernels.
 def distance_on_unit_sphere(lat1, long1, lat2, long2):
-	if lat1 == lat2	 and long1 == long2:
-		return 0
-
-	# Convert latitude and longitude to
-	# spherical coordinates in radians.
-	degrees_to_radians = math.pi/180.0
-
-	# phi = 90 - latitude
-	phi1 = (90.0 - lat1)*degrees_to_radians
-	phi2 = (90.0 - lat2)*degrees_to_radians
-
-	# theta = longitude
-	theta1 = long1*degrees_to_radians
-	theta2 = long2*degrees_to_radians
-
-	# Compute spherical distance from spherical coordinates.
-
-	# For two locations in spherical coordinates
-	# (1, theta, phi) and (1, theta, phi)
-	# cosine( arc length ) =
-	#	 sin phi sin phi' cos(theta-theta') + cos phi cos phi'
-	# distance = rho * arc length
-
-	cos = (math.sin(phi1)*math.sin(phi2)*math.cos(theta1 - theta2) +
-		   math.cos(phi1)*math.cos(phi2))
-	arc = math.acos( cos )
-
-	# Remember to multiply arc by the radius of the earth
-	# in your favorite set of units to get length.
-	return arc
+	return kernels['cosines'].arc(lat1, long1, lat2, long2)
@@ -0,0 +1,70 @@
+from curvature.collector import WayCollector
+
+# Several collectors loaded from a single parse of an input file.
+#
+# curvature.py and surface.py each parse the ways of their input and then its
+# nodes, keeping different highway types and surfaces. A CombinedCollector
+# parses an input once for all of its collectors: its tag filter keeps the
+# tags of a way that any of them can use, and each collector's ways_callback
+# takes the ways it matches into its own routes. The collectors share a single
+# CoordinateStore of the nodes referenced by any of them, so coordinates are
+# loaded (or read from a flat-nodes cache) once. Each collector then joins and
+# calculates its own ways with its own settings, and its sections are left in
+# its ways.
+#
+# Joining modifies the refs of ways in place, so every collector after the
+# first is given its own copy of the refs of each way.
+#
+# The input is read with the options of the first collector: its bounds,
+# flat-nodes cache, prefetcher, parser concurrency, verbosity and metrics.
+#
+# Usage:
+#   curvature = WayCollector()
+#   surface = NonSplittingWayCollector()
+#   combined = CombinedCollector([curvature, surface])
+#   combined.load_file('vermont.osm')
+#   curvature.ways, surface.ways                  # the sections of each
+
+class CombinedCollector(WayCollector):
+	# The options of the first collector that the input is read with.
+	input_options = ('verbose', 'min_lat_bound', 'max_lat_bound', 'min_lon_bound', 'max_lon_bound', 'flat_nodes', 'prefetcher', 'parser_concurrency', 'metrics')
+
+	def __init__(self, collectors):
+		self.collectors = collectors
+		super(CombinedCollector, self).__init__()
+
+	def reset(self):
+		super(CombinedCollector, self).reset()
+		for collector in self.collectors:
+			collector.reset()
+
+	def load_file(self, filename):
+		for name in self.input_options:
+			setattr(self, name, getattr(self.collectors[0], name))
+		super(CombinedCollector, self).load_file(filename)
+
+	def load_source(self, source):
+		self.read_source(source, self.cache_for(source))
+		for collector in self.collectors:
+			collector.coords = self.coords
+			collector.join_and_calculate()
+
+	# Keep the tags that any of our collectors keeps.
+	def ways_tag_filter(self, tags):
+		kept = {}
+		for collector in self.collectors:
+			collector_tags = dict(tags)
+			collector.ways_tag_filter(collector_tags)
+			kept.update(collector_tags)
+		tags.clear()
+		tags.update(kept)
+
+	def ways_callback(self, ways):
+		ways = [way for way in ways if way[1]]
+		for i, collector in enumerate(self.collectors):
+			collector.coords = self.coords
+			if i:
+				collector.ways_callback([(osmid, tags, list(refs)) for osmid, tags, refs in ways])
+			else:
+				collector.ways_callback(ways)
+		self.num_ways = sum([collector.num_ways for collector in self.collectors])
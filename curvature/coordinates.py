@@ -0,0 +1,249 @@
+import os
+import json
+import hashlib
+import mmap
+import array
+import struct
+import bisect
+import heapq
+
+# Compact storage of the coordinates of the nodes referenced by our ways.
+#
+# Node ids are collected while ways are parsed and then indexed into a single
+# sorted array of ids with parallel arrays of latitudes and longitudes. Lookups
+# are done by binary search over the id array. This uses 24 bytes per node
+# rather than the ~200 bytes per node of a dict of (lat, lon) tuples.
+#
+# Usage:
+#   store.add_refs(refs)          # for each way, while parsing ways
+#   store.index()                 # once all ways have been parsed
+#   store.set(osm_id, lat, lon)   # for each node, while parsing coordinates
+#   store[osm_id]                 # (lat, lon) or None if the node wasn't loaded
+class CoordinateStore(object):
+	# Typecode for node ids. 'l' is 64 bits on the 64-bit Linux and Mac OS
+	# builds of Python that are needed to handle large extracts anyway.
+	id_typecode = 'l'
+
+	# Number of pending refs to accumulate before sorting them into a run.
+	run_size = 4000000
+
+	def __init__(self):
+		self.ids = array.array(self.id_typecode)
+		self.lats = array.array('d')
+		self.lons = array.array('d')
+		self.pending = array.array(self.id_typecode)
+		self.runs = []
+		self.num_loaded = 0
+
+	def add_refs(self, refs):
+		self.pending.extend(refs)
+		if len(self.pending) >= self.run_size:
+			self._flush_pending()
+
+	def _flush_pending(self):
+		if len(self.pending):
+			self.runs.append(array.array(self.id_typecode, sorted(set(self.pending))))
+			self.pending = array.array(self.id_typecode)
+
+	# Merge all of the collected refs into a sorted array of unique ids and
+	# allocate the coordinate arrays for them.
+	def index(self):
+		self._flush_pending()
+		if len(self.ids):
+			self.runs.append(self.ids)
+
+		if len(self.runs) == 1:
+			ids = self.runs[0]
+		else:
+			ids = array.array(self.id_typecode)
+			last = None
+			for osm_id in heapq.merge(*self.runs):
+				if osm_id != last:
+					ids.append(osm_id)
+					last = osm_id
+		self.runs = []
+		self.ids = ids
+
+		# Coordinates that have not been loaded are stored as NaN.
+		nan = float('nan')
+		self.lats = array.array('d', [nan]) * len(ids)
+		self.lons = array.array('d', [nan]) * len(ids)
+		self.num_loaded = 0
+
+	def _position(self, osm_id):
+		i = bisect.bisect_left(self.ids, osm_id)
+		if i < len(self.ids) and self.ids[i] == osm_id:
+			return i
+		return -1
+
+	# Store the coordinates of a node. Returns False if the node isn't one that
+	# was referenced by our ways.
+	def set(self, osm_id, lat, lon):
+		i = self._position(osm_id)
+		if i < 0:
+			return False
+		if self.lats[i] != self.lats[i]:
+			self.num_loaded += 1
+		self.lats[i] = lat
+		self.lons[i] = lon
+		return True
+
+	def __getitem__(self, osm_id):
+		i = self._position(osm_id)
+		if i < 0:
+			raise KeyError(osm_id)
+		lat = self.lats[i]
+		if lat != lat:
+			return None
+		return (lat, self.lons[i])
+
+	def __contains__(self, osm_id):
+		return self._position(osm_id) >= 0
+
+	def __len__(self):
+		return len(self.ids)
+
+	# The number of bytes used by the arrays in this store.
+	def memory_usage(self):
+		size = 0
+		for a in [self.ids, self.lats, self.lons, self.pending] + self.runs:
+			size += a.itemsize * len(a)
+		return size
+
+# A persistent, memory-mapped file of node locations indexed by node id, similar
+# in spirit to the osm2pgsql flat-nodes file.
+#
+# Each node id owns 8 bytes at offset id * 8 holding its latitude and longitude
+# as unsigned fixed-point integers with 7 decimal places (the precision OSM
+# stores coordinates with). Values are offset to always be positive so that the
+# holes of the sparse file read back as "no node".
+#
+# A sidecar .meta file records the absolute path, inode, size and modification
+# time of the file the cache was built from so that a stale cache, or one built
+# from a copy of the file, is rebuilt rather than used. A new cache is written
+# to a temporary file of its own and then renamed into place, so processes
+# building the same cache at once never write to the same file.
+class FlatNodesCache(object):
+	version = 2
+	record = struct.Struct('II')
+	scale = 10000000.0
+	lat_offset = 900000001
+	lon_offset = 1800000001
+	# Grow the file in steps of this many bytes while writing.
+	growth = 64 * 1048576
+
+	def __init__(self, path):
+		self.path = path
+		self.meta_path = path + '.meta'
+		self.file = None
+		self.map = None
+		self.size = 0
+		# The temporary file a new cache is written to until it is finished.
+		self.temp_path = None
+
+	# The cache file to use for an input file when caches are kept in a directory.
+	# Files of the same name in different directories have caches of their own.
+	@classmethod
+	def for_source(cls, directory, source):
+		if source == '-':
+			return cls(os.path.join(directory, 'stdin.nodes'))
+		digest = hashlib.sha1(os.path.abspath(source)).hexdigest()[:12]
+		return cls(os.path.join(directory, '{}.{}.nodes'.format(os.path.basename(source), digest)))
+
+	def _source_info(self, source):
+		stat = os.stat(source)
+		return {'version': self.version, 'path': os.path.abspath(source), 'inode': stat.st_ino, 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+	# Answer True if the cache was completely built from the current version of
+	# source. A cache of standard input is never current.
+	def is_current(self, source):
+		if not os.path.isfile(source):
+			return False
+		if not os.path.exists(self.path) or not os.path.exists(self.meta_path):
+			return False
+		try:
+			with open(self.meta_path) as f:
+				meta = json.load(f)
+		except ValueError:
+			return False
+		return meta == self._source_info(source)
+
+	def open_for_writing(self):
+		# Invalidate any previous cache until we have finished writing the new one.
+		if os.path.exists(self.meta_path):
+			os.remove(self.meta_path)
+		self.temp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+		self.file = open(self.temp_path, 'w+b')
+		self.size = 0
+		self._resize(self.growth)
+
+	def _resize(self, size):
+		if self.map is not None:
+			self.map.close()
+		self.file.truncate(size)
+		self.size = size
+		self.map = mmap.mmap(self.file.fileno(), size)
+
+	# Store a batch of coordinates as passed to an imposm coords_callback.
+	def add_coords(self, coords):
+		if not len(coords):
+			return
+		record = self.record
+		scale = self.scale
+		needed = (max(coords)[0] + 1) * record.size
+		if needed > self.size:
+			self._resize((needed // self.growth + 1) * self.growth)
+		for osm_id, lon, lat in coords:
+			record.pack_into(self.map, osm_id * record.size, int(round(lat * scale)) + self.lat_offset, int(round(lon * scale)) + self.lon_offset)
+
+	# Open an existing cache to apply changes to it. A changed cache no longer
+	# matches the file it was built from, so its source information is removed.
+	def open_for_update(self):
+		if os.path.exists(self.meta_path):
+			os.remove(self.meta_path)
+		self.file = open(self.path, 'r+b')
+		self.size = 0
+		self._resize(max(os.path.getsize(self.path), self.growth))
+
+	# Remove a node from a cache opened for writing or updating.
+	def remove(self, osm_id):
+		offset = osm_id * self.record.size
+		if offset + self.record.size <= self.size:
+			self.record.pack_into(self.map, offset, 0, 0)
+
+	# Finish writing and record the source that this cache was built from, if any.
+	def finish(self, source=None):
+		self.map.flush()
+		self.close()
+		if self.temp_path is not None:
+			os.rename(self.temp_path, self.path)
+			self.temp_path = None
+		if source is not None and os.path.isfile(source):
+			with open(self.meta_path, 'w') as f:
+				json.dump(self._source_info(source), f)
+
+	def open_for_reading(self):
+		self.file = open(self.path, 'rb')
+		self.size = os.path.getsize(self.path)
+		if self.size:
+			self.map = mmap.mmap(self.file.fileno(), self.size, access=mmap.ACCESS_READ)
+
+	# Answer the (lat, lon) of a node or None if the node isn't in the cache.
+	def get(self, osm_id):
+		offset = osm_id * self.record.size
+		if offset + self.record.size > self.size:
+			return None
+		lat, lon = self.record.unpack_from(self.map, offset)
+		if not lat:
+			return None
+		# Subtract the offsets before scaling so that the result is the same float
+		# as was parsed from the 7-decimal-place input.
+		return ((lat - self.lat_offset) / self.scale, (lon - self.lon_offset) / self.scale)
+
+	def close(self):
+		if self.map is not None:
+			self.map.close()
+			self.map = None
+		if self.file is not None:
+			self.file.close()
+			self.file = None
@@ -0,0 +1,163 @@
+import math
+
+# Great-circle distance kernels.
+#
+# Each kernel measures arcs between points on a sphere, in radians, to be
+# multiplied by the radius of the earth. arc() measures a single pair of
+# points given in degrees. arcs() measures all of the arcs a way needs at once:
+# from each point to the next and to the one after that. It converts each
+# point to radians and computes its sines and cosines once, rather than once
+# for each of the (up to four) distances the point is a part of, and keeps the
+# arithmetic inline rather than calling arc() for each pair.
+#
+# The kernels, with their largest relative errors as measured by
+# benchmarks/distance.py:
+#
+#                     1m      10m     100m    1km     10km    100km
+#   cosines           1e-2    1e-4    1e-6    1e-8    1e-10   1e-12
+#   haversine         <1e-9   <1e-10  <1e-11  <1e-12  <1e-13  <1e-14
+#   equirectangular   <1e-9   <1e-10  <1e-10  3e-9    3e-7    3e-5
+#
+#   cosines          The spherical law of cosines, as curvature has always used.
+#                    Exact on the sphere, but acos() is ill-conditioned for
+#                    short distances and rounding adds up to about a centimeter
+#                    to each distance. That is enough to throw off the radius of
+#                    a tight curve measured from short segments by several
+#                    percent. Points a few millimeters apart can round to a
+#                    cosine above 1 and raise a math domain error, failing
+#                    their way.
+#   haversine        The haversine formula. Exact on the sphere to within
+#                    rounding at any distance. The slowest in pure Python.
+#   equirectangular  Pythagoras on a plane projected at the average latitude of
+#                    the two points, using the average of the cosines of their
+#                    latitudes. No trigonometry per arc, so the fastest. Its
+#                    error grows with the square of the distance but is as
+#                    accurate as haversine for segments and curves.
+#
+# All of the kernels treat the earth as a sphere, which is itself up to 0.5%
+# off the ellipsoid.
+#
+# Usage:
+#   kernel = kernels['haversine']
+#   meters = kernel.arc(lat1, lon1, lat2, lon2) * rad_earth_m
+#   arcs, skip_arcs = kernel.arcs(lats, lons)
+#   # arcs[i] is from point i to i + 1, skip_arcs[i] from point i to i + 2.
+
+degrees_to_radians = math.pi/180.0
+
+# From http://www.johndcook.com/python_longitude_latitude.html
+class CosinesKernel(object):
+	name = 'cosines'
+
+	def arc(self, lat1, lon1, lat2, lon2):
+		if lat1 == lat2 and lon1 == lon2:
+			return 0
+		phi1 = (90.0 - lat1)*degrees_to_radians
+		phi2 = (90.0 - lat2)*degrees_to_radians
+		return math.acos(math.sin(phi1)*math.sin(phi2)*math.cos(lon1*degrees_to_radians - lon2*degrees_to_radians) + math.cos(phi1)*math.cos(phi2))
+
+	def arcs(self, lats, lons):
+		sin = math.sin
+		cos = math.cos
+		acos = math.acos
+		phis = [(90.0 - lat)*degrees_to_radians for lat in lats]
+		sins = map(sin, phis)
+		coss = map(cos, phis)
+		thetas = [lon*degrees_to_radians for lon in lons]
+		arcs = []
+		skip_arcs = []
+		for i in xrange(1, len(phis)):
+			j = i - 1
+			if lats[i] == lats[j] and lons[i] == lons[j]:
+				arcs.append(0)
+			else:
+				arcs.append(acos(sins[i]*sins[j]*cos(thetas[i] - thetas[j]) + coss[i]*coss[j]))
+			j = i - 2
+			if j < 0:
+				continue
+			if lats[i] == lats[j] and lons[i] == lons[j]:
+				skip_arcs.append(0)
+			else:
+				skip_arcs.append(acos(sins[i]*sins[j]*cos(thetas[i] - thetas[j]) + coss[i]*coss[j]))
+		return arcs, skip_arcs
+
+class HaversineKernel(object):
+	name = 'haversine'
+
+	def arc(self, lat1, lon1, lat2, lon2):
+		lat1 = lat1*degrees_to_radians
+		lat2 = lat2*degrees_to_radians
+		sin_lat = math.sin((lat2 - lat1) / 2)
+		sin_lon = math.sin((lon2 - lon1)*degrees_to_radians / 2)
+		h = sin_lat*sin_lat + math.cos(lat1)*math.cos(lat2)*sin_lon*sin_lon
+		return 2 * math.asin(math.sqrt(min(h, 1.0)))
+
+	def arcs(self, lats, lons):
+		sin = math.sin
+		asin = math.asin
+		sqrt = math.sqrt
+		# Half of each angle, for the sines of half of each difference.
+		half_phis = [lat*(degrees_to_radians / 2) for lat in lats]
+		coss = [math.cos(phi * 2) for phi in half_phis]
+		half_thetas = [lon*(degrees_to_radians / 2) for lon in lons]
+		arcs = []
+		skip_arcs = []
+		for i in xrange(1, len(half_phis)):
+			j = i - 1
+			sin_lat = sin(half_phis[i] - half_phis[j])
+			sin_lon = sin(half_thetas[i] - half_thetas[j])
+			h = sin_lat*sin_lat + coss[i]*coss[j]*sin_lon*sin_lon
+			arcs.append(2 * asin(sqrt(h if h < 1.0 else 1.0)))
+			if i < 2:
+				continue
+			j = i - 2
+			sin_lat = sin(half_phis[i] - half_phis[j])
+			sin_lon = sin(half_thetas[i] - half_thetas[j])
+			h = sin_lat*sin_lat + coss[i]*coss[j]*sin_lon*sin_lon
+			skip_arcs.append(2 * asin(sqrt(h if h < 1.0 else 1.0)))
+		return arcs, skip_arcs
+
+class EquirectangularKernel(object):
+	name = 'equirectangular'
+
+	def arc(self, lat1, lon1, lat2, lon2):
+		lon = (lon2 - lon1)*degrees_to_radians
+		# Take the short way around across the antimeridian.
+		if lon > math.pi or lon < -math.pi:
+			lon -= math.copysign(2 * math.pi, lon)
+		lat1 = lat1*degrees_to_radians
+		lat2 = lat2*degrees_to_radians
+		x = lon * (math.cos(lat1) + math.cos(lat2)) / 2
+		y = lat2 - lat1
+		return math.sqrt(x*x + y*y)
+
+	def arcs(self, lats, lons):
+		sqrt = math.sqrt
+		phis = [lat*degrees_to_radians for lat in lats]
+		# Half of the cosine of each latitude, so that the sum of two is their average.
+		half_coss = [math.cos(phi) / 2 for phi in phis]
+		# Take the short way around across the antimeridian by moving the western
+		# hemisphere points of ways that cross it a turn to the east.
+		if len(lons) and max(lons) - min(lons) > 180:
+			lons = [lon + 360 if lon < 0 else lon for lon in lons]
+		thetas = [lon*degrees_to_radians for lon in lons]
+		arcs = []
+		skip_arcs = []
+		for i in xrange(1, len(phis)):
+			j = i - 1
+			x = (thetas[i] - thetas[j]) * (half_coss[i] + half_coss[j])
+			y = phis[i] - phis[j]
+			arcs.append(sqrt(x*x + y*y))
+			if i < 2:
+				continue
+			j = i - 2
+			x = (thetas[i] - thetas[j]) * (half_coss[i] + half_coss[j])
+			y = phis[i] - phis[j]
+			skip_arcs.append(sqrt(x*x + y*y))
+		return arcs, skip_arcs
+
+kernels = {
+	'cosines': CosinesKernel(),
+	'haversine': HaversineKernel(),
+	'equirectangular': EquirectangularKernel(),
+}
@@ -6,12 +6,30 @@ class WayFilter(object):
 	max_length = 0
 
 	def filter(self, ways):
-		if self.min_length > 0:
-			ways = filter(lambda w: w['length'] / 1609 > self.min_length, ways)
-		if self.max_length > 0:
-			ways = filter(lambda w: w['length'] / 1609 < self.max_length, ways)
+		ways = self.filter_length(ways)
 		if self.min_curvature > 0:
-			ways = filter(lambda w: w['curvature'] > self.min_curvature, ways)
+			ways = filter(lambda w: w.curvature > self.min_curvature, ways)
 		if self.max_curvature > 0:
-			ways = filter(lambda w: w['curvature'] < self.max_curvature, ways)
+			ways = filter(lambda w: w.curvature < self.max_curvature, ways)
 		return ways
+
+	# Filter on length only, for ways already within the curvature limits.
+	def filter_length(self, ways):
+		if self.min_length > 0:
+			ways = filter(lambda w: w.length / 1609 > self.min_length, ways)
+		if self.max_length > 0:
+			ways = filter(lambda w: w.length / 1609 < self.max_length, ways)
+		return ways
+
+# A filter that passes every way that passes any of several filters, and perhaps
+# more: their loosest limits.
+def loosest(filters):
+	loose = WayFilter()
+	for name in ('min_curvature', 'min_length'):
+		setattr(loose, name, min([getattr(filter, name) for filter in filters]))
+	for name in ('max_curvature', 'max_length'):
+		limits = [getattr(filter, name) for filter in filters]
+		# A maximum of 0 is no limit.
+		if 0 not in limits:
+			setattr(loose, name, max(limits))
+	return loose
@@ -0,0 +1,101 @@
+import array
+
+# Compact geometry of a way: the coordinates of its points plus parallel arrays
+# of the length, radius, curvature level and eliminated-flag of each segment.
+#
+# Segment i runs from point i to point i + 1, so the coordinate arrays hold one
+# more entry than the segment arrays. A WayGeometry may be a view of a range of
+# the segments of another one: sections of a way share the arrays of the whole
+# way and only record the offset and number of their segments.
+class WayGeometry(object):
+	__slots__ = ('lats', 'lons', 'lengths', 'radii', 'levels', 'eliminated', 'offset', 'count')
+
+	def __init__(self, lats, lons, lengths, radii, levels=None, eliminated=None, offset=0, count=None):
+		self.lats = lats
+		self.lons = lons
+		self.lengths = lengths
+		self.radii = radii
+		if levels is None:
+			levels = array.array('b', [0]) * len(lengths)
+		self.levels = levels
+		if eliminated is None:
+			eliminated = array.array('b', [0]) * len(lengths)
+		self.eliminated = eliminated
+		self.offset = offset
+		if count is None:
+			count = len(lengths) - offset
+		self.count = count
+
+	# The number of segments
+	def __len__(self):
+		return self.count
+
+	# A view of segments start up to (but not including) end of this geometry.
+	def section(self, start, end):
+		return WayGeometry(self.lats, self.lons, self.lengths, self.radii, self.levels, self.eliminated, self.offset + start, end - start)
+
+	# A copy with only the points at the given indexes, which must be ascending
+	# and include the first and last points. Each segment between two kept points
+	# covers those it replaces: it has their total length, tightest radius and
+	# highest level, and is eliminated only if all of them were.
+	def subset(self, indexes):
+		offset = self.offset
+		lats = array.array('d')
+		lons = array.array('d')
+		lengths = array.array('d')
+		radii = array.array('d')
+		levels = array.array('b')
+		eliminated = array.array('b')
+		for n, index in enumerate(indexes):
+			lats.append(self.lats[offset + index])
+			lons.append(self.lons[offset + index])
+			if not n:
+				continue
+			first = offset + indexes[n - 1]
+			last = offset + index
+			lengths.append(sum(self.lengths[first:last]))
+			radii.append(min(self.radii[first:last]))
+			levels.append(max(self.levels[first:last]))
+			eliminated.append(min(self.eliminated[first:last]))
+		return WayGeometry(lats, lons, lengths, radii, levels, eliminated)
+
+	def start(self, i):
+		i += self.offset
+		return (self.lats[i], self.lons[i])
+
+	def end(self, i):
+		i += self.offset + 1
+		return (self.lats[i], self.lons[i])
+
+	def length(self, i):
+		return self.lengths[self.offset + i]
+
+	def radius(self, i):
+		return self.radii[self.offset + i]
+
+	def level(self, i):
+		return self.levels[self.offset + i]
+
+	def set_level(self, i, level):
+		self.levels[self.offset + i] = level
+
+	def is_eliminated(self, i):
+		return self.eliminated[self.offset + i] != 0
+
+	def eliminate(self, i):
+		self.eliminated[self.offset + i] = 1
+
+	# The (lat, lon) of each point from the start of the first segment to the end
+	# of the last.
+	def points(self):
+		lats = self.lats
+		lons = self.lons
+		for i in xrange(self.offset, self.offset + self.count + 1):
+			yield (lats[i], lons[i])
+
+	# (min_lat, max_lat, min_lon, max_lon) of our points.
+	def bounds(self):
+		end = self.offset + self.count + 1
+		lats = self.lats[self.offset:end]
+		lons = self.lons[self.offset:end]
+		return (min(lats), max(lats), min(lons), max(lons))
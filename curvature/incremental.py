@@ -0,0 +1,522 @@
+import os
+import sys
+import bz2
+import gzip
+import json
+import array
+import bisect
+import marshal
+import sqlite3
+import copy_reg
+import cPickle
+import cStringIO
+from xml.etree import cElementTree as ElementTree
+from curvature.coordinates import CoordinateStore, FlatNodesCache
+from curvature.input import OsmInput, decompressors
+from curvature.way import Way, StringTable
+
+# Incremental updates from OSM change files (.osc).
+#
+# A full run on an extract keeps its state in a directory: a flat-nodes cache of
+# every node in the extract, the candidate ways of each route group (a route
+# ref or name whose ways are joined together) as they were parsed, before
+# joining, and the calculated sections of each group.
+#
+# Applying a change file updates the nodes in the cache, works out which groups
+# had ways created, modified or deleted or use a node that moved, and joins and
+# calculates only those groups again. The results of all other groups are
+# reused as they are.
+#
+# Each group is joined from its own copies of the refs of its ways. A full run
+# shares the refs of a way with several refs (e.g. "US 2;VT 100") between its
+# routes and the join of one route modifies them, so the results of those ways
+# can differ slightly from those of a plain run on the same extract.
+#
+# The rest of the state is kept in a SQLite database, so that applying a change
+# file only reads and rewrites the records it touches:
+#
+#   metadata    the version and the collector settings, as JSON
+#   strings     the StringTable of the way records, by code
+#   ways        the record of each way by id, the routes it is in (with None
+#               for a way in no route) and, for a way in no route, its sections
+#   way_nodes   the ways that use each node, to find the ways of moved nodes
+#   routes      the ids of the ways of each route group and its sections
+#
+# A way in no route is calculated on its own. Sections are pickled with their
+# StringTable left out, to be put back from the strings of the state. Changes
+# are applied in a single transaction, so a failed update keeps the old state,
+# and a full run builds a new database in place of the old one.
+#
+# Usage:
+#   load_file(collector, 'vermont.osm.bz2', 'state/')     # full run, saves the state
+#   load_file(collector, '1234.osc.gz', 'state/')         # applies the changes
+
+# The collector settings that the results depend on, along with its distance
+# kernel. Changes can only be applied to a state built with the same settings.
+settings = ('roads', 'ignored_surfaces', 'level_1_max_radius', 'level_1_weight',
+	'level_2_max_radius', 'level_2_weight', 'level_3_max_radius', 'level_3_weight',
+	'level_4_max_radius', 'level_4_weight', 'min_lat_bound', 'max_lat_bound',
+	'min_lon_bound', 'max_lon_bound', 'straight_segment_split_threshold', 'keep_eliminated')
+
+schema = """
+CREATE TABLE metadata (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE strings (code INTEGER PRIMARY KEY, value BLOB);
+CREATE TABLE ways (id INTEGER PRIMARY KEY, name INTEGER, type INTEGER, surface INTEGER, county INTEGER, refs BLOB, routes BLOB, sections BLOB);
+CREATE TABLE way_nodes (node INTEGER, way INTEGER, PRIMARY KEY (node, way)) WITHOUT ROWID;
+CREATE TABLE routes (route TEXT PRIMARY KEY, ways BLOB, sections BLOB);
+"""
+
+# The most parameters bound to a statement at once.
+max_parameters = 500
+
+# Pickle arrays as strings rather than as lists of numbers.
+def _array_from_string(typecode, data):
+	a = array.array(typecode)
+	a.fromstring(data)
+	return a
+
+def _reduce_array(a):
+	return (_array_from_string, (a.typecode, a.tostring()))
+
+copy_reg.pickle(array.array, _reduce_array)
+
+class IncrementalState(object):
+	version = 5
+
+	def __init__(self, directory):
+		self.directory = directory
+		self.path = os.path.join(directory, 'state.sqlite')
+		self.nodes = FlatNodesCache(os.path.join(directory, 'nodes'))
+		self.connection = None
+		# The file the database is built in, when building a new one.
+		self.temp_path = None
+		self.settings = None
+		# The table of the string codes of our way records, which the records of
+		# changed ways are added to so that the ways of a group can be joined.
+		self.strings = None
+		# The number of strings in the database, the rest are new.
+		self.saved_strings = 0
+
+	def exists(self):
+		return os.path.exists(self.path)
+
+	# Start a new state with the settings of a collector and the table of its
+	# string codes, which finish() puts in place of any earlier one.
+	def create(self, settings, strings):
+		if not os.path.isdir(self.directory):
+			os.makedirs(self.directory)
+		self.temp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+		if os.path.exists(self.temp_path):
+			os.remove(self.temp_path)
+		self.connect(self.temp_path)
+		self.connection.executescript(schema)
+		self.settings = settings
+		self.strings = strings
+		self.saved_strings = 0
+		self.connection.executemany('INSERT INTO metadata (key, value) VALUES (?, ?)', [('version', json.dumps(self.version)), ('settings', json.dumps(settings))])
+
+	def open(self):
+		self.connect(self.path)
+		metadata = {}
+		for key, value in self.connection.execute('SELECT key, value FROM metadata'):
+			metadata[key] = json.loads(value)
+		if metadata.get('version') != self.version:
+			self.close()
+			raise ValueError('{} is from an incompatible version, rebuild it from a full extract.'.format(self.path))
+		self.settings = metadata['settings']
+		self.strings = StringTable()
+		for code, value in self.connection.execute('SELECT code, value FROM strings ORDER BY code'):
+			self.strings.code(marshal.loads(value))
+		self.saved_strings = len(self.strings)
+
+	def connect(self, path):
+		self.connection = sqlite3.connect(path)
+		self.connection.text_factory = str
+
+	# Save the new strings and commit the changes.
+	def finish(self):
+		new_strings = [(code, buffer(marshal.dumps(self.strings[code]))) for code in xrange(self.saved_strings, len(self.strings))]
+		self.connection.executemany('INSERT INTO strings (code, value) VALUES (?, ?)', new_strings)
+		self.saved_strings = len(self.strings)
+		self.connection.commit()
+		if self.temp_path is not None:
+			self.connection.close()
+			os.rename(self.temp_path, self.path)
+			self.temp_path = None
+			self.connect(self.path)
+
+	# Close the database, discarding any changes not finished.
+	def close(self):
+		if self.connection is not None:
+			self.connection.close()
+			self.connection = None
+		if self.temp_path is not None:
+			os.remove(self.temp_path)
+			self.temp_path = None
+
+	# The record of a way and the routes it is in, or None if we have no such way.
+	def way(self, osm_id):
+		row = self.connection.execute('SELECT id, name, type, surface, county, refs, routes FROM ways WHERE id = ?', (osm_id,)).fetchone()
+		if row is None:
+			return None
+		refs = array.array(CoordinateStore.id_typecode)
+		refs.fromstring(row[5])
+		return Way.from_tuple(row[:5] + (refs,), self.strings), marshal.loads(row[6])
+
+	# Add the record of a way and the routes it is in, with None for no route.
+	def add_way(self, record, routes):
+		self.connection.execute('INSERT INTO ways (id, name, type, surface, county, refs, routes) VALUES (?, ?, ?, ?, ?, ?, ?)', record.to_tuple()[:5] + (buffer(record.refs.tostring()), buffer(marshal.dumps(routes))))
+		self.connection.executemany('INSERT OR IGNORE INTO way_nodes (node, way) VALUES (?, ?)', [(ref, record.id) for ref in record.refs])
+
+	def remove_way(self, record):
+		self.connection.execute('DELETE FROM ways WHERE id = ?', (record.id,))
+		self.connection.executemany('DELETE FROM way_nodes WHERE node = ? AND way = ?', [(ref, record.id) for ref in record.refs])
+
+	# The ids of the ways that use any of a set of nodes.
+	def ways_using(self, nodes):
+		nodes = list(nodes)
+		ids = set()
+		for i in xrange(0, len(nodes), max_parameters):
+			chunk = nodes[i:i + max_parameters]
+			sql = 'SELECT way FROM way_nodes WHERE node IN ({})'.format(', '.join(['?'] * len(chunk)))
+			ids.update([row[0] for row in self.connection.execute(sql, chunk)])
+		return ids
+
+	# The ids of the ways of a route, in ascending order.
+	def route_ways(self, route):
+		row = self.connection.execute('SELECT ways FROM routes WHERE route = ?', (route,)).fetchone()
+		ids = array.array(CoordinateStore.id_typecode)
+		if row is not None:
+			ids.fromstring(row[0])
+		return ids.tolist()
+
+	def save_route(self, route, ids, sections):
+		ids = array.array(CoordinateStore.id_typecode, ids)
+		self.connection.execute('INSERT OR REPLACE INTO routes (route, ways, sections) VALUES (?, ?, ?)', (route, buffer(ids.tostring()), buffer(self.dumps(sections))))
+
+	def remove_route(self, route):
+		self.connection.execute('DELETE FROM routes WHERE route = ?', (route,))
+
+	# Save the sections of a way in no route.
+	def save_way_sections(self, osm_id, sections):
+		self.connection.execute('UPDATE ways SET sections = ? WHERE id = ?', (buffer(self.dumps(sections)), osm_id))
+
+	# The calculated sections of every group: the ways in no route by id and then
+	# the routes by the UTF-8 of their names.
+	def sections(self):
+		sections = []
+		for row in self.connection.execute('SELECT sections FROM ways WHERE sections IS NOT NULL ORDER BY id'):
+			sections += self.loads(row[0])
+		for row in self.connection.execute('SELECT sections FROM routes ORDER BY route'):
+			sections += self.loads(row[0])
+		return sections
+
+	# Pickle a value, leaving out our StringTable.
+	def dumps(self, value):
+		f = cStringIO.StringIO()
+		pickler = cPickle.Pickler(f, cPickle.HIGHEST_PROTOCOL)
+		pickler.inst_persistent_id = self.persistent_id
+		pickler.dump(value)
+		return f.getvalue()
+
+	def persistent_id(self, value):
+		if value is self.strings:
+			return 'strings'
+		return None
+
+	def loads(self, data):
+		unpickler = cPickle.Unpickler(cStringIO.StringIO(data))
+		unpickler.persistent_load = lambda id: self.strings
+		return unpickler.load()
+
+def settings_of(collector):
+	values = {'collector': type(collector).__name__, 'distance': collector.distance_kernel.name}
+	for name in settings:
+		value = getattr(collector, name)
+		if isinstance(value, tuple):
+			value = list(value)
+		values[name] = value
+	return values
+
+# Answer True if a file is an OSM change file, optionally compressed.
+def is_change_file(filename):
+	if os.path.splitext(filename)[1] in decompressors:
+		filename = os.path.splitext(filename)[0]
+	return filename.endswith('.osc')
+
+# Run the collector on an input file, keeping its state in directory. Change
+# files are applied to the existing state and other files replace it. The
+# sections of every group are left in collector.ways, unless sections is False
+# and only the state is updated: the sections of the groups a change file
+# doesn't affect are only read from the state for the outputs.
+def load_file(collector, filename, directory, sections=True):
+	state = IncrementalState(directory)
+	prefetched = None
+	if collector.prefetcher is not None:
+		prefetched = collector.prefetcher.take(filename)
+	source = OsmInput(filename, prefetched)
+	try:
+		if is_change_file(filename):
+			apply_changes(collector, source, state, sections)
+		else:
+			build(collector, source, state)
+	finally:
+		source.close()
+		state.close()
+
+# Parse a full extract and calculate all of its groups.
+def build(collector, source, state):
+	if not os.path.isdir(state.directory):
+		os.makedirs(state.directory)
+	collector.read_source(source, state.nodes)
+	state.create(settings_of(collector), collector.strings)
+
+	# The record of each way and the routes it is in.
+	records = {}
+	way_routes = {}
+	for key, ways in collector.routes.iteritems():
+		for way in ways:
+			if way.id not in records:
+				records[way.id] = way_record(way)
+				way_routes[way.id] = []
+			way_routes[way.id].append(key)
+	for way in collector.ways:
+		if way.id not in way_routes:
+			way_routes[way.id] = []
+		records[way.id] = way_record(way)
+		way_routes[way.id].append(None)
+	for osm_id in sorted(records):
+		state.add_way(records[osm_id], way_routes[osm_id])
+	del way_routes
+	routes = dict([(key, sorted([way.id for way in ways])) for key, ways in collector.routes.iteritems()])
+	unrouted = [way.id for way in collector.ways]
+	collector.routes = {}
+
+	if collector.verbose:
+		sys.stderr.write("\nCalculating {} route groups and {} ways in no route".format(len(routes), len(unrouted)))
+		sys.stderr.flush()
+	route_sections, way_sections = calculate_groups(collector, state, records, routes, unrouted)
+	state.finish()
+
+	# The sections just calculated, in the order the state reads them.
+	collector.ways = []
+	for osm_id in sorted(way_sections):
+		collector.ways += way_sections[osm_id]
+	for key in sorted(route_sections, key=utf8):
+		collector.ways += route_sections[key]
+
+# Apply a change file to a saved state and recalculate the groups it affects,
+# leaving the sections of every group in collector.ways if sections is True.
+def apply_changes(collector, source, state, sections=True):
+	if not state.exists():
+		raise ValueError('No state in {} to apply {} to. Run on a full extract with the same state directory first.'.format(state.directory, source.filename))
+	state.open()
+	if state.settings != settings_of(collector):
+		raise ValueError('The state in {} was built with different settings. Rebuild it from a full extract with these settings.'.format(state.directory))
+	collector.reset()
+	collector.strings = state.strings
+
+	state.nodes.open_for_update()
+	try:
+		touched_nodes, way_changes = read_changes(open_changes(source), state.nodes)
+	finally:
+		state.nodes.finish()
+
+	# The ids of the ways of each affected route, read as they are first
+	# affected, and the affected ways in no route.
+	routes = {}
+	unrouted = set()
+	def affect(osm_id, keys):
+		for key in keys:
+			if key is None:
+				unrouted.add(osm_id)
+			elif key not in routes:
+				routes[key] = state.route_ways(key)
+
+	for osm_id, (action, tags, refs) in way_changes.iteritems():
+		# Remove the previous version of the way.
+		previous = state.way(osm_id)
+		if previous is not None:
+			record, keys = previous
+			affect(osm_id, keys)
+			for key in keys:
+				if key is not None:
+					routes[key].remove(osm_id)
+			unrouted.discard(osm_id)
+			state.remove_way(record)
+		if action == 'delete':
+			continue
+
+		keys, record = classify_way(collector, osm_id, tags, refs)
+		if record is None:
+			continue
+		state.add_way(record, keys)
+		affect(osm_id, keys)
+		for key in keys:
+			if key is not None:
+				bisect.insort(routes[key], osm_id)
+
+	# Groups with ways that use a node that was changed.
+	for osm_id in state.ways_using(touched_nodes):
+		record, keys = state.way(osm_id)
+		affect(osm_id, keys)
+
+	if collector.verbose:
+		sys.stderr.write("\n{} node and {} way changes, recalculating {} route groups and {} ways in no route".format(len(touched_nodes), len(way_changes), len(routes), len(unrouted)))
+		sys.stderr.flush()
+
+	# Load the records of the affected ways and their coordinates from the
+	# updated cache.
+	records = {}
+	for ids in routes.values() + [unrouted]:
+		for osm_id in ids:
+			if osm_id not in records:
+				records[osm_id] = state.way(osm_id)[0]
+	collector.coords = CoordinateStore()
+	for record in records.itervalues():
+		collector.coords.add_refs(record.refs)
+	collector.coords.index()
+	verbose = collector.verbose
+	collector.verbose = False
+	try:
+		collector.load_cached_coords(state.nodes)
+	finally:
+		collector.verbose = verbose
+
+	for key in [key for key, ids in routes.iteritems() if not ids]:
+		state.remove_route(key)
+		del routes[key]
+	calculate_groups(collector, state, records, routes, unrouted)
+	state.finish()
+
+	collector.ways = []
+	if sections:
+		collector.ways = state.sections()
+
+# Join and calculate the ways of routes and the ways in no route from their
+# records by id, saving their sections. Answers the sections of each route and
+# of each way in no route. The coordinates of their nodes must be loaded into
+# collector.coords.
+def calculate_groups(collector, state, records, routes, unrouted):
+	route_sections = {}
+	way_sections = {}
+	for key, ids in routes.iteritems():
+		route_sections[key] = calculate_group(collector, key, [records[osm_id] for osm_id in ids])
+		state.save_route(key, ids, route_sections[key])
+	for osm_id in unrouted:
+		way_sections[osm_id] = calculate_group(collector, None, [records[osm_id]])
+		state.save_way_sections(osm_id, way_sections[osm_id])
+	return route_sections, way_sections
+
+# A route name as UTF-8, which SQLite orders the routes by.
+def utf8(value):
+	if isinstance(value, unicode):
+		return value.encode('utf-8')
+	return value
+
+# Join and calculate the ways of a group from their records, answering its
+# sections. Ways in no route (key None) are calculated without joining.
+def calculate_group(collector, key, records):
+	ways = []
+	for record in records:
+		way = record.copy()
+		way.refs = list(way.refs)
+		ways.append(way)
+
+	verbose = collector.verbose
+	collector.verbose = False
+	try:
+		collector.ways = []
+		if key is None:
+			collector.ways = ways
+		else:
+			collector.join_route(key, ways)
+		collector.calculate()
+		return collector.ways
+	finally:
+		collector.verbose = verbose
+
+# The record we keep of a way parsed by the collector.
+def way_record(way):
+	record = way.copy()
+	record.refs = array.array(CoordinateStore.id_typecode, way.refs)
+	return record
+
+# Answer the groups that the collector would add a way to and its record, or
+# ([], None) if it isn't a candidate way.
+def classify_way(collector, osm_id, tags, refs):
+	if not refs:
+		return [], None
+	collector.routes = {}
+	collector.ways = []
+	collector.coords = CoordinateStore()
+	collector.ways_tag_filter(tags)
+	collector.ways_callback([(osm_id, tags, refs)])
+
+	keys = []
+	record = None
+	for key, ways in collector.routes.iteritems():
+		keys += [key] * len(ways)
+		record = way_record(ways[0])
+	if collector.ways:
+		keys.append(None)
+		record = way_record(collector.ways[0])
+	collector.routes = {}
+	collector.ways = []
+	return keys, record
+
+def open_changes(source):
+	filename = source.filename
+	if source.prefetched is not None:
+		filename = source.prefetched
+	if filename == '-':
+		return sys.stdin
+	if filename.endswith('.gz'):
+		return gzip.open(filename, 'rb')
+	if filename.endswith('.bz2'):
+		return bz2.BZ2File(filename)
+	return open(filename, 'rb')
+
+# Read an osmChange document, writing the new locations of its nodes to the
+# cache as we go. Answers the set of changed node ids and a dict of the last
+# change to each way by id as (action, tags, refs).
+def read_changes(f, nodes):
+	touched_nodes = set()
+	way_changes = {}
+	action = None
+	# The osmChange element and the action element the elements are read from,
+	# which are cleared as we go so that the elements read aren't kept.
+	root = None
+	parent = None
+	for event, elem in ElementTree.iterparse(f, events=('start', 'end')):
+		if event == 'start':
+			if root is None:
+				root = elem
+				parent = elem
+			elif elem.tag in ('create', 'modify', 'delete'):
+				action = elem.tag
+				parent = elem
+			continue
+
+		if elem.tag == 'node':
+			osm_id = int(elem.get('id'))
+			touched_nodes.add(osm_id)
+			if action == 'delete':
+				nodes.remove(osm_id)
+			else:
+				nodes.add_coords([(osm_id, float(elem.get('lon')), float(elem.get('lat')))])
+			parent.clear()
+		elif elem.tag == 'way':
+			tags = {}
+			for tag in elem.findall('tag'):
+				tags[tag.get('k')] = tag.get('v')
+			refs = [int(nd.get('ref')) for nd in elem.findall('nd')]
+			way_changes[int(elem.get('id'))] = (action, tags, refs)
+			parent.clear()
+		elif elem.tag == 'relation':
+			parent.clear()
+		elif elem.tag in ('create', 'modify', 'delete'):
+			root.clear()
+			parent = root
+	f.close()
+	return touched_nodes, way_changes
@@ -0,0 +1,155 @@
+import os
+import shutil
+import tempfile
+import subprocess
+from distutils.spawn import find_executable
+
+# Reading of compressed and piped OSM input.
+#
+# imposm.parser can only parse files named .osm, .osm.bz2 or .pbf and needs to
+# read them twice. Compressed files and standard input are instead decompressed
+# by a separate process into a named pipe that imposm reads as an .osm file, so
+# that nothing is written to disk and decompression runs alongside parsing.
+#
+# A Prefetcher can be used to decompress the next of several input files into a
+# spool directory while the current one is being calculated.
+
+# Decompression commands for each compressed extension in order of preference.
+# The parallel bzip2 implementations are much faster on multi-core machines.
+decompressors = {
+	'.bz2': (['lbzip2', '-dc'], ['pbzip2', '-dc'], ['bunzip2', '-c']),
+	'.gz': (['pigz', '-dc'], ['gzip', '-dc']),
+}
+
+# Run a command with its standard output sent to a path. The redirection is done
+# by the shell so that we don't block opening a named pipe before it has a reader.
+def spawn_to(path, command):
+	return subprocess.Popen(['sh', '-c', 'exec "$@" > "$0"', path] + command)
+
+# Answer the command that decompresses a file, or None if it isn't compressed.
+def decompressor_for(filename):
+	ext = os.path.splitext(filename)[1]
+	if ext not in decompressors:
+		return None
+	for command in decompressors[ext]:
+		if find_executable(command[0]):
+			return command
+	raise IOError('No {} decompressor found for {}. Install one of {}.'.format(ext, filename, ', '.join([c[0] for c in decompressors[ext]])))
+
+# The name of the uncompressed .osm file for an input file.
+def uncompressed_name(filename):
+	if filename == '-':
+		return 'stdin.osm'
+	name = os.path.basename(filename)
+	if os.path.splitext(name)[1] in decompressors:
+		name = os.path.splitext(name)[0]
+	if not name.endswith('.osm'):
+		name += '.osm'
+	return name
+
+# An input file: an .osm or .pbf file, an .osm.bz2 or .osm.gz file, or '-' for
+# OSM XML on standard input.
+#
+# Usage:
+#   source = OsmInput(filename)
+#   source.parse(parser)          # once for each pass over the input
+#   source.close()                # remove any temporary files
+class OsmInput(object):
+	def __init__(self, filename, prefetched=None):
+		self.filename = filename
+		# The path of a decompressed copy of the file made by a Prefetcher.
+		self.prefetched = prefetched
+		self.passes = 0
+		self.temp_dir = None
+
+	def is_stdin(self):
+		return self.filename == '-'
+
+	# Standard input can only be read once.
+	def is_rereadable(self):
+		return not self.is_stdin()
+
+	# A temporary directory that is removed when the input is closed.
+	def temp_directory(self):
+		if self.temp_dir is None:
+			self.temp_dir = tempfile.mkdtemp(prefix='curvature-')
+		return self.temp_dir
+
+	# Run an OSMParser over the input.
+	def parse(self, parser):
+		if self.passes and not self.is_rereadable():
+			raise IOError('Standard input can only be read once.')
+		self.passes += 1
+
+		if self.prefetched is not None:
+			return parser.parse(self.prefetched)
+		if self.is_stdin():
+			command = ['cat']
+		else:
+			command = decompressor_for(self.filename)
+			if command is None:
+				return parser.parse(self.filename)
+			command = command + [self.filename]
+
+		fifo = os.path.join(self.temp_directory(), uncompressed_name(self.filename))
+		if not os.path.exists(fifo):
+			os.mkfifo(fifo)
+		process = spawn_to(fifo, command)
+		try:
+			parser.parse(fifo)
+		except:
+			# The decompressor may still be blocked waiting for a reader.
+			process.kill()
+			process.wait()
+			raise
+		if process.wait():
+			raise IOError('{} exited with status {} reading {}'.format(command[0], process.returncode, self.filename))
+
+	def close(self):
+		if self.prefetched is not None and os.path.exists(self.prefetched):
+			os.remove(self.prefetched)
+		self.prefetched = None
+		if self.temp_dir is not None:
+			shutil.rmtree(self.temp_dir, ignore_errors=True)
+			self.temp_dir = None
+
+# Decompresses input files into a spool directory in the background.
+#
+# Usage:
+#   prefetcher.start(next_filename)      # while working on the current file
+#   path = prefetcher.take(filename)     # decompressed path or None
+class Prefetcher(object):
+	def __init__(self, directory):
+		self.directory = directory
+		self.fetches = {}
+
+	def start(self, filename):
+		if filename in self.fetches or filename == '-':
+			return
+		command = decompressor_for(filename)
+		if command is None:
+			return
+		path = os.path.join(self.directory, uncompressed_name(filename))
+		self.fetches[filename] = (spawn_to(path, command + [filename]), path)
+
+	# Wait for a file to be decompressed and answer its path, or None if it wasn't
+	# being prefetched.
+	def take(self, filename):
+		if filename not in self.fetches:
+			return None
+		process, path = self.fetches.pop(filename)
+		if process.wait():
+			if os.path.exists(path):
+				os.remove(path)
+			raise IOError('Decompressing {} failed with status {}'.format(filename, process.returncode))
+		return path
+
+	# Stop any fetches that are still running and remove their files.
+	def cancel(self):
+		for filename, (process, path) in self.fetches.items():
+			if process.poll() is None:
+				process.kill()
+			process.wait()
+			if os.path.exists(path):
+				os.remove(path)
+		self.fetches = {}
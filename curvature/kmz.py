@@ -0,0 +1,82 @@
+import time
+import zlib
+import struct
+
+# Streaming KMZ output.
+#
+# A KMZ file is a zip archive whose first entry, doc.kml, is the KML document.
+# zipfile in Python 2 can only add entries whose data is already complete, so
+# this writes the archive itself: the document is deflated as it is written
+# and its checksum and sizes follow it in a data descriptor, so that only the
+# compressor's buffers are held in memory however large the document is.
+#
+# Usage:
+#   f = KmzFile('vermont.c_300.kmz', level=6)
+#   f.write(u'<?xml ...')     # unicode is written as UTF-8
+#   f.close()
+
+# Write the compressed data once this much of the document is buffered.
+buffer_size = 65536
+
+class KmzFile(object):
+	name = 'doc.kml'
+
+	def __init__(self, path, level=zlib.Z_DEFAULT_COMPRESSION):
+		self.file = open(path, 'wb')
+		# Raw deflate data, without the zlib header and checksum.
+		self.compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+		self.crc = 0
+		self.size = 0
+		self.compressed_size = 0
+		self.buffer = []
+		self.buffered = 0
+		self.date_time = dos_date_time(time.localtime())
+		self.file.write(struct.pack('<IHHHHHIIIHH', 0x04034b50, 20, 0x08, 8, self.date_time[0], self.date_time[1], 0, 0, 0, len(self.name), 0))
+		self.file.write(self.name)
+
+	def write(self, data):
+		if isinstance(data, unicode):
+			data = data.encode('utf-8')
+		self.buffer.append(data)
+		self.buffered += len(data)
+		if self.buffered >= buffer_size:
+			self.flush()
+
+	def flush(self):
+		data = ''.join(self.buffer)
+		self.buffer = []
+		self.buffered = 0
+		self.crc = zlib.crc32(data, self.crc)
+		self.size += len(data)
+		self._write_compressed(self.compressor.compress(data))
+
+	def _write_compressed(self, data):
+		self.compressed_size += len(data)
+		self.file.write(data)
+
+	def close(self):
+		if self.file is None:
+			return
+		self.flush()
+		self._write_compressed(self.compressor.flush())
+		if self.size > 0xFFFFFFFF or self.compressed_size > 0xFFFFFFFF:
+			self.file.close()
+			self.file = None
+			raise IOError('The KML document is too large for a KMZ file.')
+		crc = self.crc & 0xFFFFFFFF
+
+		# The data descriptor following the data of the entry.
+		self.file.write(struct.pack('<IIII', 0x08074b50, crc, self.compressed_size, self.size))
+
+		# The central directory with the one entry and its end record.
+		directory_offset = self.file.tell()
+		self.file.write(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, 20, 20, 0x08, 8, self.date_time[0], self.date_time[1], crc, self.compressed_size, self.size, len(self.name), 0, 0, 0, 0, 0, 0))
+		self.file.write(self.name)
+		directory_size = self.file.tell() - directory_offset
+		self.file.write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, 1, 1, directory_size, directory_offset, 0))
+		self.file.close()
+		self.file = None
+
+# The MS-DOS (time, date) of a time.struct_time as used in zip headers.
+def dos_date_time(t):
+	return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
@@ -0,0 +1,193 @@
+import os
+import sys
+import json
+import time
+import resource
+import threading
+
+# Instrumentation of the phases of a run.
+#
+# Each phase (e.g. parsing ways, loading coordinates, joining, calculating and
+# writing output) is timed with a Metrics object, which records the wall time,
+# CPU time and number of calls of each phase, the peak resident memory at its
+# end and counts of the items it handled, such as ways or coordinates. A phase
+# that runs several times, e.g. once for each input file or tile, accumulates
+# its totals. The metrics of a run can be written as JSON, with the throughput
+# of each count per second of wall time.
+#
+# With a profile directory, each phase is also run under cProfile and its
+# statistics are written to <directory>/<phase>.prof (with any ':' in its name
+# as '_'), for use with pstats or snakeviz.
+#
+# Progress reports run in a thread of their own every few seconds, so counting
+# the items of a phase only costs an increment.
+#
+# Usage:
+#   metrics = Metrics()
+#   with metrics.phase('join_ways') as phase:
+#       ...
+#       phase.count('routes', len(routes))
+#   metrics.write('metrics.json')
+
+# Peak resident memory of this process in MB. ru_maxrss is reported in bytes
+# on Mac OS X and in kilobytes on Linux.
+def peak_memory_mb():
+	maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	if sys.platform == 'darwin':
+		return maxrss / 1048576.0
+	return maxrss / 1024.0
+
+# The user and system CPU time of this process.
+def cpu_seconds():
+	times = os.times()
+	return times[0] + times[1]
+
+class Metrics(object):
+	def __init__(self, profile_dir=None):
+		self.profile_dir = profile_dir
+		# The totals of each phase by name, in the order they first ran.
+		self.phases = {}
+		self.order = []
+		self.profiles = {}
+		# The phase being profiled. Phases within it aren't profiled separately.
+		self.profiling = None
+
+	def phase(self, name):
+		return Phase(self, name)
+
+	def record(self, name):
+		if name not in self.phases:
+			self.phases[name] = {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'peak_memory_mb': 0.0, 'counts': {}}
+			self.order.append(name)
+		return self.phases[name]
+
+	# Add the totals of another run's metrics, e.g. from a worker process.
+	def merge(self, phases):
+		for name, other in sorted(phases.items(), key=lambda item: item[1].get('order', 0)):
+			record = self.record(name)
+			record['calls'] += other['calls']
+			record['wall_seconds'] += other['wall_seconds']
+			record['cpu_seconds'] += other['cpu_seconds']
+			record['peak_memory_mb'] = max(record['peak_memory_mb'], other['peak_memory_mb'])
+			for key, value in other['counts'].iteritems():
+				record['counts'][key] = record['counts'].get(key, 0) + value
+
+	# The metrics of each phase with the throughput of its counts.
+	def to_dict(self):
+		phases = {}
+		for i, name in enumerate(self.order):
+			record = dict(self.phases[name])
+			record['order'] = i
+			record['counts'] = dict(record['counts'])
+			record['throughput'] = {}
+			if record['wall_seconds'] > 0:
+				for key, value in record['counts'].iteritems():
+					record['throughput'][key + '_per_second'] = value / record['wall_seconds']
+			phases[name] = record
+		return phases
+
+	def write(self, path):
+		data = {'phases': self.to_dict(), 'peak_memory_mb': peak_memory_mb(), 'cpu_seconds': cpu_seconds()}
+		with open(path, 'w') as f:
+			json.dump(data, f, indent=2, sort_keys=True)
+			f.write('\n')
+
+	def _start_profile(self, name):
+		if self.profile_dir is None or self.profiling is not None:
+			return False
+		import cProfile
+		if name not in self.profiles:
+			self.profiles[name] = cProfile.Profile()
+		self.profiling = name
+		self.profiles[name].enable()
+		return True
+
+	def _stop_profile(self, name):
+		self.profiles[name].disable()
+		self.profiling = None
+		if not os.path.isdir(self.profile_dir):
+			os.makedirs(self.profile_dir)
+		self.profiles[name].dump_stats(os.path.join(self.profile_dir, name.replace(':', '_') + '.prof'))
+
+# A run of a phase, used as a context manager.
+class Phase(object):
+	def __init__(self, metrics, name):
+		self.metrics = metrics
+		self.name = name
+		self.counts = {}
+
+	def count(self, key, n=1):
+		self.counts[key] = self.counts.get(key, 0) + n
+
+	def __enter__(self):
+		self.profiled = self.metrics._start_profile(self.name)
+		self.start_wall = time.time()
+		self.start_cpu = cpu_seconds()
+		return self
+
+	def __exit__(self, type, value, traceback):
+		wall = time.time() - self.start_wall
+		cpu = cpu_seconds() - self.start_cpu
+		if self.profiled:
+			self.metrics._stop_profile(self.name)
+		record = self.metrics.record(self.name)
+		record['calls'] += 1
+		record['wall_seconds'] += wall
+		record['cpu_seconds'] += cpu
+		record['peak_memory_mb'] = max(record['peak_memory_mb'], peak_memory_mb())
+		for key, value in self.counts.iteritems():
+			record['counts'][key] = record['counts'].get(key, 0) + value
+		return False
+
+# Reports the progress of a phase to stderr every interval seconds from a thread
+# of its own while it runs. The phase only increments count.
+#
+# Usage:
+#   progress = Progress('Loading ways').start()
+#   ... progress.count += 1 ...
+#   progress.stop()
+class Progress(object):
+	interval = 2.0
+
+	def __init__(self, label, total=None, count=None):
+		self.label = label
+		self.total = total
+		self.count = 0
+		# A function answering the count, if not counted in self.count.
+		self.counter = count
+		self.start_time = None
+		self.stopped = threading.Event()
+		self.thread = None
+
+	def start(self):
+		self.start_time = time.time()
+		self.thread = threading.Thread(target=self._run)
+		self.thread.daemon = True
+		self.thread.start()
+		return self
+
+	def _run(self):
+		while not self.stopped.wait(self.interval):
+			self.report()
+
+	def current(self):
+		if self.counter is not None:
+			return self.counter()
+		return self.count
+
+	def report(self):
+		count = self.current()
+		seconds = time.time() - self.start_time
+		rate = count / seconds if seconds > 0 else 0
+		if self.total:
+			line = '{}: {} of {} ({:.0f}%), {:.0f}/s, {:.1f}MB'.format(self.label, count, self.total, 100.0 * count / self.total, rate, peak_memory_mb())
+		else:
+			line = '{}: {}, {:.0f}/s, {:.1f}MB'.format(self.label, count, rate, peak_memory_mb())
+		sys.stderr.write('\n' + line)
+		sys.stderr.flush()
+
+	def stop(self):
+		self.stopped.set()
+		if self.thread is not None:
+			self.thread.join()
+		self.report()
@@ -1,5 +1,31 @@
 import sys
 import math
+import bisect
+
+# The ways of a run sorted by curvature once, so that the ways of several
+# outputs can be selected from them without filtering and sorting them again.
+class SortedWays(object):
+	def __init__(self, ways):
+		self.ways = sorted(ways, key=lambda k: k.curvature)
+		self.curvatures = [way.curvature for way in self.ways]
+
+	def __len__(self):
+		return len(self.ways)
+
+	# The range of the ways within the curvature limits of a filter.
+	def window(self, filter):
+		start = 0
+		end = len(self.ways)
+		if filter.min_curvature > 0:
+			start = bisect.bisect_right(self.curvatures, filter.min_curvature)
+		if filter.max_curvature > 0:
+			end = max(start, bisect.bisect_left(self.curvatures, filter.max_curvature))
+		return start, end
+
+	# The ways that pass a filter, in order of curvature.
+	def select(self, filter):
+		start, end = self.window(filter)
+		return filter.filter_length(self.ways[start:end])
 
 class Output(object):
 	max_curvature = 0
@@ -7,16 +33,18 @@ class Output(object):
 	def __init__(self, filter):
 		self.filter = filter
 
+	# Answer the ways that pass our filter in order of curvature. ways may be a
+	# list or SortedWays shared with other outputs.
 	def filter_and_sort(self, ways):
-		# Filter out ways that are too short/long or too straight or too curvy
-		ways = self.filter.filter(ways)
+		if not isinstance(ways, SortedWays):
+			ways = SortedWays(ways)
 
-		# Sort the ways based on curvature
-		ways = sorted(ways, key=lambda k: k['curvature'])
+		# Select the ways that are not too short/long or too straight or too curvy
+		ways = ways.select(self.filter)
 
 		for way in ways:
-			if way['curvature'] > self.max_curvature:
-				self.max_curvature = way['curvature']
+			if way.curvature > self.max_curvature:
+				self.max_curvature = way.curvature
 
 		return ways
 
@@ -26,12 +54,28 @@ class TabOutput(Output):
 
 		print "Curvature	Length (mi) Distance (mi)	Id				Name  			County"
 		for way in ways:
-			print '%d	%9.2f	%9.2f	%10s	%25s	%20s' % (way['curvature'], way['length'] / 1609, way['distance'] / 1609, way['id'], way['name'], way['county'])
+			print '%d	%9.2f	%9.2f	%10s	%25s	%20s' % (way.curvature, way.length / 1609, way.distance / 1609, way.id, way.name, way.county)
 
+import os
 import codecs
 from xml.sax.saxutils import escape
+from curvature.kmz import KmzFile
+from curvature.regionate import RegionatedKmlOutput
+from curvature import simplify
 class KmlOutput(Output):
 	units = 'mi'
+	# The zlib compression level (0-9) to write a KMZ file with, or None to write
+	# a KML file.
+	kmz_level = None
+	# The tolerance in meters to simplify the lines of ways to, or 0 to write all
+	# of their points.
+	simplify_tolerance = 0
+	# Keep the points where the level of segments changes when simplifying.
+	keep_runs = False
+	# The number of points of the ways written and of those removed by
+	# simplification.
+	points_total = 0
+	points_removed = 0
 
 	def _write_header(self, f):
 		self._write_doc_start(f)
@@ -76,10 +120,8 @@ class KmlOutput(Output):
 		return ''
 
 	def _write_region(self, f, ways):
-		min_lat = ways[0]['segments'][0]['start'][0]
-		max_lat = ways[0]['segments'][0]['start'][0]
-		min_lon = ways[0]['segments'][0]['start'][1]
-		max_lon = ways[0]['segments'][0]['start'][1]
+		min_lat, min_lon = ways[0].geometry.start(0)
+		max_lat, max_lon = ways[0].geometry.start(0)
 		for way in ways:
 			way_max_lat = self.get_way_max_lat(way)
 			if way_max_lat > max_lat:
@@ -108,54 +150,52 @@ class KmlOutput(Output):
 # 		f.write('	-->\n')
 
 	def get_way_max_lat(self, way):
-		if 'max_lat' not in way:
-			self.store_way_region(way)
-		return way['max_lat']
+		return self.get_way_bounds(way)[1]
 
 	def get_way_min_lat(self, way):
-		if 'min_lat' not in way:
-			self.store_way_region(way)
-		return way['min_lat']
+		return self.get_way_bounds(way)[0]
 
 	def get_way_max_lon(self, way):
-		if 'max_lon' not in way:
-			self.store_way_region(way)
-		return way['max_lon']
+		return self.get_way_bounds(way)[3]
 
 	def get_way_min_lon(self, way):
-		if 'min_lon' not in way:
+		return self.get_way_bounds(way)[2]
+
+	# The (min_lat, max_lat, min_lon, max_lon) of a way.
+	def get_way_bounds(self, way):
+		if way.bounds is None:
 			self.store_way_region(way)
-		return way['min_lon']
+		return way.bounds
 
 	def store_way_region(self, way):
-		way['max_lat'] = way['segments'][0]['start'][0]
-		way['min_lat'] = way['segments'][0]['start'][0]
-		way['max_lon'] = way['segments'][0]['start'][1]
-		way['min_lon'] = way['segments'][0]['start'][1]
-		for segment in way['segments']:
-			if segment['end'][0] > way['max_lat']:
-				way['max_lat'] = segment['end'][0]
-			if segment['end'][0] < way['min_lat']:
-				way['min_lat'] = segment['end'][0]
-			if segment['end'][1] > way['max_lon']:
-				way['max_lon'] = segment['end'][1]
-			if segment['end'][1] < way['min_lon']:
-				way['min_lon'] = segment['end'][1]
+		way.bounds = way.geometry.bounds()
 
 	def write (self, ways, path, basename):
-		ways = self.filter_and_sort(ways)
-		ways.reverse()
+		plan = KmlOutputPlan(ways)
+		plan.add(self, path, basename)
+		plan.write()
 
-		f = codecs.open(path + '/' + self.get_filename(basename), 'w', "utf-8")
+	def _write_ways(self, f, ways):
+		self._write_ways_start(f)
+		for way in ways:
+			f.write(self.get_placemark(way))
 
-		self._write_header(f)
-		if len(ways) > 1:
-			self._write_region(f, ways)
-			self._write_ways(f, ways)
-		else:
-			sys.stderr.write('\nWarning no ways available for output into {}'.format(self.get_filename(basename)))
-		self._write_footer(f)
-		f.close()
+	# Write anything that comes before the placemarks of the ways.
+	def _write_ways_start(self, f):
+		pass
+
+	# Answer a key that is equal for two outputs if they write the same placemark
+	# for a way.
+	def placemark_key(self, way):
+		return (type(self), self.units, self.simplify_tolerance)
+
+	# Answer the way with its geometry simplified to our tolerance, counting the
+	# points removed.
+	def simplify_way(self, way):
+		self.points_total += len(way.geometry) + 1
+		way, removed = simplify.simplify_way(way, self.simplify_tolerance, self.keep_runs)
+		self.points_removed += removed
+		return way
 
 	def get_filename(self, basename):
 		filename = basename + '.c_{0:.0f}'.format(self.filter.min_curvature)
@@ -168,11 +208,23 @@ class KmlOutput(Output):
 		filename += self._filename_suffix() + '.kml'
 		return filename;
 
+	# The name of the file we write, .kmz if compressed.
+	def get_output_filename(self, basename):
+		filename = self.get_filename(basename)
+		if self.kmz_level is not None:
+			filename = os.path.splitext(filename)[0] + '.kmz'
+		return filename
+
+	def open(self, filename):
+		if self.kmz_level is not None:
+			return KmzFile(filename, self.kmz_level)
+		return codecs.open(filename, 'w', "utf-8")
+
 	def get_description(self, way):
 		if self.units == 'km':
-			return 'Curvature: %.2f\nDistance: %.2f km\nType: %s\nSurface: %s' % (way['curvature'], way['length'] / 1000, way['type'], way['surface'])
+			return 'Curvature: %.2f\nDistance: %.2f km\nType: %s\nSurface: %s' % (way.curvature, way.length / 1000, way.type, way.surface)
 		else:
-			return 'Curvature: %.2f\nDistance: %.2f mi\nType: %s\nSurface: %s' % (way['curvature'], way['length'] / 1609, way['type'], way['surface'])
+			return 'Curvature: %.2f\nDistance: %.2f mi\nType: %s\nSurface: %s' % (way.curvature, way.length / 1609, way.type, way.surface)
 
 class SingleColorKmlOutput(KmlOutput):
 
@@ -195,28 +247,30 @@ class SingleColorKmlOutput(KmlOutput):
 
 		return styles
 
-	def _write_ways(self, f, ways):
-
-		for way in ways:
-			if 'segments' not in way or not len(way['segments']):
-# 				sys.stderr.write("\nError: way has no segments: {} \n".format(way['name']))
-				continue
-			f.write('	<Placemark>\n')
-			f.write('		<styleUrl>#' + self.line_style(way) + '</styleUrl>\n')
-			f.write('		<name>' + escape(way['name']) + '</name>\n')
-			f.write('		<description>' + self.get_description(way) + '</description>\n')
-			f.write('		<LineString>\n')
-			f.write('			<tessellate>1</tessellate>\n')
-			f.write('			<coordinates>')
-			self._write_segments(f, way['segments']);
-			f.write('</coordinates>\n')
-			f.write('		</LineString>\n')
-			f.write('	</Placemark>\n')
-
-	def _write_segments(self, f, segments):
-		f.write("%.6f,%6f " %(segments[0]['start'][1], segments[0]['start'][0]))
-		for segment in segments:
-			f.write("%.6f,%6f " %(segment['end'][1], segment['end'][0]))
+	def get_placemark(self, way):
+		if way.geometry is None or not len(way.geometry):
+# 			sys.stderr.write("\nError: way has no segments: {} \n".format(way.name))
+			return ''
+		way = self.simplify_way(way)
+		return ''.join([
+			'	<Placemark>\n',
+			'		<styleUrl>#' + self.line_style(way) + '</styleUrl>\n',
+			'		<name>' + escape(way.name) + '</name>\n',
+			'		<description>' + self.get_description(way) + '</description>\n',
+			'		<LineString>\n',
+			'			<tessellate>1</tessellate>\n',
+			'			<coordinates>',
+			self._get_segments(way.geometry),
+			'</coordinates>\n',
+			'		</LineString>\n',
+			'	</Placemark>\n',
+		])
+
+	def placemark_key(self, way):
+		return super(SingleColorKmlOutput, self).placemark_key(way) + (self.line_style(way),)
+
+	def _get_segments(self, geometry):
+		return ''.join(["%.6f,%6f " %(lon, lat) for lat, lon in geometry.points()])
 
 
 	def level_for_curvature(self, curvature):
@@ -272,7 +326,7 @@ class SingleColorKmlOutput(KmlOutput):
 		return level
 
 	def line_style(self, way):
-		return 'lineStyle{}'.format(self.level_for_curvature(way['curvature']))
+		return 'lineStyle{}'.format(self.level_for_curvature(way.curvature))
 
 class ReducedPointsSingleColorKmlOutput(SingleColorKmlOutput):
 	num_points = 2
@@ -283,67 +337,78 @@ class ReducedPointsSingleColorKmlOutput(SingleColorKmlOutput):
 		if num_points > self.num_points:
 			self.num_points = num_points
 
-	def _write_segments(self, f, segments):
-		num_segments = len(segments)
+	def placemark_key(self, way):
+		return super(ReducedPointsSingleColorKmlOutput, self).placemark_key(way) + (self.num_points,)
+
+	def _get_segments(self, geometry):
+		num_segments = len(geometry)
 		interval = math.ceil((num_segments) / (self.num_points - 1))
 
 		# write the first point
-		f.write("%.6f,%6f " %(segments[0]['start'][1], segments[0]['start'][0]))
+		start = geometry.start(0)
+		points = ["%.6f,%6f " %(start[1], start[0])]
 
-		i = 0
 		j = 0
-		for segment in segments:
-			i = i + 1
+		for i in xrange(num_segments):
 			j = j + 1
 
 			# Print the last of the interval, plus the last
-			if j == interval or i == num_segments:
-				f.write("%.6f,%6f " %(segment['end'][1], segment['end'][0]))
+			if j == interval or i + 1 == num_segments:
+				end = geometry.end(i)
+				points.append("%.6f,%6f " %(end[1], end[0]))
 				j = 0
+		return ''.join(points)
 
 class MultiColorKmlOutput(KmlOutput):
+	keep_runs = True
+
 	def _filename_suffix(self):
 		return '.multicolor'
 
-	def _write_ways(self, f, ways):
+	def _write_ways_start(self, f):
 		f.write('	<Style id="folderStyle">\n')
 		f.write('		<ListStyle>\n')
 		f.write('			<listItemType>checkHideChildren</listItemType>\n')
 		f.write('		</ListStyle>\n')
 		f.write('	</Style>\n')
 
-		for way in ways:
-			f.write('	<Folder>\n')
-			f.write('		<styleUrl>#folderStyle</styleUrl>\n')
-			f.write('		<name>' + escape(way['name']) + '</name>\n')
-			f.write('		<description>' + self.get_description(way) + '</description>\n')
-			current_curvature_level = 0
-			i = 0
-			for segment in way['segments']:
-				if segment['curvature_level'] != current_curvature_level or not i:
-					current_curvature_level = segment['curvature_level']
-					# Close the open LineString
-					if i:
-						f.write('</coordinates>\n')
-						f.write('			</LineString>\n')
-						f.write('		</Placemark>\n')
-					# Start a new linestring for this level
-					f.write('		<Placemark>\n')
-					if 'eliminated' in segment:
-						f.write('			<styleUrl>#elminiated</styleUrl>\n')
-					else:
-						f.write('			<styleUrl>#lineStyle%d</styleUrl>\n' % (current_curvature_level))
-					f.write('			<LineString>\n')
-					f.write('				<tessellate>1</tessellate>\n')
-					f.write('				<coordinates>')
-					f.write("%.6f,%6f " %(segment['start'][1], segment['start'][0]))
-				f.write("%.6f,%6f " %(segment['end'][1], segment['end'][0]))
-				i = i + 1
-			if i:
-				f.write('</coordinates>\n')
-				f.write('			</LineString>\n')
-				f.write('		</Placemark>\n')
-			f.write('	</Folder>\n')
+	def get_placemark(self, way):
+		way = self.simplify_way(way)
+		parts = []
+		write = parts.append
+		write('	<Folder>\n')
+		write('		<styleUrl>#folderStyle</styleUrl>\n')
+		write('		<name>' + escape(way.name) + '</name>\n')
+		write('		<description>' + self.get_description(way) + '</description>\n')
+		geometry = way.geometry
+		current_curvature_level = 0
+		for i in xrange(len(geometry)):
+			if geometry.level(i) != current_curvature_level or not i:
+				current_curvature_level = geometry.level(i)
+				# Close the open LineString
+				if i:
+					write('</coordinates>\n')
+					write('			</LineString>\n')
+					write('		</Placemark>\n')
+				# Start a new linestring for this level
+				write('		<Placemark>\n')
+				if geometry.is_eliminated(i):
+					write('			<styleUrl>#elminiated</styleUrl>\n')
+				else:
+					write('			<styleUrl>#lineStyle%d</styleUrl>\n' % (current_curvature_level))
+				write('			<LineString>\n')
+				write('				<tessellate>1</tessellate>\n')
+				write('				<coordinates>')
+				start = geometry.start(i)
+				write("%.6f,%6f " %(start[1], start[0]))
+			end = geometry.end(i)
+			write("%.6f,%6f " %(end[1], end[0]))
+		if len(geometry):
+			write('</coordinates>\n')
+			write('			</LineString>\n')
+			write('		</Placemark>\n')
+		write('	</Folder>\n')
+		return ''.join(parts)
 
 class SurfaceKmlOutput(SingleColorKmlOutput):
 	def __init__(self, filter):
@@ -379,7 +444,7 @@ class SurfaceKmlOutput(SingleColorKmlOutput):
 		}
 
 	def line_style(self, way):
-		return way['surface']
+		return way.surface
 
 	def get_filename(self, basename):
 		filename = basename + '.surfaces'
@@ -391,4 +456,80 @@ class SurfaceKmlOutput(SingleColorKmlOutput):
 		return filename;
 
 	def get_description(self, way):
-		return 'Type: %s\nSurface: %s' % (way['type'], way['surface'])
+		return 'Type: %s\nSurface: %s' % (way.type, way.surface)
+
+# Writes several KML outputs of the same ways in a single walk over them.
+#
+# The ways are sorted by curvature once and each output selects its ways from
+# that ordering, bisecting for its curvature limits. The placemarks of all of
+# the outputs are then written way by way, and a placemark that is the same in
+# several outputs is only serialized once. Regionated outputs write trees of
+# files of their own from the same sorted ways.
+#
+# Usage:
+#   plan = KmlOutputPlan(ways)
+#   plan.add(kml, path, basename)      # for each output
+#   plan.write()
+class KmlOutputPlan(object):
+	def __init__(self, ways):
+		if not isinstance(ways, SortedWays):
+			ways = SortedWays(ways)
+		self.ways = ways
+		self.outputs = []
+
+	def add(self, output, path, basename):
+		self.outputs.append((output, path, basename))
+
+	def write(self):
+		# The files being written and the ways of each, from the most curvy.
+		targets = []
+		# An output replaces any earlier one written to the same file.
+		filenames = {}
+		for i, (output, path, basename) in enumerate(self.outputs):
+			if isinstance(output, RegionatedKmlOutput):
+				output.write(self.ways, path, basename)
+				continue
+			filenames[path + '/' + output.get_output_filename(basename)] = i
+		try:
+			for filename, i in sorted(filenames.items(), key=lambda item: item[1]):
+				output, path, basename = self.outputs[i]
+				ways = output.filter_and_sort(self.ways)
+				ways.reverse()
+				f = output.open(filename)
+				output._write_header(f)
+				if len(ways) > 1:
+					output._write_region(f, ways)
+					output._write_ways_start(f)
+					targets.append((output, f, ways, filename))
+				else:
+					sys.stderr.write('\nWarning no ways available for output into {}'.format(output.get_output_filename(basename)))
+					output._write_footer(f)
+					f.close()
+
+			# The ways of each output are in the same order as the shared ways, so
+			# walk them together with the position of the next way of each output.
+			positions = [0] * len(targets)
+			for way in reversed(self.ways.ways):
+				placemarks = {}
+				for i, (output, f, ways, filename) in enumerate(targets):
+					if positions[i] < len(ways) and ways[positions[i]] is way:
+						positions[i] += 1
+						key = output.placemark_key(way)
+						if key in placemarks:
+							placemark, total, removed = placemarks[key]
+							output.points_total += total
+							output.points_removed += removed
+						else:
+							total = output.points_total
+							removed = output.points_removed
+							placemark = output.get_placemark(way)
+							placemarks[key] = (placemark, output.points_total - total, output.points_removed - removed)
+						f.write(placemark)
+
+			for output, f, ways, filename in targets:
+				output._write_footer(f)
+				if output.simplify_tolerance:
+					sys.stderr.write('\nSimplified {}: removed {} of {} points'.format(os.path.basename(filename), output.points_removed, output.points_total))
+		finally:
+			for output, f, ways, filename in targets:
+				f.close()
@@ -0,0 +1,278 @@
+import os
+import sys
+import math
+import shutil
+import marshal
+from imposm.parser import OSMParser
+from curvature.coordinates import CoordinateStore, FlatNodesCache
+from curvature.input import OsmInput, uncompressed_name
+from curvature import results
+from curvature.metrics import Progress
+from curvature.way import Way
+
+# Tile-partitioned processing of inputs too large to hold in memory at once.
+#
+# Rather than keeping every way of the input in memory, the input is processed
+# in three steps that only keep a part of it in memory at a time:
+#
+#   1. The input is parsed once. Every node is written to a flat-nodes cache and
+#      the candidate ways of each route group (a route ref or name whose ways are
+#      joined together) are written to a spool file as they are parsed.
+#   2. Each route group is assigned to the geographic tile of the first node of
+#      its first way, and its ways are written to the spool file of that tile.
+#      The node references of every route group are counted first, so a route
+#      group that would take a tile over its memory budget starts a new one and
+#      dense areas are split further. A route group larger than the budget on
+#      its own gets a tile of its own, with a warning.
+#   3. Each tile is loaded, joined and calculated on its own with node locations
+#      read from the cache, and its sections that pass the filter (if any) are
+#      saved to a results file.
+#
+# All of the ways of a route group are in the same tile, so routes that cross
+# tile borders are joined just as they would be in a single pass. The results
+# of the tiles are then merged for output. Give the partitioner the loosest
+# filter of the outputs, so that only the sections that some output writes are
+# kept for the merge.
+#
+# Each way is spooled separately for each of its routes, so ways with several
+# route refs (e.g. "US 2;VT 100") are joined from their own copies of their refs.
+# A single pass shares the refs between the routes and the join of one route
+# modifies them, so the results of those ways can differ slightly.
+#
+# Usage:
+#   partitioner = TilePartitioner('work/', tile_size=10, memory_mb=2048, filter=filter)
+#   partitioner.load_file(collector, 'north-america.osm.bz2')
+
+class TilePartitioner(object):
+	# A rough estimate of the memory used while calculating per node reference:
+	# the coordinate store, the refs of the ways and the calculated geometry.
+	bytes_per_ref = 120
+
+	# Flush the spooled ways of the tiles after buffering this many bytes.
+	spool_buffer_size = 64 * 1048576
+
+	def __init__(self, directory, tile_size=10, memory_mb=2048, filter=None):
+		self.directory = directory
+		self.tile_size = tile_size
+		self.memory_mb = memory_mb
+		self.filter = filter
+
+	# The maximum number of node references to put in a tile.
+	def max_refs(self):
+		return int(self.memory_mb * 1048576 / self.bytes_per_ref)
+
+	# Load and calculate an input file one tile at a time, leaving the sections of
+	# every tile in collector.ways.
+	def load_file(self, collector, filename):
+		work = os.path.join(self.directory, os.path.splitext(uncompressed_name(filename))[0])
+		if not os.path.isdir(work):
+			os.makedirs(work)
+		if collector.flat_nodes is not None:
+			cache = FlatNodesCache.for_source(collector.flat_nodes, filename)
+		else:
+			cache = FlatNodesCache(os.path.join(work, 'nodes'))
+
+		prefetched = None
+		if collector.prefetcher is not None:
+			prefetched = collector.prefetcher.take(filename)
+		source = OsmInput(filename, prefetched)
+		try:
+			spool = os.path.join(work, 'ways.spool')
+			strings = self.spool_ways(collector, source, cache, spool)
+			tiles = self.assign_tiles(collector, cache, spool, work)
+			os.remove(spool)
+
+			verbose = collector.verbose
+			for i, (tile, path) in enumerate(tiles):
+				if verbose:
+					sys.stderr.write("\nCalculating tile {} of {}, {}".format(i + 1, len(tiles), tile))
+					sys.stderr.flush()
+				collector.verbose = False
+				try:
+					sections = self.calculate_tile(collector, cache, path, strings)
+				finally:
+					collector.verbose = verbose
+				if self.filter is not None:
+					sections = self.filter.filter(sections)
+				results.save(path + results.extension, sections)
+				os.remove(path)
+				collector.reset()
+
+			# Merge the results of all of the tiles.
+			collector.reset()
+			for tile, path in tiles:
+				collector.ways += results.load(path + results.extension)
+		finally:
+			source.close()
+			shutil.rmtree(work, ignore_errors=True)
+
+	# Parse the input, writing each candidate way with its route to the spool file
+	# and building the flat-nodes cache if needed. Answers the table of the
+	# string codes of the spooled ways.
+	def spool_ways(self, collector, source, cache, path):
+		collector.reset()
+		spool = open(path, 'wb')
+
+		# Drain the ways parsed into the collector after each batch.
+		def ways_callback(ways):
+			collector.coords = CoordinateStore()
+			collector.ways_callback(ways)
+			for route, route_ways in collector.routes.iteritems():
+				for way in route_ways:
+					marshal.dump((route, way.to_tuple()), spool)
+			for way in collector.ways:
+				marshal.dump((None, way.to_tuple()), spool)
+			collector.routes = {}
+			collector.ways = []
+
+		with collector.metrics.phase('spool_ways') as phase:
+			progress = Progress('Ways spooled', count=lambda: collector.num_ways)
+			if collector.verbose:
+				sys.stderr.write("\nSpooling ways")
+				progress.start()
+			if cache.is_current(source.filename):
+				p = OSMParser(concurrency=collector.parser_concurrency, ways_callback=ways_callback, ways_tag_filter=collector.ways_tag_filter)
+				source.parse(p)
+			else:
+				if collector.verbose:
+					sys.stderr.write("\nBuilding the flat-nodes cache {}".format(cache.path))
+				cache.open_for_writing()
+				p = OSMParser(concurrency=collector.parser_concurrency, ways_callback=ways_callback, ways_tag_filter=collector.ways_tag_filter, coords_callback=cache.add_coords)
+				source.parse(p)
+				cache.finish(source.filename)
+			if collector.verbose:
+				progress.stop()
+			phase.count('ways', collector.num_ways)
+		spool.close()
+		strings = collector.strings
+		collector.reset()
+		return strings
+
+	# The tile of a location. Ways whose first node is unknown go to tile None.
+	def tile_of(self, coord):
+		if coord is None:
+			return None
+		lat, lon = coord
+		return (int(math.floor(lat / self.tile_size)), int(math.floor(lon / self.tile_size)))
+
+	# Distribute the spooled ways to the tiles of their routes, answering the
+	# (tile, spool path) of each tile.
+	def assign_tiles(self, collector, cache, path, work):
+		max_refs = self.max_refs()
+		cache.open_for_reading()
+
+		# Count the references of each route and find its area, so that each route
+		# is put in a tile with room for all of its ways.
+		routes = []
+		route_areas = {}
+		route_refs = {}
+		for route, fields in self.read_spool(path):
+			if route is None:
+				continue
+			refs = fields[-1]
+			if route not in route_refs:
+				routes.append(route)
+				route_areas[route] = self.tile_of(cache.get(refs[0]))
+				route_refs[route] = 0
+			route_refs[route] += len(refs)
+
+		# The tile of each route and the number of references in each tile.
+		route_tiles = {}
+		tile_refs = {}
+		# The current tile of each geographic tile that routes are added to.
+		current = {}
+		for route in routes:
+			route_tiles[route] = self.add_to_tile(route_areas[route], route_refs[route], current, tile_refs, max_refs)
+		del routes, route_areas, route_refs
+
+		buffers = {}
+		buffered = 0
+		for route, fields in self.read_spool(path):
+			refs = fields[-1]
+			if route is None:
+				tile = self.add_to_tile(self.tile_of(cache.get(refs[0])), len(refs), current, tile_refs, max_refs)
+			else:
+				tile = route_tiles[route]
+			data = marshal.dumps((route, fields))
+			if tile not in buffers:
+				buffers[tile] = []
+			buffers[tile].append(data)
+			buffered += len(data)
+			if buffered >= self.spool_buffer_size:
+				self.flush_tiles(buffers, work)
+				buffered = 0
+		cache.close()
+		self.flush_tiles(buffers, work)
+
+		if collector.verbose:
+			sys.stderr.write("\n{} routes assigned to {} tiles".format(len(route_tiles), len(tile_refs)))
+			sys.stderr.flush()
+		over = [refs for refs in tile_refs.itervalues() if refs > max_refs]
+		if over:
+			sys.stderr.write("\nWarning: {} tiles hold a route too large for --tile_memory {}, the largest with {} node references ({} fit).".format(len(over), self.memory_mb, max(over), max_refs))
+			sys.stderr.flush()
+		return [(tile, self.tile_path(work, tile)) for tile in sorted(tile_refs)]
+
+	# Add a number of references to the current tile of an area, starting a new
+	# tile if they would take it over max_refs, and answer the tile.
+	def add_to_tile(self, area, refs, current, tile_refs, max_refs):
+		tile = current.get(area, (area, 0))
+		if tile in tile_refs and tile_refs[tile] + refs > max_refs:
+			tile = (area, tile[1] + 1)
+		current[area] = tile
+		tile_refs[tile] = tile_refs.get(tile, 0) + refs
+		return tile
+
+	# The (route, way fields) of each way in a spool file.
+	def read_spool(self, path):
+		with open(path, 'rb') as spool:
+			while True:
+				try:
+					yield marshal.load(spool)
+				except EOFError:
+					break
+
+	def tile_path(self, work, tile):
+		area, part = tile
+		if area is None:
+			return os.path.join(work, 'tile_unknown_{}.spool'.format(part))
+		return os.path.join(work, 'tile_{}_{}_{}.spool'.format(area[0], area[1], part))
+
+	def flush_tiles(self, buffers, work):
+		for tile, data in buffers.iteritems():
+			with open(self.tile_path(work, tile), 'ab') as f:
+				f.write(''.join(data))
+		buffers.clear()
+
+	# Join and calculate the routes of a tile with string codes in a table,
+	# answering its sections.
+	def calculate_tile(self, collector, cache, path, strings):
+		collector.reset()
+		routes = {}
+		ways = []
+		collector.coords = CoordinateStore()
+		for route, fields in self.read_spool(path):
+			way = Way.from_tuple(fields, strings)
+			if route is None:
+				ways.append(way)
+			else:
+				if route not in routes:
+					routes[route] = []
+				routes[route].append(way)
+			collector.coords.add_refs(way.refs)
+		collector.coords.index()
+		with collector.metrics.phase('coords') as phase:
+			collector.load_cached_coords(cache)
+			phase.count('coordinates', collector.coords.num_loaded)
+
+		collector.routes = routes
+		collector.ways = ways
+		with collector.metrics.phase('join_ways') as phase:
+			phase.count('routes', len(routes))
+			collector.join_ways()
+			phase.count('ways', len(collector.ways))
+		with collector.metrics.phase('calculate') as phase:
+			phase.count('ways', len(collector.ways))
+			collector.calculate()
+			phase.count('sections', len(collector.ways))
+		return collector.ways
@@ -0,0 +1,184 @@
+import os
+import sys
+import math
+from curvature.simplify import simplify_way, rad_earth_m
+
+# Regionated KML output for browsing large areas.
+#
+# Rather than a single KML file of every way, the ways are written to a
+# quadtree of KML files. Each tile holds the most curvy of the ways centered in
+# it that are not already in a coarser tile, up to a maximum number, and links
+# to the files of its four quarters with NetworkLinks. Each link has a Region
+# with a Lod, so Google Earth only loads a tile once it is large enough on the
+# screen. Zoomed out, only the most curvy ways of the whole area are loaded,
+# and more detail is loaded for the parts of it that are zoomed in to.
+#
+# The ways of a tile that has quarters are simplified for the size of the tile,
+# to a tolerance of a pixel at detail_zoom times the size at which the tile is
+# loaded. The ways of tiles without quarters are only simplified as the output
+# itself simplifies them.
+#
+# The root tile is written to the usual file name of the output and the rest to
+# a directory next to it. When the output is KMZ, each tile is a KMZ file of
+# its own, linked to relative to the directory of the file rather than the
+# inside of the archive.
+#
+# Usage:
+#   output = RegionatedKmlOutput(MultiColorKmlOutput(filter), max_ways=100)
+#   output.write(ways, path, basename)
+
+class RegionatedKmlOutput(object):
+	# Load a tile once its region is this many pixels across.
+	min_lod_pixels = 128
+
+	# Keep the points of simplified ways that are a pixel apart when the tile is
+	# zoomed in this many times from when it is loaded.
+	detail_zoom = 16
+
+	# The maximum depth of the tree. The deepest tiles hold all of their ways.
+	max_depth = 12
+
+	def __init__(self, output, max_ways=100):
+		self.output = output
+		self.max_ways = max_ways
+
+	def write(self, ways, path, basename):
+		output = self.output
+		ways = output.filter_and_sort(ways)
+		ways.reverse()
+
+		filename = output.get_output_filename(basename)
+		if len(ways) <= 1:
+			sys.stderr.write('\nWarning no ways available for output into {}'.format(filename))
+			f = output.open(os.path.join(path, filename))
+			output._write_header(f)
+			output._write_footer(f)
+			f.close()
+			return
+
+		# Tile files go in a directory named after the root file.
+		directory = os.path.splitext(filename)[0] + '_tiles'
+		if not os.path.isdir(os.path.join(path, directory)):
+			os.makedirs(os.path.join(path, directory))
+
+		min_lat = min([output.get_way_min_lat(way) for way in ways])
+		max_lat = max([output.get_way_max_lat(way) for way in ways])
+		min_lon = min([output.get_way_min_lon(way) for way in ways])
+		max_lon = max([output.get_way_max_lon(way) for way in ways])
+		root = Tile('0', (max_lat, min_lat, max_lon, min_lon), 0)
+		self.write_tile(root, ways, os.path.join(path, filename), directory + '/')
+		if output.points_removed:
+			sys.stderr.write('\nSimplified {}: removed {} of {} points'.format(filename, output.points_removed, output.points_total))
+
+	# Write a tile with the most curvy of its ways and then its quarters with the
+	# rest. href_prefix is the path of the tile directory from the tile's file.
+	def write_tile(self, tile, ways, path, href_prefix):
+		output = self.output
+		if tile.depth < self.max_depth:
+			tile_ways = ways[:self.max_ways]
+			quarters = tile.split(ways[self.max_ways:], output)
+		else:
+			tile_ways = ways
+			quarters = []
+
+		f = output.open(path)
+		output._write_doc_start(f)
+		if tile.depth:
+			self._write_region(f, tile)
+		output._write_styles(f, output.get_styles())
+		output._write_ways_start(f)
+		for quarter, quarter_ways in quarters:
+			self._write_link(f, quarter, href_prefix)
+		if quarters:
+			tolerance = math.radians(tile.span()) * rad_earth_m / (self.min_lod_pixels * self.detail_zoom)
+		else:
+			tolerance = 0
+		for way in tile_ways:
+			way, removed = simplify_way(way, tolerance, output.keep_runs)
+			# The output counts the points that are left of the way, so add those we
+			# removed to both of its counts.
+			output.points_total += removed
+			output.points_removed += removed
+			f.write(output.get_placemark(way))
+		output._write_footer(f)
+		f.close()
+
+		directory = os.path.dirname(path)
+		if not tile.depth:
+			directory = os.path.join(directory, href_prefix)
+		for quarter, quarter_ways in quarters:
+			self.write_tile(quarter, quarter_ways, os.path.join(directory, self.tile_filename(quarter)), '')
+
+	def tile_filename(self, tile):
+		if self.output.kmz_level is not None:
+			return tile.id + '.kmz'
+		return tile.id + '.kml'
+
+	def _write_region(self, f, tile, indent='	'):
+		north, south, east, west = tile.box
+		f.write(indent + '<Region>\n')
+		f.write(indent + '	<LatLonAltBox>\n')
+		f.write(indent + '		<north>%.6f</north>\n' % (north))
+		f.write(indent + '		<south>%.6f</south>\n' % (south))
+		f.write(indent + '		<east>%.6f</east>\n' % (east))
+		f.write(indent + '		<west>%.6f</west>\n' % (west))
+		f.write(indent + '	</LatLonAltBox>\n')
+		f.write(indent + '	<Lod>\n')
+		f.write(indent + '		<minLodPixels>%d</minLodPixels>\n' % (self.min_lod_pixels))
+		f.write(indent + '		<maxLodPixels>-1</maxLodPixels>\n')
+		f.write(indent + '	</Lod>\n')
+		f.write(indent + '</Region>\n')
+
+	def _write_link(self, f, tile, href_prefix):
+		f.write('	<NetworkLink>\n')
+		f.write('		<name>' + tile.id + '</name>\n')
+		self._write_region(f, tile, '		')
+		f.write('		<Link>\n')
+		if self.output.kmz_level is not None:
+			href_prefix = '../' + href_prefix
+		f.write('			<href>' + href_prefix + self.tile_filename(tile) + '</href>\n')
+		f.write('			<viewRefreshMode>onRegion</viewRefreshMode>\n')
+		f.write('		</Link>\n')
+		f.write('	</NetworkLink>\n')
+
+# A tile of the quadtree. Its id is that of its parent followed by the number
+# of the quarter it is.
+class Tile(object):
+	def __init__(self, id, box, depth):
+		self.id = id
+		# (north, south, east, west)
+		self.box = box
+		self.depth = depth
+
+	# The larger of the height and width of the tile in degrees.
+	def span(self):
+		north, south, east, west = self.box
+		return max(north - south, east - west)
+
+	# Divide ways among the quarters of the tile by their centers, answering each
+	# quarter that has ways with its ways in the same order.
+	def split(self, ways, output):
+		north, south, east, west = self.box
+		middle_lat = (north + south) / 2
+		middle_lon = (east + west) / 2
+		boxes = (
+			(north, middle_lat, middle_lon, west),
+			(north, middle_lat, east, middle_lon),
+			(middle_lat, south, middle_lon, west),
+			(middle_lat, south, east, middle_lon),
+		)
+		quarter_ways = ([], [], [], [])
+		for way in ways:
+			lat = (output.get_way_min_lat(way) + output.get_way_max_lat(way)) / 2
+			lon = (output.get_way_min_lon(way) + output.get_way_max_lon(way)) / 2
+			quarter = 0
+			if lat < middle_lat:
+				quarter += 2
+			if lon >= middle_lon:
+				quarter += 1
+			quarter_ways[quarter].append(way)
+		quarters = []
+		for i in range(4):
+			if quarter_ways[i]:
+				quarters.append((Tile(self.id + str(i), boxes[i], self.depth + 1), quarter_ways[i]))
+		return quarters
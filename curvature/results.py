@@ -0,0 +1,218 @@
+import sys
+import json
+import mmap
+import array
+import struct
+from curvature.geometry import WayGeometry
+from curvature.way import Way, StringTable
+
+# Binary columnar storage of calculated ways.
+#
+# A results file holds the final sections of a run so that outputs can be
+# written again with other options without re-parsing the OSM file. Its layout:
+#
+#   magic         8 bytes, 'CURVRES\0'
+#   header size   uint32, little-endian
+#   header        JSON: the number of ways and points, the byte order, any
+#                 metadata and the typecode, item size, offset and length of
+#                 each column
+#   columns       each column as a packed array starting on an 8-byte boundary
+#
+# Way columns have one entry per way: id, curvature, length, distance, offset
+# and count (the first point and the number of segments of the way in the point
+# columns) and codes into the string tables of name, type, surface and county.
+# Each string table is a column of UTF-8 data plus a column of the offsets of
+# each string in it.
+#
+# Point columns have one entry per point: lat and lon plus the segment_length,
+# radius, level and eliminated flag of the segment starting at the point. The
+# last point of a way starts no segment and has zeros in the segment columns,
+# so a way's points and segments share the same offset in every column.
+#
+# Columns can be memory-mapped directly, e.g. with numpy.frombuffer() on
+# ResultFile.buffer().
+
+magic = 'CURVRES\0'
+version = 1
+extension = '.curvature'
+
+way_columns = (('id', 'l'), ('curvature', 'd'), ('length', 'd'), ('distance', 'd'), ('offset', 'l'), ('count', 'l'))
+string_columns = ('name', 'type', 'surface', 'county')
+point_columns = (('lat', 'd'), ('lon', 'd'), ('segment_length', 'd'), ('radius', 'd'), ('level', 'b'), ('eliminated', 'b'))
+
+# Answer True if a file is a results file.
+def is_results_file(filename):
+	return filename.endswith(extension)
+
+# Write a list of calculated ways to a results file.
+def save(path, ways, metadata=None):
+	columns = {}
+	for name, typecode in way_columns + point_columns:
+		columns[name] = array.array(typecode)
+	point_count = 0
+	for way in ways:
+		geometry = way.geometry
+		first = geometry.offset
+		count = len(geometry)
+		columns['id'].append(way.id)
+		columns['curvature'].append(way.curvature)
+		columns['length'].append(way.length)
+		columns['distance'].append(way.distance)
+		columns['offset'].append(point_count)
+		columns['count'].append(count)
+		columns['lat'].extend(geometry.lats[first:first + count + 1])
+		columns['lon'].extend(geometry.lons[first:first + count + 1])
+		columns['segment_length'].extend(geometry.lengths[first:first + count])
+		columns['segment_length'].append(0.0)
+		columns['radius'].extend(geometry.radii[first:first + count])
+		columns['radius'].append(0.0)
+		columns['level'].extend(geometry.levels[first:first + count])
+		columns['level'].append(0)
+		columns['eliminated'].extend(geometry.eliminated[first:first + count])
+		columns['eliminated'].append(0)
+		point_count += count + 1
+	for name in string_columns:
+		codes, offsets, data = encode_strings([getattr(way, name) for way in ways])
+		columns[name] = codes
+		columns[name + '.offsets'] = offsets
+		columns[name + '.data'] = data
+
+	header = {'version': version, 'byteorder': sys.byteorder, 'ways': len(ways), 'points': point_count, 'metadata': metadata or {}, 'columns': {}}
+	# The column offsets depend on the size of the header, which depends on the
+	# offsets, so lay out the columns after a header size that is large enough.
+	names = sorted(columns)
+	header_size = 0
+	while True:
+		offset = align(len(magic) + 4 + header_size)
+		for name in names:
+			column = columns[name]
+			header['columns'][name] = [column.typecode, column.itemsize, offset, len(column)]
+			offset = align(offset + column.itemsize * len(column))
+		encoded = json.dumps(header, sort_keys=True)
+		if len(encoded) <= header_size:
+			break
+		header_size = len(encoded) + 64
+
+	with open(path, 'wb') as f:
+		f.write(magic)
+		f.write(struct.pack('<I', header_size))
+		f.write(encoded.ljust(header_size))
+		for name in names:
+			typecode, itemsize, offset, length = header['columns'][name]
+			f.write('\0' * (offset - f.tell()))
+			columns[name].tofile(f)
+
+def align(offset):
+	return (offset + 7) // 8 * 8
+
+# Dictionary-encode a list of strings, answering the code of each value, the
+# offsets of each distinct string in the data and the UTF-8 data.
+def encode_strings(values):
+	codes = array.array('I')
+	offsets = array.array('l', [0])
+	data = array.array('B')
+	table = {}
+	for value in values:
+		code = table.get(value)
+		if code is None:
+			code = len(table)
+			table[value] = code
+			if isinstance(value, unicode):
+				value = value.encode('utf-8')
+			data.fromstring(value)
+			offsets.append(len(data))
+		codes.append(code)
+	return codes, offsets, data
+
+# A results file, memory-mapped for reading.
+#
+# Usage:
+#   results = ResultFile(path)
+#   ways = results.ways()
+#   results.close()
+class ResultFile(object):
+	def __init__(self, path):
+		self.path = path
+		self.file = open(path, 'rb')
+		self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+		if self.map[:len(magic)] != magic:
+			raise ValueError('{} is not a curvature results file.'.format(path))
+		header_size = struct.unpack_from('<I', self.map, len(magic))[0]
+		start = len(magic) + 4
+		self.header = json.loads(self.map[start:start + header_size])
+		if self.header['version'] != version:
+			raise ValueError('{} is from an incompatible version.'.format(path))
+		self.metadata = self.header['metadata']
+
+	def __len__(self):
+		return self.header['ways']
+
+	# A read-only buffer of the bytes of a column, without copying it.
+	def buffer(self, name):
+		typecode, itemsize, offset, length = self.header['columns'][name]
+		return buffer(self.map, offset, itemsize * length)
+
+	# A copy of a column as an array.
+	def column(self, name):
+		typecode, itemsize, offset, length = self.header['columns'][name]
+		column = array.array(str(typecode))
+		if column.itemsize != itemsize:
+			raise ValueError('Column {} of {} has {}-byte items, but {}-byte items here.'.format(name, self.path, itemsize, column.itemsize))
+		column.fromstring(self.map[offset:offset + itemsize * length])
+		if self.header['byteorder'] != sys.byteorder:
+			column.byteswap()
+		return column
+
+	# The distinct strings of a string column.
+	def strings(self, name):
+		offsets = self.column(name + '.offsets')
+		data = self.column(name + '.data').tostring()
+		strings = []
+		for i in xrange(len(offsets) - 1):
+			value = data[offsets[i]:offsets[i + 1]]
+			# Like the parser, use str for ASCII values and unicode for the rest.
+			try:
+				value.decode('ascii')
+			except UnicodeDecodeError:
+				value = value.decode('utf-8')
+			strings.append(value)
+		return strings
+
+	# The ways in the file, as calculated by the collector.
+	def ways(self):
+		columns = {}
+		for name, typecode in way_columns + point_columns:
+			columns[name] = self.column(name)
+		# The codes of the strings of each string column in a table of our own.
+		table = StringTable()
+		for name in string_columns:
+			codes = [table.code(value) for value in self.strings(name)]
+			columns[name] = [codes[code] for code in self.column(name)]
+		lats = columns['lat']
+		lons = columns['lon']
+		lengths = columns['segment_length']
+		radii = columns['radius']
+		levels = columns['level']
+		eliminated = columns['eliminated']
+
+		ways = []
+		for i in xrange(len(self)):
+			way = Way.from_tuple((columns['id'][i], columns['name'][i], columns['type'][i], columns['surface'][i], columns['county'][i], None), table)
+			way.curvature = columns['curvature'][i]
+			way.length = columns['length'][i]
+			way.distance = columns['distance'][i]
+			way.geometry = WayGeometry(lats, lons, lengths, radii, levels, eliminated, columns['offset'][i], columns['count'][i])
+			ways.append(way)
+		return ways
+
+	def close(self):
+		self.map.close()
+		self.file.close()
+
+# Read the ways of a results file.
+def load(path):
+	results = ResultFile(path)
+	try:
+		return results.ways()
+	finally:
+		results.close()
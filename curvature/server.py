@@ -0,0 +1,404 @@
+import os
+import sys
+import json
+import errno
+import socket
+import math
+import time
+import shutil
+import tempfile
+import threading
+import collections
+import urlparse
+import BaseHTTPServer
+import SocketServer
+from cStringIO import StringIO
+from curvature.filter import WayFilter
+from curvature.output import SingleColorKmlOutput, MultiColorKmlOutput
+from curvature.sqlite import SqliteOutput, WayDatabase
+from curvature import results
+
+# An HTTP server answering queries for the calculated ways of a dataset.
+#
+# The dataset is a SQLite database written with --sqlite, or a results file
+# written with --save_results, which is loaded into a SQLite database in a
+# temporary directory. Either way the ways are found through the database's
+# R*Tree and curvature index and their geometry is only read for the ways
+# answered, so the server holds little of the dataset in memory.
+#
+# Requests:
+#
+#   GET /ways.geojson?bbox=west,south,east,north&...
+#   GET /ways.kml?bbox=west,south,east,north&...
+#   GET /tiles/<z>/<x>/<y>.geojson       The ways in a web map tile, e.g. for a
+#   GET /tiles/<z>/<x>/<y>.kml           tiled layer of a map frontend.
+#   GET /stats                           Request, cache and latency counters.
+#   POST /reload                         Load the dataset again.
+#
+# Ways and tiles accept these parameters, with the same meaning as the options
+# of curvature.py: min_curvature, max_curvature, min_length and max_length (in
+# miles), highway_types and surfaces (comma-separated lists), limit (at most
+# max_ways of the server) and for KML colorize=1 and km=1.
+#
+# Rendered responses are kept in an LRU cache keyed by the parsed query, so that
+# the same query asked with its parameters in another order is a hit too. The
+# cache is emptied whenever the dataset is reloaded, on POST /reload or on a
+# SIGHUP.
+#
+# The server's lock is only held to look up the cache, swap the dataset and
+# count requests, so requests are searched and rendered in parallel, each
+# thread through a database connection of its own. A dataset replaced by a
+# reload is closed (and its temporary directory removed) once the last request
+# reading it is done.
+#
+# Usage:
+#   server = WayServer(('127.0.0.1', 8000), 'vermont.c_300.sqlite')
+#   server.serve_forever()
+
+# A cache of the most recently used values, up to a maximum number of them.
+class LruCache(object):
+	def __init__(self, size):
+		self.size = size
+		self.values = collections.OrderedDict()
+
+	def get(self, key):
+		value = self.values.pop(key, None)
+		if value is not None:
+			self.values[key] = value
+		return value
+
+	def put(self, key, value):
+		if self.size <= 0:
+			return
+		self.values.pop(key, None)
+		self.values[key] = value
+		while len(self.values) > self.size:
+			self.values.popitem(last=False)
+
+	def clear(self):
+		self.values.clear()
+
+	def __len__(self):
+		return len(self.values)
+
+# Counters of the requests answered, with the latency of the most recent ones.
+class ServerStats(object):
+	# The number of recent latencies to report percentiles of.
+	window = 1000
+
+	def __init__(self):
+		self.requests = 0
+		self.errors = 0
+		self.cache_hits = 0
+		self.cache_misses = 0
+		self.total_seconds = 0.0
+		self.max_seconds = 0.0
+		self.latencies = collections.deque(maxlen=self.window)
+
+	def record(self, seconds, hit=None, error=False):
+		self.requests += 1
+		if error:
+			self.errors += 1
+		if hit is not None:
+			if hit:
+				self.cache_hits += 1
+			else:
+				self.cache_misses += 1
+		self.total_seconds += seconds
+		self.max_seconds = max(self.max_seconds, seconds)
+		self.latencies.append(seconds)
+
+	def to_dict(self):
+		lookups = self.cache_hits + self.cache_misses
+		latencies = sorted(self.latencies)
+		return {
+			'requests': self.requests,
+			'errors': self.errors,
+			'cache_hits': self.cache_hits,
+			'cache_misses': self.cache_misses,
+			'cache_hit_rate': float(self.cache_hits) / lookups if lookups else 0.0,
+			'latency_ms': {
+				'mean': 1000 * self.total_seconds / self.requests if self.requests else 0.0,
+				'max': 1000 * self.max_seconds,
+				'p50': 1000 * percentile(latencies, 0.5),
+				'p95': 1000 * percentile(latencies, 0.95),
+				'p99': 1000 * percentile(latencies, 0.99),
+			},
+		}
+
+def percentile(values, fraction):
+	if not values:
+		return 0.0
+	return values[min(len(values) - 1, int(fraction * len(values)))]
+
+# The (south, west, north, east) of a web map tile.
+def tile_box(z, x, y):
+	n = 2 ** z
+	if not 0 <= x < n or not 0 <= y < n:
+		raise ValueError('Tile {}/{}/{} does not exist.'.format(z, x, y))
+	west = x * 360.0 / n - 180
+	east = (x + 1) * 360.0 / n - 180
+	north = math.degrees(math.atan(math.sinh(math.pi * (1 - 2.0 * y / n))))
+	south = math.degrees(math.atan(math.sinh(math.pi * (1 - 2.0 * (y + 1) / n))))
+	return (south, west, north, east)
+
+# A query of the ways, parsed from the parameters of a request.
+class WayQuery(object):
+	def __init__(self, parameters, max_ways):
+		self.filter = WayFilter()
+		for name in ('min_curvature', 'max_curvature', 'min_length', 'max_length'):
+			if name in parameters:
+				setattr(self.filter, name, float(parameters[name]))
+		self.box = None
+		if 'bbox' in parameters:
+			values = parameters['bbox'].split(',')
+			if len(values) != 4:
+				raise ValueError('bbox should be west,south,east,north.')
+			west, south, east, north = [float(value) for value in values]
+			self.box = (south, west, north, east)
+		self.types = self._list(parameters, 'highway_types')
+		self.surfaces = self._list(parameters, 'surfaces')
+		self.limit = max_ways
+		if 'limit' in parameters:
+			limit = int(parameters['limit'])
+			# SQLite answers every way for a negative limit.
+			if limit < 1:
+				raise ValueError('limit should be 1 or more.')
+			self.limit = min(limit, max_ways)
+		self.colorize = parameters.get('colorize', '0') not in ('', '0')
+		self.units = 'km' if parameters.get('km', '0') not in ('', '0') else 'mi'
+
+	def _list(self, parameters, name):
+		if name not in parameters:
+			return None
+		return tuple(sorted(parameters[name].decode('utf-8').split(',')))
+
+	# A key equal for queries that answer the same response in a format.
+	def key(self, format):
+		key = (format, self.box, self.filter.min_curvature, self.filter.max_curvature, self.filter.min_length, self.filter.max_length, self.types, self.surfaces, self.limit)
+		if format == 'kml':
+			key += (self.colorize, self.units)
+		return key
+
+def render_geojson(ways):
+	features = []
+	for way in ways:
+		features.append({
+			'type': 'Feature',
+			'id': way.id,
+			'geometry': {
+				'type': 'LineString',
+				'coordinates': [[round(lon, 6), round(lat, 6)] for lat, lon in way.geometry.points()],
+			},
+			'properties': {
+				'name': way.name,
+				'type': way.type,
+				'surface': way.surface,
+				'county': way.county,
+				'curvature': way.curvature,
+				'length': way.length,
+				'distance': way.distance,
+			},
+		})
+	return json.dumps({'type': 'FeatureCollection', 'features': features}, separators=(',', ':'))
+
+def render_kml(ways, query):
+	if query.colorize:
+		output = MultiColorKmlOutput(query.filter)
+	else:
+		output = SingleColorKmlOutput(query.filter, False)
+	output.units = query.units
+	f = StringIO()
+	output._write_header(f)
+	if ways:
+		output._write_region(f, ways)
+		output._write_ways_start(f)
+		for way in ways:
+			placemark = output.get_placemark(way)
+			if isinstance(placemark, unicode):
+				placemark = placemark.encode('utf-8')
+			f.write(placemark)
+	output._write_footer(f)
+	return f.getvalue()
+
+content_types = {
+	'geojson': 'application/geo+json',
+	'kml': 'application/vnd.google-earth.kml+xml',
+	'json': 'application/json',
+}
+
+# A loaded dataset with the number of requests reading it.
+class Dataset(object):
+	def __init__(self, database, temp_dir):
+		self.database = database
+		# A temporary directory holding the database, removed along with it.
+		self.temp_dir = temp_dir
+		self.loaded_at = time.time()
+		self.readers = 0
+		# Whether the dataset has been replaced, to be removed when it has no readers.
+		self.replaced = False
+
+	def remove(self):
+		self.database.close()
+		if self.temp_dir is not None:
+			shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+class WayServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+	def __init__(self, address, path, cache_size=256, max_ways=1000, verbose=False):
+		BaseHTTPServer.HTTPServer.__init__(self, address, WayRequestHandler)
+		self.path = path
+		self.max_ways = max_ways
+		self.verbose = verbose
+		self.cache = LruCache(cache_size)
+		self.stats = ServerStats()
+		self.reloads = 0
+		# Guards the dataset, the cache and the counters, which are shared by the
+		# threads answering requests.
+		self.lock = threading.Lock()
+		self.dataset = None
+		self.reload()
+
+	# Load the dataset, replacing any loaded earlier and emptying the cache.
+	def reload(self):
+		temp_dir = None
+		if results.is_results_file(self.path):
+			temp_dir = tempfile.mkdtemp(prefix='curvature-server-')
+			ways = results.load(self.path)
+			filename = SqliteOutput(WayFilter(), {'source': self.path}).write(ways, temp_dir, 'ways')
+			del ways
+		else:
+			filename = self.path
+		dataset = Dataset(WayDatabase(filename), temp_dir)
+
+		with self.lock:
+			old = self.dataset
+			self.dataset = dataset
+			remove = False
+			if old is not None:
+				self.reloads += 1
+				old.replaced = True
+				remove = not old.readers
+			self.cache.clear()
+		if remove:
+			old.remove()
+		if self.verbose:
+			sys.stderr.write('Loaded {} ways from {}\n'.format(len(dataset.database), self.path))
+
+	# Answer the body of the response to a query, rendered or from the cache,
+	# and whether it was in the cache.
+	def answer(self, query, format):
+		key = query.key(format)
+		with self.lock:
+			body = self.cache.get(key)
+			if body is not None:
+				return body, True
+			dataset = self.dataset
+			dataset.readers += 1
+		try:
+			ways = dataset.database.query(query.box, query.filter, query.limit, query.types, query.surfaces)
+		finally:
+			# Each request has a thread and connection of its own.
+			dataset.database.close()
+			with self.lock:
+				dataset.readers -= 1
+				remove = dataset.replaced and not dataset.readers
+			if remove:
+				dataset.remove()
+		if format == 'geojson':
+			body = render_geojson(ways)
+		else:
+			body = render_kml(ways, query)
+		with self.lock:
+			# Don't cache a response from a dataset that has since been replaced.
+			if dataset is self.dataset:
+				self.cache.put(key, body)
+		return body, False
+
+	def stats_dict(self):
+		with self.lock:
+			stats = self.stats.to_dict()
+			stats['cache_size'] = len(self.cache)
+			stats['reloads'] = self.reloads
+			stats['dataset'] = {'path': self.path, 'ways': len(self.dataset.database), 'loaded_at': self.dataset.loaded_at}
+		return stats
+
+	# Clients such as map frontends drop requests that are no longer needed, e.g.
+	# for tiles panned out of view, so ignore the errors of writing to them.
+	def handle_error(self, request, client_address):
+		error = sys.exc_info()[1]
+		if isinstance(error, socket.error) and error.errno in (errno.EPIPE, errno.ECONNRESET):
+			return
+		BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+	def server_close(self):
+		BaseHTTPServer.HTTPServer.server_close(self)
+		if self.dataset is not None:
+			self.dataset.remove()
+
+class WayRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	def do_GET(self):
+		start = time.time()
+		hit = None
+		error = False
+		try:
+			url = urlparse.urlparse(self.path)
+			parameters = dict(urlparse.parse_qsl(url.query))
+			parts = url.path.strip('/').split('/')
+			if url.path == '/stats':
+				self.respond(200, 'json', json.dumps(self.server.stats_dict(), indent=2, sort_keys=True))
+				return
+			name, format = os.path.splitext(parts[-1])
+			format = format[1:]
+			if format not in ('geojson', 'kml'):
+				error = True
+				self.respond(404, 'text', 'Not found: {}\n'.format(url.path))
+				return
+			try:
+				if len(parts) == 1 and name == 'ways':
+					query = WayQuery(parameters, self.server.max_ways)
+				elif len(parts) == 4 and parts[0] == 'tiles':
+					parameters['bbox'] = '{1},{0},{3},{2}'.format(*tile_box(int(parts[1]), int(parts[2]), int(name)))
+					query = WayQuery(parameters, self.server.max_ways)
+				else:
+					error = True
+					self.respond(404, 'text', 'Not found: {}\n'.format(url.path))
+					return
+			except ValueError as e:
+				error = True
+				self.respond(400, 'text', 'Bad request: {}\n'.format(e))
+				return
+			body, hit = self.server.answer(query, format)
+			self.respond(200, format, body)
+		except Exception:
+			# Count failures to answer before they are logged by handle_error().
+			error = True
+			raise
+		finally:
+			seconds = time.time() - start
+			with self.server.lock:
+				self.server.stats.record(seconds, hit, error)
+
+	def do_POST(self):
+		if self.path != '/reload':
+			self.respond(404, 'text', 'Not found: {}\n'.format(self.path))
+			return
+		try:
+			self.server.reload()
+		except Exception as e:
+			self.respond(500, 'text', 'Reload failed: {}\n'.format(e))
+			return
+		self.respond(200, 'json', json.dumps(self.server.stats_dict()['dataset']))
+
+	def respond(self, status, format, body):
+		self.send_response(status)
+		self.send_header('Content-Type', content_types.get(format, 'text/plain; charset=utf-8'))
+		self.send_header('Content-Length', str(len(body)))
+		self.send_header('Access-Control-Allow-Origin', '*')
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		if self.server.verbose:
+			BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
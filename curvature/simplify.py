@@ -0,0 +1,91 @@
+import math
+
+# Simplification of way geometry for output.
+#
+# Lines are simplified with the Douglas-Peucker algorithm: the point farthest
+# from the line between the first and last points is kept if it is farther
+# than the tolerance, and each half is simplified in the same way. Unlike
+# keeping every Nth point, this keeps the apexes of tight curves while dropping
+# the points along straight stretches.
+#
+# Distances are measured in meters on an equirectangular projection centered
+# on the way, which is accurate to well under a meter over the length of a way.
+#
+# Usage:
+#   way, removed = simplify_way(way, 5)     # a 5 meter tolerance
+
+rad_earth_m = 6373000 # Radius of the earth in meters
+
+# Answer the indexes of the points of a geometry that are kept when simplifying
+# it to a tolerance in meters. With keep_runs, the points where the level or
+# eliminated flag of the segments changes are kept, and each run of segments
+# between them is simplified on its own, so colorized output is unchanged.
+def douglas_peucker(geometry, tolerance, keep_runs=False):
+	count = len(geometry)
+	offset = geometry.offset
+	lats = geometry.lats
+	lons = geometry.lons
+	scale = math.cos(math.radians(lats[offset])) * math.pi / 180 * rad_earth_m
+	xs = [lons[offset + i] * scale for i in xrange(count + 1)]
+	ys = [lats[offset + i] * math.pi / 180 * rad_earth_m for i in xrange(count + 1)]
+
+	anchors = [0]
+	if keep_runs:
+		levels = geometry.levels
+		eliminated = geometry.eliminated
+		for i in xrange(1, count):
+			if levels[offset + i] != levels[offset + i - 1] or eliminated[offset + i] != eliminated[offset + i - 1]:
+				anchors.append(i)
+	anchors.append(count)
+
+	keep = [False] * (count + 1)
+	for i in anchors:
+		keep[i] = True
+	limit = tolerance * tolerance
+	stack = zip(anchors[:-1], anchors[1:])
+	while stack:
+		first, last = stack.pop()
+		if last - first < 2:
+			continue
+		x1 = xs[first]
+		y1 = ys[first]
+		dx = xs[last] - x1
+		dy = ys[last] - y1
+		length_squared = dx * dx + dy * dy
+		farthest = None
+		farthest_distance = limit
+		for i in xrange(first + 1, last):
+			px = xs[i] - x1
+			py = ys[i] - y1
+			# The squared distance to the nearest point of the line segment.
+			if length_squared:
+				t = (px * dx + py * dy) / length_squared
+				if t < 0:
+					t = 0
+				elif t > 1:
+					t = 1
+				px -= t * dx
+				py -= t * dy
+			distance = px * px + py * py
+			if distance > farthest_distance:
+				farthest = i
+				farthest_distance = distance
+		if farthest is not None:
+			keep[farthest] = True
+			stack.append((first, farthest))
+			stack.append((farthest, last))
+	return [i for i in xrange(count + 1) if keep[i]]
+
+# Answer a way with its geometry simplified to a tolerance in meters and the
+# number of points removed. The way itself is answered if no points are removed.
+def simplify_way(way, tolerance, keep_runs=False):
+	geometry = way.geometry
+	if tolerance <= 0 or len(geometry) < 2:
+		return way, 0
+	indexes = douglas_peucker(geometry, tolerance, keep_runs)
+	removed = len(geometry) + 1 - len(indexes)
+	if not removed:
+		return way, 0
+	simplified = way.copy()
+	simplified.geometry = geometry.subset(indexes)
+	return simplified, removed
@@ -0,0 +1,316 @@
+import os
+import sys
+import json
+import array
+import struct
+import sqlite3
+import threading
+from curvature.output import Output
+from curvature.geometry import WayGeometry
+from curvature.way import Way, StringTable
+
+# SQLite output of calculated ways for bounding-box queries.
+#
+# The ways that pass the output's filter are written to a SQLite database with
+# these tables:
+#
+#   ways            One row per way: its OSM id, name, type, surface, county,
+#                   curvature, length, distance and bounding box, with an index
+#                   on curvature.
+#   ways_bbox       An R*Tree of the bounding box of each way, by the rowid of
+#                   its row in ways.
+#   way_geometries  The geometry of each way by the same rowid. Keeping the
+#                   geometry out of ways keeps its rows small, so that selecting
+#                   ways reads few pages.
+#   metadata        Key/value pairs describing the run: the format version, the
+#                   filter and any metadata given to the output.
+#
+# Geometry is stored as a packed little-endian blob: the number of segments as
+# a uint32, then the lats and lons of the points as doubles, the length and
+# radius of each segment as doubles and the level and eliminated flag of each
+# segment as bytes.
+#
+# The database is loaded with batched inserts in a single transaction, in the
+# Z-order of the centers of the ways so that the R*Tree is built from nearby
+# boxes, and the curvature index is built once the rows are in. It is written
+# to a temporary file which then replaces any earlier database, so readers never
+# see a partly written one.
+#
+# Usage:
+#   output = SqliteOutput(filter)
+#   output.write(ways, path, basename)
+#
+#   database = WayDatabase('vermont.c_300.sqlite')
+#   ways = database.query((south, west, north, east), filter, limit=100)
+#   database.close()
+#
+# A WayDatabase may be queried from several threads at once. Each thread reads
+# through a connection of its own, opened on its first query and closed when
+# the thread ends or calls close().
+
+version = 1
+
+way_columns = ('osm_id', 'name', 'type', 'surface', 'county', 'curvature', 'length', 'distance', 'min_lat', 'max_lat', 'min_lon', 'max_lon')
+
+schema = '''
+CREATE TABLE metadata (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE ways (
+	id INTEGER PRIMARY KEY,
+	osm_id INTEGER,
+	name TEXT,
+	type TEXT,
+	surface TEXT,
+	county TEXT,
+	curvature REAL,
+	length REAL,
+	distance REAL,
+	min_lat REAL,
+	max_lat REAL,
+	min_lon REAL,
+	max_lon REAL
+);
+CREATE TABLE way_geometries (id INTEGER PRIMARY KEY, geometry BLOB);
+CREATE VIRTUAL TABLE ways_bbox USING rtree(id, min_lat, max_lat, min_lon, max_lon);
+'''
+
+class SqliteOutput(Output):
+	# The number of rows to insert with each executemany().
+	batch_size = 10000
+
+	def __init__(self, filter, metadata=None):
+		super(SqliteOutput, self).__init__(filter)
+		self.metadata = metadata or {}
+
+	def get_filename(self, basename):
+		filename = basename + '.c_{0:.0f}'.format(self.filter.min_curvature)
+		if self.filter.max_curvature > 0:
+			filename += '-{0:.0f}'.format(self.filter.max_curvature)
+		if self.filter.min_length != 1 or self.filter.max_length > 0:
+			filename += '.l_{0:.0f}'.format(self.filter.min_length)
+		if self.filter.max_length > 0:
+			filename += '-{0:.0f}'.format(self.filter.max_length)
+		return filename + '.sqlite'
+
+	def write(self, ways, path, basename):
+		ways = self.filter_and_sort(ways)
+		filename = os.path.join(path, self.get_filename(basename))
+		temp = filename + '.tmp'
+		if os.path.exists(temp):
+			os.remove(temp)
+
+		rows = []
+		for way in ways:
+			min_lat, max_lat, min_lon, max_lon = way.geometry.bounds()
+			key = z_order((min_lat + max_lat) / 2, (min_lon + max_lon) / 2)
+			rows.append((key, way, (min_lat, max_lat, min_lon, max_lon)))
+		rows.sort(key=lambda row: row[0])
+
+		connection = sqlite3.connect(temp)
+		try:
+			connection.text_factory = str
+			# Nothing is worth syncing until the database is complete.
+			connection.execute('PRAGMA journal_mode = OFF')
+			connection.execute('PRAGMA synchronous = OFF')
+			connection.executescript(schema)
+			with connection:
+				way_rows = []
+				bbox_rows = []
+				geometry_rows = []
+				for rowid, (key, way, bounds) in enumerate(rows):
+					way_rows.append((rowid, way.id, way.name, way.type, way.surface, way.county, way.curvature, way.length, way.distance) + bounds)
+					bbox_rows.append((rowid,) + bounds)
+					geometry_rows.append((rowid, sqlite3.Binary(pack_geometry(way.geometry))))
+					if len(way_rows) >= self.batch_size:
+						self._insert(connection, way_rows, bbox_rows, geometry_rows)
+						way_rows = []
+						bbox_rows = []
+						geometry_rows = []
+				self._insert(connection, way_rows, bbox_rows, geometry_rows)
+
+				metadata = dict(self.metadata)
+				metadata.update({
+					'version': version,
+					'ways': len(rows),
+					'bounds': bounds_of([bounds for key, way, bounds in rows]),
+					'min_curvature': self.filter.min_curvature,
+					'max_curvature': self.filter.max_curvature,
+					'min_length': self.filter.min_length,
+					'max_length': self.filter.max_length,
+				})
+				connection.executemany('INSERT INTO metadata (key, value) VALUES (?, ?)', [(key, json.dumps(value)) for key, value in metadata.iteritems()])
+				connection.execute('CREATE INDEX ways_curvature ON ways (curvature)')
+			connection.execute('ANALYZE')
+		finally:
+			connection.close()
+		os.rename(temp, filename)
+		return filename
+
+	def _insert(self, connection, way_rows, bbox_rows, geometry_rows):
+		connection.executemany('INSERT INTO ways (id, {}) VALUES (?, {})'.format(', '.join(way_columns), ', '.join(['?'] * len(way_columns))), way_rows)
+		connection.executemany('INSERT INTO ways_bbox (id, min_lat, max_lat, min_lon, max_lon) VALUES (?, ?, ?, ?, ?)', bbox_rows)
+		connection.executemany('INSERT INTO way_geometries (id, geometry) VALUES (?, ?)', geometry_rows)
+
+# A database written by SqliteOutput, opened for queries.
+class WayDatabase(object):
+	def __init__(self, path):
+		self.path = path
+		# The connection of each thread.
+		self.local = threading.local()
+		self.metadata = {}
+		# The table of the strings of the ways we answer, freed with the last of them.
+		self.strings = StringTable()
+		for key, value in self.connection().execute('SELECT key, value FROM metadata'):
+			self.metadata[key] = json.loads(value)
+		# The thread opening the database may not be one that queries it.
+		self.close()
+		if self.metadata.get('version') != version:
+			raise ValueError('{} is from an incompatible version.'.format(path))
+
+	# The connection of the calling thread, opened if it has none.
+	def connection(self):
+		connection = getattr(self.local, 'connection', None)
+		if connection is None:
+			# Connecting would create an empty database in place of a missing one.
+			if not os.path.isfile(self.path):
+				raise IOError('{} does not exist.'.format(self.path))
+			connection = sqlite3.connect(self.path)
+			connection.text_factory = str
+			self.local.connection = connection
+		return connection
+
+	# Answer the ways that overlap a box of (south, west, north, east), pass a
+	# filter and have one of the highway types and surfaces given, from the most
+	# curvy, with at most limit ways if given. With no box, the ways of the whole
+	# database are answered.
+	#
+	# Ways are found either by searching the R*Tree for the box, which reads
+	# about fraction * ways rows where fraction is the part of the area of all of
+	# the ways that the box covers, or by scanning the curvature index from the
+	# most curvy until limit ways in the box are found, which reads about
+	# limit / fraction rows. The cheaper of the two is used.
+	def query(self, box=None, filter=None, limit=None, types=None, surfaces=None):
+		sql = 'SELECT {} FROM ways'.format(', '.join(['ways.id'] + ['ways.' + column for column in way_columns]))
+		conditions = []
+		parameters = []
+		if box is not None:
+			south, west, north, east = box
+			fraction = self.coverage(box)
+			if limit is not None and fraction * fraction * self.metadata['ways'] > limit:
+				table = 'ways'
+			else:
+				table = 'ways_bbox'
+				sql += ' JOIN ways_bbox ON ways_bbox.id = ways.id'
+			conditions.append('{0}.max_lat >= ? AND {0}.min_lat <= ? AND {0}.max_lon >= ? AND {0}.min_lon <= ?'.format(table))
+			parameters += [south, north, west, east]
+		if filter is not None:
+			# The same comparisons as WayFilter.
+			if filter.min_curvature > 0:
+				conditions.append('ways.curvature > ?')
+				parameters.append(filter.min_curvature)
+			if filter.max_curvature > 0:
+				conditions.append('ways.curvature < ?')
+				parameters.append(filter.max_curvature)
+			if filter.min_length > 0:
+				conditions.append('ways.length / 1609 > ?')
+				parameters.append(filter.min_length)
+			if filter.max_length > 0:
+				conditions.append('ways.length / 1609 < ?')
+				parameters.append(filter.max_length)
+		for column, values in (('type', types), ('surface', surfaces)):
+			if values is not None:
+				conditions.append('ways.{} IN ({})'.format(column, ', '.join(['?'] * len(values))))
+				parameters += [value.encode('utf-8') if isinstance(value, unicode) else value for value in values]
+		if conditions:
+			sql += ' WHERE ' + ' AND '.join(conditions)
+		sql += ' ORDER BY ways.curvature DESC'
+		if limit is not None:
+			sql += ' LIMIT ?'
+			parameters.append(limit)
+		# Read the geometry of only the ways answered, in the same query.
+		sql = 'SELECT {}, way_geometries.geometry FROM ({}) AS ways JOIN way_geometries ON way_geometries.id = ways.id ORDER BY ways.curvature DESC'.format(', '.join(['ways.' + column for column in way_columns]), sql)
+		ways = []
+		for row in self.connection().execute(sql, parameters).fetchall():
+			osm_id, name, type, surface, county, curvature, length, distance = row[:8]
+			way = Way(osm_id, decode(name), decode(type), decode(surface), decode(county), self.strings)
+			way.curvature = curvature
+			way.length = length
+			way.distance = distance
+			way.bounds = row[8:12]
+			way.geometry = unpack_geometry(row[12])
+			ways.append(way)
+		return ways
+
+	# The part of the area of the bounds of all of the ways within a box.
+	def coverage(self, box):
+		south, west, north, east = box
+		min_lat, max_lat, min_lon, max_lon = self.metadata['bounds']
+		height = min(north, max_lat) - max(south, min_lat)
+		width = min(east, max_lon) - max(west, min_lon)
+		if height <= 0 or width <= 0:
+			return 0.0
+		return height * width / (max(max_lat - min_lat, 1e-9) * max(max_lon - min_lon, 1e-9))
+
+	def __len__(self):
+		return self.metadata['ways']
+
+	# Close the connection of the calling thread.
+	def close(self):
+		connection = getattr(self.local, 'connection', None)
+		if connection is not None:
+			connection.close()
+			self.local.connection = None
+
+# Like the parser, use str for ASCII values and unicode for the rest.
+def decode(value):
+	if value is None:
+		return value
+	try:
+		value.decode('ascii')
+	except UnicodeDecodeError:
+		return value.decode('utf-8')
+	return value
+
+# The (min_lat, max_lat, min_lon, max_lon) of a list of bounds.
+def bounds_of(bounds):
+	if not bounds:
+		return [0.0, 0.0, 0.0, 0.0]
+	return [min([b[0] for b in bounds]), max([b[1] for b in bounds]), min([b[2] for b in bounds]), max([b[3] for b in bounds])]
+
+# A key that orders locations along a Z-order curve over 2^16 steps of latitude
+# and longitude.
+def z_order(lat, lon):
+	y = int((lat + 90) / 180 * 65535)
+	x = int((lon + 180) / 360 * 65535)
+	key = 0
+	for bit in xrange(16):
+		key |= ((x >> bit) & 1) << (2 * bit) | ((y >> bit) & 1) << (2 * bit + 1)
+	return key
+
+def pack_geometry(geometry):
+	first = geometry.offset
+	count = len(geometry)
+	columns = (
+		geometry.lats[first:first + count + 1],
+		geometry.lons[first:first + count + 1],
+		geometry.lengths[first:first + count],
+		geometry.radii[first:first + count],
+	)
+	if sys.byteorder != 'little':
+		for column in columns:
+			column.byteswap()
+	return struct.pack('<I', count) + ''.join([column.tostring() for column in columns]) + geometry.levels[first:first + count].tostring() + geometry.eliminated[first:first + count].tostring()
+
+def unpack_geometry(blob):
+	blob = str(blob)
+	count = struct.unpack_from('<I', blob)[0]
+	offset = 4
+	columns = []
+	for typecode, length in (('d', count + 1), ('d', count + 1), ('d', count), ('d', count), ('b', count), ('b', count)):
+		column = array.array(typecode)
+		end = offset + column.itemsize * length
+		column.fromstring(blob[offset:end])
+		if sys.byteorder != 'little' and typecode == 'd':
+			column.byteswap()
+		columns.append(column)
+		offset = end
+	return WayGeometry(*columns)
@@ -0,0 +1,205 @@
+import sys
+import copy
+import array
+import bisect
+import itertools
+from curvature.collector import WayCollector
+from curvature.geometry import WayGeometry
+from curvature.output import SortedWays
+from curvature.metrics import Progress
+
+# Parameter sweeps that score the same ways with many settings.
+#
+# The radius of each segment depends only on the geometry of a way, while the
+# level thresholds and weights and the straight segment split threshold are
+# only applied to the radii afterwards. A SweepCollector calculates the
+# distances and radii of its ways once, keeping them with the radius bucket
+# and heading of each segment and the distances to the three segments ahead
+# that deflections are checked against: 2 + 8 + 3 * 8 = 34 more bytes per
+# segment. It can then score the ways with any setting of those parameters
+# without parsing, joining or measuring them again.
+#
+# The radii of all of the settings fall into the buckets between the distinct
+# level thresholds of all of them, and every radius in a bucket has the same
+# level and weight in a setting. So the bucket of each segment is looked up
+# once and each setting only maps buckets to levels and weights through small
+# tables. Deflections are then filtered and the ways split into sections with
+# the collector's own code, so each setting's sections are the same as those
+# of a full run with it.
+#
+# Usage:
+#   collector = SweepCollector(grid(['level_1_max_radius=150/175/200']))
+#   collector.load_file('vermont.osm')            # sections of the base setting
+#   for setting, sections in collector.sweep():
+#       ...
+
+# The parameters a sweep can vary, with the options of curvature.py that set
+# them. straight_segment_split_threshold is given in miles like its option.
+parameters = (
+	'level_1_max_radius', 'level_1_weight',
+	'level_2_max_radius', 'level_2_weight',
+	'level_3_max_radius', 'level_3_weight',
+	'level_4_max_radius', 'level_4_weight',
+	'straight_segment_split_threshold',
+)
+
+# The levels in the order get_curvature_for_segment() tests them.
+levels = (4, 3, 2, 1)
+
+# The settings of a list of grids, each a comma-separated list of
+# parameter=values with values separated by '/', e.g.
+# 'level_1_max_radius=150/175/200,level_1_weight=1/1.5' for six settings. Each
+# setting is a dict of the parameters it sets.
+def grid(specs):
+	settings = []
+	for spec in specs:
+		names = []
+		values = []
+		for opt in spec.split(','):
+			opt = opt.split('=')
+			if len(opt) != 2 or opt[0] not in parameters:
+				raise ValueError("'{}' should be one of {} followed by =VALUES".format(opt[0], ', '.join(parameters)))
+			names.append(opt[0])
+			values.append([float(value) for value in opt[1].split('/')])
+		for combination in itertools.product(*values):
+			setting = dict(zip(names, combination))
+			if setting not in settings:
+				settings.append(setting)
+	return settings
+
+class SweepCollector(WayCollector):
+	def __init__(self, settings):
+		self.settings = settings
+		super(SweepCollector, self).__init__()
+
+	def reset(self):
+		super(SweepCollector, self).reset()
+		# The calculated ways with the radius bucket, heading and deflection gaps
+		# of each segment.
+		self.calculated = []
+		# The distinct level thresholds of all of the settings, between which the
+		# buckets lie.
+		self.bounds = []
+
+	# Calculate the distances and radii of our ways, keeping them to sweep, and
+	# answer their sections with our own setting.
+	def calculate(self):
+		progress = Progress('Ways calculated', len(self.ways))
+		if self.verbose:
+			progress.start()
+
+		self.bounds = self.bucket_bounds()
+		bounds = self.bounds
+		while len(self.ways):
+			batch = self.ways[-self.calculate_batch_size:]
+			del self.ways[-self.calculate_batch_size:]
+			batch.reverse()
+			for way in self.calculate_distance_and_curvature_batch(batch):
+				geometry = way.geometry
+				buckets = array.array('H', [bisect.bisect_right(bounds, radius) for radius in geometry.radii])
+				headings = array.array('d', self.deflection_headings(geometry))
+				self.calculated.append((way, buckets, headings, self.deflection_gaps(geometry)))
+			progress.count += len(batch)
+		if self.verbose:
+			progress.stop()
+		self.ways = self.score({})
+
+	# The distinct level thresholds of our own settings and those of the sweep.
+	def bucket_bounds(self):
+		bounds = set()
+		for setting in [{}] + self.settings:
+			scorer = self.scorer(setting)
+			for level in levels:
+				bounds.add(getattr(scorer, 'level_{}_max_radius'.format(level)))
+		return sorted(bounds)
+
+	# A copy of ourselves with our settings changed by those of a setting.
+	def scorer(self, setting):
+		scorer = copy.copy(self)
+		for name, value in setting.iteritems():
+			if name == 'straight_segment_split_threshold':
+				value *= 1609
+			setattr(scorer, name, value)
+		return scorer
+
+	# The sections of our calculated ways with a setting.
+	def score(self, setting):
+		scorer = self.scorer(setting)
+		# The level and weight of each bucket: those of the smallest radius in it.
+		level_table = array.array('b')
+		weight_table = []
+		for radius in [float('-inf')] + self.bounds:
+			level = 0
+			for candidate in levels:
+				if radius < getattr(scorer, 'level_{}_max_radius'.format(candidate)):
+					level = candidate
+					break
+			level_table.append(level)
+			weight_table.append(getattr(scorer, 'level_{}_weight'.format(level)) if level else 0)
+
+		sections = []
+		for way, buckets, headings, gaps in self.calculated:
+			geometry = way.geometry
+			lengths = geometry.lengths
+			way = way.copy()
+			way.geometry = WayGeometry(geometry.lats, geometry.lons, lengths, geometry.radii,
+				array.array('b', [level_table[bucket] for bucket in buckets]))
+			# Summed in segment order, as in calculate_distance_and_curvature().
+			curvature = 0
+			for i in xrange(len(lengths)):
+				curvature += lengths[i] * weight_table[buckets[i]]
+			way.curvature = curvature
+			try:
+				scorer.filter_deflections(way, headings, gaps)
+				sections += scorer.split_way_sections(way)
+			except Exception as e:
+				sys.stderr.write('\nerror calculating distance & curvature: {}'.format(e))
+				continue
+		return sections
+
+	# Answer each setting of the sweep with the sections of our ways.
+	def sweep(self):
+		for setting in self.settings:
+			yield setting, self.score(setting)
+
+# The number of the most curvy sections compared between settings.
+top = 100
+
+# Summarize the sections of each setting of a sweep, compared with those of the
+# base setting. Each row is a dict of the setting and its summary.
+def summarize(base, settings, filter):
+	# A section is the same in two settings if it starts at the same point of the
+	# same way.
+	def key(section):
+		return (section.id,) + section.geometry.start(0)
+
+	def summary(setting, sections):
+		sections = SortedWays(sections).select(filter)
+		sections.reverse()
+		length = sum([section.length for section in sections])
+		return {
+			'setting': setting,
+			'sections': len(sections),
+			'length': length / 1609,
+			'mean_curvature': sum([section.curvature for section in sections]) / len(sections) if sections else 0,
+			'max_curvature': sections[0].curvature if sections else 0,
+			'top': set([key(section) for section in sections[:top]]),
+		}
+
+	rows = [summary({}, base)]
+	for setting, sections in settings:
+		rows.append(summary(setting, sections))
+	for row in rows:
+		row['top_overlap'] = float(len(row['top'] & rows[0]['top'])) / len(rows[0]['top']) if rows[0]['top'] else 0
+	return rows
+
+# Write a tab-separated table of the rows of summarize(), with a column for each
+# parameter that a setting changes.
+def write_table(f, rows):
+	names = [name for name in parameters if any([name in row['setting'] for row in rows])]
+	f.write('\t'.join(['setting'] + names + ['sections', 'length (mi)', 'mean curvature', 'max curvature', 'top {} overlap'.format(top)]) + '\n')
+	for i, row in enumerate(rows):
+		values = ['base' if not i else str(i)]
+		values += ['{:g}'.format(row['setting'][name]) if name in row['setting'] else '-' for name in names]
+		values += [str(row['sections']), '{:.1f}'.format(row['length']), '{:.0f}'.format(row['mean_curvature']), '{:.0f}'.format(row['max_curvature']), '{:.2f}'.format(row['top_overlap'])]
+		f.write('\t'.join(values) + '\n')
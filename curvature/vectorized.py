@@ -0,0 +1,238 @@
+# NumPy implementation of WayCollector.calculate_distance_and_curvature() that
+# calculates a whole batch of ways at once.
+#
+# The coordinates of every way in the batch are concatenated into flat arrays
+# and the segment lengths, circumcircle radii of each set of three points, the
+# smaller radius of the two circumcircles each segment is a part of, the
+# curvature levels and the weighted sums are all computed with array operations.
+#
+# The results match the pure-Python implementation to within floating point
+# rounding: the trigonometric functions and the order of summation differ
+# slightly, so 'length', 'distance' and 'curvature' agree to a relative
+# tolerance of 1e-9. A segment whose radius lies within that rounding of a
+# level boundary could, in principle, be placed in the neighboring level.
+#
+# Distances are measured with the array versions of the arcs() and arc() of
+# the collector's distance kernel, which do their arithmetic in the same order
+# as the kernel. The circumradius of a gentle curve magnifies the rounding of
+# its distances many times over, so the radii would otherwise differ by more
+# than the tolerance.
+#
+# NumPy is only needed when this engine is selected.
+
+import sys
+import array
+import numpy
+from curvature.collector import rad_earth_m
+from curvature.geometry import WayGeometry
+
+# Radius used for segments that aren't part of any curve.
+straight_radius = 100000
+
+def calculate_distance_and_curvature(collector, ways):
+	# Gather the coordinates of all of our ways, skipping ways with coordinates
+	# that weren't loaded just like the Python engine fails on them.
+	batch = []
+	lats = []
+	lons = []
+	starts = []
+	# The ways we will return in order, with their index in the batch, or None for
+	# ways too short to vectorize that were calculated by the collector.
+	entries = []
+	for way in ways:
+		try:
+			if len(way.refs) < 2:
+				collector.calculate_distance_and_curvature(way)
+				entries.append((way, None))
+				continue
+			coords = [collector.coords[ref] for ref in way.refs]
+			if None in coords:
+				raise ValueError('coordinates missing for way {}'.format(way.id))
+		except Exception as e:
+			sys.stderr.write('\nerror calculating distance & curvature: {}'.format(e))
+			continue
+		entries.append((way, len(batch)))
+		starts.append(len(lats))
+		for lat, lon in coords:
+			lats.append(lat)
+			lons.append(lon)
+		batch.append(way)
+
+	if not len(batch):
+		return [way for way, w in entries]
+
+	arcs, distances = kernel_arrays[collector.distance_kernel.name]
+	lat = numpy.array(lats)
+	lon = numpy.array(lons)
+	starts = numpy.array(starts)
+	ends = numpy.append(starts[1:], len(lats)) - 1
+	# Index of the way that each point belongs to.
+	point_way = numpy.repeat(numpy.arange(len(starts)), ends - starts + 1)
+	failed = numpy.zeros(len(batch), dtype=bool)
+
+	# The length of the segment from each point to the next.
+	seg_arcs, skip_arcs = arcs(lat, lon, starts)
+	seg_length = seg_arcs * rad_earth_m
+	seg_valid = point_way[:-1] == point_way[1:]
+	failed[point_way[:-1][seg_valid & numpy.isnan(seg_length)]] = True
+
+	# The circumcircle radius of the triangle starting at each point.
+	tri_valid = point_way[:-2] == point_way[2:]
+	a = seg_length[1:]
+	b = seg_length[:-1]
+	c = skip_arcs * rad_earth_m
+	failed[point_way[:-2][tri_valid & numpy.isnan(c)]] = True
+	# ignore curvature from zero-distance
+	nonzero = tri_valid & (a > 0) & (b > 0) & (c > 0)
+	with numpy.errstate(divide='ignore', invalid='ignore'):
+		divisor = numpy.sqrt(numpy.fabs((a+b+c)*(b+c-a)*(c+a-b)*(a+b-c)))
+		# Three points in an exact line are straight.
+		r = numpy.where(nonzero & (divisor > 0), (a * b * c) / divisor, straight_radius)
+	r[~tri_valid] = numpy.inf
+
+	# Each segment is part of the triangles starting one point before it and at
+	# its start; use the smaller of the two radii.
+	seg_radius = numpy.empty(len(seg_length))
+	if len(r):
+		seg_radius[0] = r[0]
+		seg_radius[1:-1] = numpy.minimum(r[:-1], r[1:])
+		seg_radius[-1] = r[-1]
+	else:
+		seg_radius[:] = numpy.inf
+	# Two-coordinate ways have no triangles.
+	seg_radius[numpy.isinf(seg_radius)] = straight_radius
+
+	seg_level = numpy.zeros(len(seg_length), dtype=numpy.int8)
+	seg_weight = numpy.zeros(len(seg_length))
+	for level in range(1, 5):
+		in_level = seg_radius < getattr(collector, 'level_{}_max_radius'.format(level))
+		seg_level[in_level] = level
+		seg_weight[in_level] = getattr(collector, 'level_{}_weight'.format(level))
+
+	seg_length = seg_length[seg_valid]
+	seg_radius = seg_radius[seg_valid]
+	seg_level = seg_level[seg_valid]
+	seg_curvature = seg_length * seg_weight[seg_valid]
+	# Offsets of each way's first segment in the valid segment arrays.
+	seg_offsets = starts - numpy.arange(len(starts))
+
+	way_length = numpy.add.reduceat(seg_length, seg_offsets)
+	way_curvature = numpy.add.reduceat(seg_curvature, seg_offsets)
+	way_distance = distances(lat[starts], lon[starts], lat[ends], lon[ends]) * rad_earth_m
+	failed |= numpy.isnan(way_distance)
+
+	seg_offsets = seg_offsets.tolist() + [len(seg_length)]
+	starts = starts.tolist()
+	ends = ends.tolist()
+	calculated = []
+	for way, w in entries:
+		if w is None:
+			calculated.append(way)
+			continue
+		if failed[w]:
+			sys.stderr.write('\nerror calculating distance & curvature: math error in way {}'.format(way.id))
+			continue
+		first_seg = seg_offsets[w]
+		last_seg = seg_offsets[w + 1]
+		way.geometry = WayGeometry(
+			to_array('d', lat[starts[w]:ends[w] + 1]),
+			to_array('d', lon[starts[w]:ends[w] + 1]),
+			to_array('d', seg_length[first_seg:last_seg]),
+			to_array('d', seg_radius[first_seg:last_seg]),
+			to_array('b', seg_level[first_seg:last_seg]))
+		way.length = float(way_length[w])
+		way.curvature = float(way_curvature[w])
+		way.distance = float(way_distance[w])
+		way.refs = None # refs are no longer needed now that we have loaded our segments
+		calculated.append(way)
+
+	return calculated
+
+# Copy a NumPy array into a Python array of the given typecode.
+def to_array(typecode, values):
+	result = array.array(typecode)
+	result.fromstring(values.tostring())
+	return result
+
+# Array version of the cosines distance kernel. Pairs of points that would raise
+# a math domain error from acos() are returned as NaN.
+def cosines_distances(lat1, long1, lat2, long2):
+	degrees_to_radians = numpy.pi/180.0
+	phi1 = (90.0 - lat1)*degrees_to_radians
+	phi2 = (90.0 - lat2)*degrees_to_radians
+	theta1 = long1*degrees_to_radians
+	theta2 = long2*degrees_to_radians
+	cos = (numpy.sin(phi1)*numpy.sin(phi2)*numpy.cos(theta1 - theta2) +
+		   numpy.cos(phi1)*numpy.cos(phi2))
+	with numpy.errstate(invalid='ignore'):
+		arc = numpy.arccos(cos)
+	arc[(lat1 == lat2) & (long1 == long2)] = 0
+	return arc
+
+# Array version of the haversine distance kernel.
+def haversine_distances(lat1, long1, lat2, long2):
+	degrees_to_radians = numpy.pi/180.0
+	lat1 = lat1*degrees_to_radians
+	lat2 = lat2*degrees_to_radians
+	sin_lat = numpy.sin((lat2 - lat1) / 2)
+	sin_lon = numpy.sin((long2 - long1)*degrees_to_radians / 2)
+	h = sin_lat*sin_lat + numpy.cos(lat1)*numpy.cos(lat2)*sin_lon*sin_lon
+	return 2 * numpy.arcsin(numpy.sqrt(numpy.minimum(h, 1)))
+
+# Array version of the equirectangular distance kernel.
+def equirectangular_distances(lat1, long1, lat2, long2):
+	degrees_to_radians = numpy.pi/180.0
+	lat1 = lat1*degrees_to_radians
+	lat2 = lat2*degrees_to_radians
+	lon = (long2 - long1)*degrees_to_radians
+	# Take the short way around across the antimeridian.
+	lon = numpy.where(lon > numpy.pi, lon - 2 * numpy.pi, numpy.where(lon < -numpy.pi, lon + 2 * numpy.pi, lon))
+	x = lon * (numpy.cos(lat1) + numpy.cos(lat2)) / 2
+	y = lat2 - lat1
+	return numpy.sqrt(x*x + y*y)
+
+# Array versions of the arcs() of the distance kernels: the arcs from each of a
+# series of points to the next and to the one after that, of the ways starting
+# at each of starts.
+def cosines_arcs(lat, lon, starts):
+	return cosines_distances(lat[:-1], lon[:-1], lat[1:], lon[1:]), cosines_distances(lat[:-2], lon[:-2], lat[2:], lon[2:])
+
+def haversine_arcs(lat, lon, starts):
+	degrees_to_radians = numpy.pi/180.0
+	# Half of each angle, for the sines of half of each difference.
+	half_phi = lat*(degrees_to_radians / 2)
+	cos = numpy.cos(half_phi * 2)
+	half_theta = lon*(degrees_to_radians / 2)
+	arcs = []
+	for step in (1, 2):
+		sin_lat = numpy.sin(half_phi[step:] - half_phi[:-step])
+		sin_lon = numpy.sin(half_theta[step:] - half_theta[:-step])
+		h = sin_lat*sin_lat + cos[step:]*cos[:-step]*sin_lon*sin_lon
+		arcs.append(2 * numpy.arcsin(numpy.sqrt(numpy.minimum(h, 1))))
+	return arcs
+
+def equirectangular_arcs(lat, lon, starts):
+	degrees_to_radians = numpy.pi/180.0
+	phi = lat*degrees_to_radians
+	# Half of the cosine of each latitude, so that the sum of two is their average.
+	half_cos = numpy.cos(phi) / 2
+	# Take the short way around across the antimeridian by moving the western
+	# hemisphere points of ways that cross it a turn to the east.
+	if len(starts):
+		counts = numpy.diff(numpy.append(starts, len(lon)))
+		crosses = numpy.maximum.reduceat(lon, starts) - numpy.minimum.reduceat(lon, starts) > 180
+		lon = numpy.where(numpy.repeat(crosses, counts) & (lon < 0), lon + 360, lon)
+	theta = lon*degrees_to_radians
+	arcs = []
+	for step in (1, 2):
+		x = (theta[step:] - theta[:-step]) * (half_cos[step:] + half_cos[:-step])
+		y = phi[step:] - phi[:-step]
+		arcs.append(numpy.sqrt(x*x + y*y))
+	return arcs
+
+# The arcs() and arc() of each distance kernel.
+kernel_arrays = {
+	'cosines': (cosines_arcs, cosines_distances),
+	'haversine': (haversine_arcs, haversine_distances),
+	'equirectangular': (equirectangular_arcs, equirectangular_distances),
+}
@@ -0,0 +1,123 @@
+# Compact records of the ways of a run.
+#
+# A run holds a record for every candidate way of an extract and every section
+# calculated from them. A dict for each costs several hundred bytes for its keys
+# and hash table alone, so a Way keeps its fields in __slots__ instead.
+#
+# The highway types, surfaces and counties of ways take only a few hundred
+# distinct values, and names repeat for each of the many ways a road is split
+# into, yet each is held by every way. So they are kept as integer codes into
+# a StringTable and only decoded as the outputs write them through the name,
+# type, surface and county properties.
+#
+# Each way refers to the table its codes are in. A table is made for each run
+# of a collector (and each results file or database read), so it only holds
+# the strings of those ways and is freed along with the last of them. Codes
+# are only comparable between ways of the same table. A table is pickled once
+# along with all of the ways that share it.
+#
+# Usage:
+#   table = StringTable()
+#   way = Way(osm_id, 'Main Street', 'secondary', 'asphalt', '', table, refs)
+#   way.type_code == table.code('secondary')
+#   way.name                # u'Main Street', decoded
+
+# Strings by integer code, each stored once.
+class StringTable(object):
+	def __init__(self):
+		self.codes = {}
+		self.strings = []
+
+	# The code of a string, adding it if it is new.
+	def code(self, value):
+		code = self.codes.get(value)
+		if code is None:
+			code = len(self.strings)
+			self.codes[value] = code
+			self.strings.append(value)
+		return code
+
+	def __getitem__(self, code):
+		return self.strings[code]
+
+	def __len__(self):
+		return len(self.strings)
+
+class Way(object):
+	__slots__ = ('id', 'strings', 'name_code', 'type_code', 'surface_code', 'county_code', 'refs', 'geometry', 'curvature', 'length', 'distance', 'bounds')
+
+	def __init__(self, id, name, type, surface, county, strings, refs=None):
+		self.id = id
+		self.strings = strings
+		self.name_code = strings.code(name)
+		self.type_code = strings.code(type)
+		self.surface_code = strings.code(surface)
+		self.county_code = strings.code(county)
+		self.refs = refs
+		self.geometry = None
+		self.curvature = 0.0
+		self.length = 0.0
+		self.distance = 0.0
+		# The (min_lat, max_lat, min_lon, max_lon) of the geometry once known.
+		self.bounds = None
+
+	@property
+	def name(self):
+		return self.strings[self.name_code]
+
+	@name.setter
+	def name(self, value):
+		self.name_code = self.strings.code(value)
+
+	@property
+	def type(self):
+		return self.strings[self.type_code]
+
+	@property
+	def surface(self):
+		return self.strings[self.surface_code]
+
+	@property
+	def county(self):
+		return self.strings[self.county_code]
+
+	# A copy that shares the refs and geometry of this way.
+	def copy(self):
+		way = Way.__new__(Way)
+		way.id = self.id
+		way.strings = self.strings
+		way.name_code = self.name_code
+		way.type_code = self.type_code
+		way.surface_code = self.surface_code
+		way.county_code = self.county_code
+		way.refs = self.refs
+		way.geometry = self.geometry
+		way.curvature = self.curvature
+		way.length = self.length
+		way.distance = self.distance
+		way.bounds = self.bounds
+		return way
+
+	# The fields of the way as a tuple of builtin types, e.g. for marshal, with
+	# its strings as codes in its table.
+	def to_tuple(self):
+		return (self.id, self.name_code, self.type_code, self.surface_code, self.county_code, self.refs)
+
+	# A way from the fields of to_tuple() with codes in a table.
+	@classmethod
+	def from_tuple(cls, fields, strings):
+		way = cls.__new__(cls)
+		way.strings = strings
+		way.id, way.name_code, way.type_code, way.surface_code, way.county_code, way.refs = fields
+		way.geometry = None
+		way.curvature = 0.0
+		way.length = 0.0
+		way.distance = 0.0
+		way.bounds = None
+		return way
+
+	def __getstate__(self):
+		return (self.id, self.strings, self.name_code, self.type_code, self.surface_code, self.county_code, self.refs, self.geometry, self.curvature, self.length, self.distance, self.bounds)
+
+	def __setstate__(self, state):
+		self.id, self.strings, self.name_code, self.type_code, self.surface_code, self.county_code, self.refs, self.geometry, self.curvature, self.length, self.distance, self.bounds = state
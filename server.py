@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+# server.py
+#
+# Serve the calculated ways of a curvature run over HTTP, as GeoJSON or KML for
+# a bounding box or web map tile, e.g. to a map frontend.
+#
+# The dataset is a SQLite database written by curvature.py with --sqlite or a
+# results file written with --save_results. Send the server a SIGHUP or POST to
+# /reload to load it again after it is rewritten. See curvature/server.py for the
+# requests it answers.
+#
+# Usage:
+#   ./server.py --port 8000 vermont.c_300.sqlite
+#   curl 'http://127.0.0.1:8000/ways.geojson?bbox=-72.5,44.0,-72.2,44.2&min_curvature=1000'
+
+import sys
+import signal
+import argparse
+import threading
+from curvature.server import WayServer
+
+parser = argparse.ArgumentParser(description='Serve the calculated ways of a curvature run over HTTP as GeoJSON or KML.')
+parser.add_argument('-v', action='store_true', help='Verbose mode, logging each request')
+parser.add_argument('--host', type=str, default='127.0.0.1', help='The address to listen on. The default is 127.0.0.1, which only answers requests from this machine.')
+parser.add_argument('--port', type=int, default=8000, help='The port to listen on. The default is 8000.')
+parser.add_argument('--cache_size', type=int, default=256, help='The number of rendered responses to keep in the cache, dropping the least recently used. 0 disables the cache. The default is 256.')
+parser.add_argument('--max_ways', type=int, default=1000, help='The most ways to answer for a request, the most curvy first. Requests may ask for fewer with limit. The default is 1000.')
+parser.add_argument('dataset', type=str, help='A SQLite database written with --sqlite or a .curvature results file written with --save_results.')
+args = parser.parse_args()
+
+server = WayServer((args.host, args.port), args.dataset, args.cache_size, args.max_ways, args.v)
+
+# Reload in a thread of its own, as the signal may arrive while a request holds
+# the server's lock.
+def reload(signum, frame):
+	threading.Thread(target=server.reload).start()
+signal.signal(signal.SIGHUP, reload)
+
+sys.stderr.write('Serving {} ways from {} at http://{}:{}/\n'.format(len(server.dataset.database), args.dataset, args.host, args.port))
+try:
+	server.serve_forever()
+except KeyboardInterrupt:
+	pass
+finally:
+	server.server_close()
@@ -14,8 +14,18 @@ import copy
 import ast
 import sys
 import argparse
+import time
 from curvature.collector import NonSplittingWayCollector
-from curvature.filter import WayFilter
+from curvature.metrics import Metrics, peak_memory_mb
+from curvature.input import Prefetcher
+from curvature import incremental
+from curvature import results
+from curvature import batch
+from curvature import distance
+from curvature.partition import TilePartitioner
+from curvature.filter import WayFilter, loosest
+from curvature.output import KmlOutputPlan
+from curvature.regionate import RegionatedKmlOutput
 from curvature.output import SurfaceKmlOutput
 
 parser = argparse.ArgumentParser(description='Generate KML files highlighing road surface based on Open Street Map (OSM) data.')
@@ -24,19 +34,79 @@ parser.add_argument('--output_path', type=str, default='.', help='The path under
 parser.add_argument('--output_basename', type=str, default=None, help='The base of the name for output files. This will be appended with a suffix and extension')
 parser.add_argument('--min_length', type=float, default=0, help='the minimum length of a way that should be included, in miles, 0 for no minimum. The default is 0')
 parser.add_argument('--max_length', type=float, default=0, help='the maximum length of a way that should be included, in miles, 0 for no maximum. The default is 0')
-parser.add_argument('--add_kml', metavar='PARAMETERS', type=str, action='append', help='Output an additional KML file with alternate output parameters. PARAMETERS should be a comma-separated list of option=value that may include any of the following options: min_length, and max_length. Example: --add_kml min_length=0.5,max_length=10')
+parser.add_argument('--kmz', action='store_true', help='Write compressed KMZ files rather than KML files. The KML is compressed as it is generated, so it is never held in memory or written uncompressed.')
+parser.add_argument('--kmz_level', type=int, default=6, help='The compression level of KMZ files from 0 (none) to 9 (smallest and slowest). The default is 6.')
+parser.add_argument('--simplify', type=float, default=0, help='Simplify the lines of ways with the Douglas-Peucker algorithm, dropping points that are within this many meters of the simplified line. Unlike --limit_points this keeps the apexes of curves. Colorized output keeps every change of curve level. The number of points removed is reported for each file. The default is 0, which keeps every point.')
+parser.add_argument('--regionate', type=int, default=0, help='Write each KML output as a quadtree of regionated files linked by NetworkLinks with at most this many ways in each tile, so that large areas can be browsed in Google Earth from the root file. Coarse tiles hold the most curvy ways, simplified, and finer tiles are loaded as they are zoomed in to. The default is 0, which writes single files.')
+parser.add_argument('--add_kml', metavar='PARAMETERS', type=str, action='append', help='Output an additional KML file with alternate output parameters. PARAMETERS should be a comma-separated list of option=value that may include any of the following options: min_length, max_length, and simplify. Example: --add_kml min_length=0.5,max_length=10')
 parser.add_argument('--ignored_surfaces', type=str, default='', help='a list of the surfaces that should be ignored.')
 parser.add_argument('--highway_types', type=str, default='secondary,residential,tertiary,primary,primary_link,motorway,motorway_link,road,trunk,trunk_link,unclassified', help='a list of the highway types that should be included. The default is secondary,residential,tertiary,primary,primary_link,motorway,motorway_link,road,trunk,trunk_link,unclassified')
 parser.add_argument('--min_lat_bound', type=float, default=None, help='The minimum latitude to include.')
 parser.add_argument('--max_lat_bound', type=float, default=None, help='The maximum latitude to include.')
 parser.add_argument('--min_lon_bound', type=float, default=None, help='The minimum longitude to include.')
 parser.add_argument('--max_lon_bound', type=float, default=None, help='The maximum longitude to include.')
-parser.add_argument('file', type=argparse.FileType('r'), nargs='+', help='the input file. Should be an OSM XML file.')
+parser.add_argument('--flat_nodes', type=str, default=None, help='A directory in which to keep a memory-mapped cache of the node locations in each input file. The first run on a file builds its cache while parsing the ways; later runs on the same unchanged file read node locations from the cache rather than parsing the file a second time.')
+parser.add_argument('--parser_concurrency', type=int, default=None, help='The number of processes to use for parsing the input file. The default is one per CPU.')
+parser.add_argument('--engine', type=str, default='python', choices=['python', 'numpy'], help='The implementation used to calculate distance and curvature. The numpy engine calculates batches of ways with array operations and requires the numpy module. Its results match the default python engine to a relative tolerance of 1e-9. The default is python.')
+parser.add_argument('--distance', type=str, default='cosines', choices=['cosines', 'haversine', 'equirectangular'], help='The formula used to measure distances. cosines is the spherical law of cosines, which can be off by a centimeter on short segments. haversine is the haversine formula, which is accurate at any distance. equirectangular is a flat projection at the latitude of each segment, which is the fastest and as accurate as haversine for segments of up to a kilometer. See curvature/distance.py for their error bounds. The default is cosines.')
+parser.add_argument('--prefetch_dir', type=str, default=None, help='A directory in which to decompress the next compressed input file while the current one is being processed. By default compressed files are decompressed as they are parsed without using any disk space.')
+parser.add_argument('--state', type=str, default=None, help='A directory in which to keep the state of the run so that OSM change files (.osc, .osc.gz or .osc.bz2) can later be applied to it. Input files that are change files are applied to the state, recalculating only the routes they affect, and other input files replace it.')
+parser.add_argument('--save_results', action='store_true', help='Save the calculated ways as a binary results file named with the output basename followed by .surfaces.curvature. Results files can be passed as input files in place of OSM files to write other outputs without recalculating.')
+parser.add_argument('--tiles', type=str, default=None, help='Process the input in geographic tiles to bound the memory used, using this directory for temporary files. Every way is spooled to disk during a single parse and each route is calculated in the tile of its first node, so routes that cross tile borders are still joined.')
+parser.add_argument('--tile_size', type=float, default=10, help='The size of tiles in degrees of latitude and longitude when using --tiles. The default is 10.')
+parser.add_argument('--tile_memory', type=int, default=2048, help='The approximate memory budget in megabytes for calculating a tile when using --tiles. Tiles with more ways than fit are split, but a route is kept in a single tile. The default is 2048.')
+parser.add_argument('--jobs', type=int, default=1, help='The number of input files to process at once, each in a worker process of its own. 0 uses one per CPU. The time and peak memory of each file is reported as it completes. The default is 1, which processes files one after another.')
+parser.add_argument('--metrics', type=str, default=None, help='Write the wall time, CPU time, peak memory, counts and throughput of each phase of the run (parsing ways, loading coordinates, joining, calculating and output) to this file as JSON.')
+parser.add_argument('--profile', type=str, default=None, help='Run each phase under cProfile and write its statistics to <phase>.prof in this directory, for use with pstats or snakeviz. With --jobs, the statistics of each file are written to a directory of their own named after it.')
+parser.add_argument('file', type=argparse.FileType('r'), nargs='+', help='the input file. Should be an OSM XML file, optionally compressed with bzip2 (.osm.bz2) or gzip (.osm.gz), or a PBF file. Use - to read OSM XML from standard input. A .curvature results file saved with --save_results may also be given.')
 args = parser.parse_args()
 
 rad_earth_mi = 3960 # Radius of the earth in miles
 rad_earth_m = 6373000 # Radius of the earth in meters
 
+# Validate our kmz_level argument.
+if args.kmz_level < 0 or args.kmz_level > 9:
+	sys.stderr.write("--kmz_level must be between 0 and 9.\n")
+	exit(2);
+
+# Validate our simplify argument.
+if args.simplify < 0:
+	sys.stderr.write("--simplify must be 0 or more.\n")
+	exit(2);
+
+# Validate our regionate argument.
+if args.regionate < 0:
+	sys.stderr.write("--regionate must be 0 or more.\n")
+	exit(2);
+
+# Validate our state argument.
+for file in args.file:
+	if file is not sys.stdin and incremental.is_change_file(file.name) and args.state is None:
+		sys.stderr.write("--state is required to apply the change file {}.\n".format(file.name))
+		exit(2);
+
+# Validate our tiles argument.
+if args.tiles is not None and args.state is not None:
+	sys.stderr.write("--tiles can't be used with --state.\n")
+	exit(2);
+
+# Validate our jobs argument.
+if args.jobs != 1:
+	if args.jobs < 0:
+		sys.stderr.write("--jobs must be 0 or more.\n")
+		exit(2);
+	if sys.stdin in args.file or args.state is not None:
+		sys.stderr.write("--jobs can't be used with standard input or --state.\n")
+		exit(2);
+
+# Validate our engine argument.
+if args.engine == 'numpy':
+	try:
+		import numpy
+	except ImportError:
+		sys.stderr.write("--engine numpy requires the numpy module.\n")
+		exit(2);
+
 # Instantiate our collector
 collector = NonSplittingWayCollector()
 default_filter = WayFilter()
@@ -53,36 +123,89 @@ collector.min_lat_bound = args.min_lat_bound
 collector.max_lat_bound = args.max_lat_bound
 collector.min_lon_bound = args.min_lon_bound
 collector.max_lon_bound = args.max_lon_bound
+collector.flat_nodes = args.flat_nodes
+collector.parser_concurrency = args.parser_concurrency
+collector.engine = args.engine
+collector.distance_kernel = distance.kernels[args.distance]
+collector.metrics = Metrics(args.profile)
+if args.prefetch_dir is not None and args.jobs == 1:
+	collector.prefetcher = Prefetcher(args.prefetch_dir)
 
-# start parsing
-for file in args.file:
+# The keys of --add_kml that set the filter of its file.
+filter_keys = ('min_length', 'max_length')
+
+# The filter of the file of an --add_kml option string.
+def add_kml_filter(opt_string):
+	filter = copy.copy(default_filter)
+	for opt in opt_string.split(','):
+		opt = opt.split('=')
+		if len(opt) >= 2 and opt[0] in filter_keys:
+			setattr(filter, opt[0], float(opt[1]))
+	return filter
+
+if args.tiles is not None:
+	# Keep only the sections of each tile that some output writes, so that the
+	# merged tiles (and any results saved with --save_results) hold no others.
+	filters = [default_filter]
+	if args.add_kml is not None:
+		filters += [add_kml_filter(opt_string) for opt_string in args.add_kml]
+	tile_filter = loosest(filters)
+	partitioner = TilePartitioner(args.tiles, args.tile_size, args.tile_memory, tile_filter)
+else:
+	partitioner = None
+
+# Load, calculate and write the outputs of an input file, answering a summary of
+# the time and memory used.
+def process_file(filename):
+	start_time = time.time()
 	if args.v:
-		sys.stderr.write("Loading {}\n".format(file.name))
+		sys.stderr.write("Loading {}\n".format(filename))
 
-	collector.load_file(file.name)
+	if results.is_results_file(filename):
+		collector.ways = results.load(filename)
+	elif args.state is not None:
+		incremental.load_file(collector, filename, args.state)
+	elif partitioner is not None:
+		partitioner.load_file(collector, filename)
+	else:
+		collector.load_file(filename)
 
 	# Generate KML output
 	if args.v:
 		sys.stderr.write("generating KML output\n")
 
 	if args.output_path is None:
-		path = os.path.dirname(file.name)
+		path = os.path.dirname(filename)
 	else:
 		path = args.output_path
 	if args.output_basename is None:
-		basename = os.path.basename(file.name)
+		basename = os.path.basename(filename)
+		if filename == '-':
+			basename = 'stdin'
 		parts = os.path.splitext(basename)
+		if results.is_results_file(filename) and parts[0].endswith('.surfaces'):
+			parts = os.path.splitext(parts[0])
 		basename = parts[0]
 	else:
 		basename = os.path.basename(args.output_basename)
 
+	# Save the calculated ways so that outputs can be written again without recalculating
+	if args.save_results and not results.is_results_file(filename):
+		results.save(os.path.join(path, basename + '.surfaces' + results.extension), collector.ways, {'source': filename, 'collector': 'NonSplittingWayCollector', 'distance': collector.distance_kernel.name})
+
+	plan = KmlOutputPlan(collector.ways)
 	kml = SurfaceKmlOutput(default_filter)
-	kml.write(collector.ways, path, basename)
+	if args.kmz:
+		kml.kmz_level = args.kmz_level
+	kml.simplify_tolerance = args.simplify
+	if args.regionate:
+		kml = RegionatedKmlOutput(kml, args.regionate)
+	plan.add(kml, path, basename)
 
 	if args.add_kml is not None:
 		for opt_string in args.add_kml:
-			colorize = args.colorize
-			filter = copy.copy(default_filter)
+			filter = add_kml_filter(opt_string)
+			simplify = args.simplify
 			opts = opt_string.split(',')
 			for opt in opts:
 				opt = opt.split('=')
@@ -91,15 +214,78 @@ for file in args.file:
 					sys.stderr.write("Key '{}' passed to --add_kml has no value, ignoring.\n".format(key))
 					continue
 				value = opt[1]
-				if key == 'min_length':
-					filter.min_length = float(value)
-				elif key == 'max_length':
-					filter.max_length = float(value)
+				if key in filter_keys:
+					# Set by add_kml_filter()
+					pass
+				elif key == 'simplify':
+					simplify = float(value)
 				else:
 					sys.stderr.write("Ignoring unknown key '{}' passed to --add_kml\n".format(key))
 
 			kml = SurfaceKmlOutput(filter)
-			kml.write(collector.ways, path, basename)
+			if args.kmz:
+				kml.kmz_level = args.kmz_level
+			kml.simplify_tolerance = simplify
+			if args.regionate:
+				kml = RegionatedKmlOutput(kml, args.regionate)
+			plan.add(kml, path, basename)
+
+	# Write all of the KML files in a single pass over the ways
+	with collector.metrics.phase('output:kml') as phase:
+		plan.write()
+		phase.count('ways', len(collector.ways))
+
+	return {'file': filename, 'ways': len(collector.ways), 'seconds': time.time() - start_time, 'memory': peak_memory_mb(), 'metrics': collector.metrics.to_dict()}
+
+# Process a file in a batch worker, profiling it into a directory of its own.
+def process_file_in_worker(filename):
+	if args.profile is not None:
+		collector.metrics.profile_dir = os.path.join(args.profile, os.path.basename(filename))
+	return process_file(filename)
+
+# argparse opens '-' as standard input.
+filenames = []
+for file in args.file:
+	if file is sys.stdin:
+		filenames.append('-')
+	else:
+		filenames.append(file.name)
+
+# start parsing
+if args.jobs == 1:
+	try:
+		for i, filename in enumerate(filenames):
+			# Decompress the next file while we work on this one.
+			if collector.prefetcher is not None and i + 1 < len(filenames) and filenames[i + 1] != '-':
+				collector.prefetcher.start(filenames[i + 1])
+
+			process_file(filename)
+	finally:
+		# Don't leave a file being decompressed if processing one failed.
+		if collector.prefetcher is not None:
+			collector.prefetcher.cancel()
+else:
+	# Process each file in a worker process of its own, at most jobs at a time.
+	jobs = args.jobs or batch.default_jobs()
+	if collector.parser_concurrency is None:
+		# Share the CPUs between the parsers of our workers.
+		collector.parser_concurrency = max(1, batch.default_jobs() // jobs)
+	start_time = time.time()
+	failed = False
+	for index, summary, error in batch.run(process_file_in_worker, filenames, jobs):
+		if error is not None:
+			sys.stderr.write("Processing {} failed:\n{}\n".format(filenames[index], error))
+			failed = True
+			continue
+		sys.stderr.write("{file}: {seconds:.1f} seconds, {memory:.1f}MB peak memory, {ways} ways\n".format(**summary))
+		collector.metrics.merge(summary['metrics'])
+	sys.stderr.write("{} files processed in {:.1f} seconds\n".format(len(filenames), time.time() - start_time))
+
+if args.metrics is not None:
+	collector.metrics.write(args.metrics)
+
+if args.jobs != 1 and failed:
+	exit(1)
 
 if args.v:
 	sys.stderr.write("done.\n")